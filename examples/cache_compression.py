@@ -0,0 +1,119 @@
+"""Benchmark of compressed storage of item metadata and primary texts
+in the pyalveo cache, comparing database size against read latency.
+
+By default the benchmark uses synthetic items built from the sample
+responses in the test suite. To measure with real data, pass the path of
+an existing cache directory: its items and primary texts are copied into
+a temporary cache for each codec, and the original is left unchanged.
+
+    python examples/cache_compression.py [cache_dir]
+
+No server access or API key is needed.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+
+import pyalveo
+from pyalveo.cache import CODECS, zstandard
+
+# number of synthetic items to generate
+n_items = 2000
+
+# number of random lookups to time for each codec
+n_reads = 2000
+
+here = os.path.dirname(os.path.abspath(__file__))
+responses = os.path.join(here, '..', 'tests', 'responses')
+
+
+def synthetic_entries():
+    """Return (item_url, metadata, primary_text) entries based on the
+    sample item and document in the test suite"""
+    with open(os.path.join(responses, '1-190.json')) as fd:
+        metadata = json.load(fd)
+    with open(os.path.join(responses, '1-190-plain.txt'), 'rb') as fd:
+        text = fd.read()
+
+    entries = []
+    for n in range(n_items):
+        url = 'https://app.alveo.edu.au/catalog/cooee/%d' % n
+        metadata['alveo:catalog_url'] = url
+        metadata['alveo:metadata']['dcterms:identifier'] = str(n)
+        entries.append((url, json.dumps(metadata), text + str(n).encode()))
+    return entries
+
+
+def cached_entries(cache_dir):
+    """Return the (item_url, metadata, primary_text) entries held in an
+    existing cache"""
+    cache = pyalveo.Cache(cache_dir)
+    rows = cache.conn.execute("SELECT url FROM items").fetchall()
+    entries = []
+    for url, in rows:
+        text = None
+        if cache.has_primary_text(url):
+            text = cache.get_primary_text(url)
+        entries.append((url, cache.get_item(url), text))
+    return entries
+
+
+def benchmark(entries, codec, level=None):
+    """Write the entries to a new cache using the codec and return the
+    size of the stored values, the database size and the mean time to
+    read an item and its primary text"""
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = pyalveo.Cache(cache_dir, compression=codec,
+                              compression_level=level, journal_mode='DELETE')
+        cache.add_items_bulk((url, metadata) for url, metadata, text in entries)
+        cache.add_primary_texts_bulk((url, text) for url, metadata, text in entries
+                                     if text is not None)
+        cache.conn.execute("VACUUM")
+        size = os.path.getsize(cache.database)
+        data_size = (cache.conn.execute("SELECT sum(length(metadata)) FROM items").fetchone()[0] +
+                     (cache.conn.execute("SELECT sum(length(primary_text)) FROM primary_texts").fetchone()[0] or 0))
+
+        urls = [url for url, metadata, text in entries]
+        start = time.time()
+        for n in range(n_reads):
+            url = urls[(n * 7919) % len(urls)]
+            cache.lookup_item_metadata(url)
+            cache.lookup_primary_text(url)
+        latency = (time.time() - start) / n_reads
+        cache.conn.close()
+        return data_size, size, latency
+    finally:
+        shutil.rmtree(cache_dir, True)
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) > 1:
+        entries = cached_entries(sys.argv[1])
+    else:
+        entries = synthetic_entries()
+
+    codecs = [(None, None), ('zlib', 1), ('zlib', None), ('zlib', 9)]
+    if zstandard is not None:
+        codecs += [('zstd', 1), ('zstd', None), ('zstd', 19)]
+    else:
+        print("zstandard is not installed, skipping zstd")
+
+    print("%d items" % len(entries))
+    # the database grows in whole pages, so its size falls in steps
+    # as the stored values shrink
+    print("%-8s %7s %12s %12s %8s %14s" % ('codec', 'level', 'data bytes', 'db bytes',
+                                           'ratio', 'read (us/item)'))
+    base_size = None
+    for codec, level in codecs:
+        data_size, size, latency = benchmark(entries, codec, level)
+        base_size = base_size or size
+        print("%-8s %7s %12d %12d %8.2f %14.1f" % (codec or 'none',
+                                                   'default' if level is None else level,
+                                                   data_size, size, float(base_size) / size,
+                                                   latency * 1e6))
@@ -6,5 +6,12 @@ __author__ = 'Steve Cassidy'
 __email__ = 'Steve.Cassidy@mq.edu.au'
 __version__ = '1.1'
 
-from .pyalveo import Client, ItemGroup, ItemList, Item, Document, APIError
+from .pyalveo import Client, ItemGroup, ItemList, Item, Document, APIError, BatchError
 from .cache import Cache
+from .retry import RetryPolicy
+from .ratelimit import RateLimiter
+from .metrics import Metrics
+
+import sys
+if sys.version_info >= (3, 7):
+    from .async_client import AsyncClient
@@ -0,0 +1,496 @@
+"""asyncio interface to the Alveo API
+
+Requires Python 3.7 or later and the optional aiohttp package
+(pip install pyalveo[async]).
+"""
+
+import asyncio
+import functools
+import json
+import os
+import shutil
+import tempfile
+
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from .cache import Cache, MISS
+from .objects import ItemGroup, Item
+from .pyalveo import Client, APIError, BatchError, DOWNLOAD_CHUNK_SIZE, _annotation_query_url
+
+
+def _read_file(path):
+    """ Return the content of a file """
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _remove_file(path):
+    """ Remove a file if it exists """
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class AsyncClient(object):
+    """ Client object providing awaitable versions of the read-only
+    Client methods, so that many requests can be in flight at once on
+    a single event loop.
+
+    Item, ItemGroup and Document objects returned by an AsyncClient call
+    back into it, so eg. item.get_primary_text(), document.get_content()
+    and document.download_content() return awaitables. Methods needing a
+    request the AsyncClient doesn't provide, such as
+    document.get_content_buffer(), document.open_content() or anything
+    that modifies data on the server, are only available from a Client.
+
+    Cache lookups and updates, and reading and writing files, are run in
+    the event loop's default executor so that they don't block the loop.
+    """
+
+    def __init__(self, api_key=None, cache=None, api_url=None,
+                 use_cache=True, update_cache=True, cache_dir=None,
+                 verifySSL=True, configfile=None, max_connections=100):
+        """ Construct a new AsyncClient with the specified parameters.
+        Unspecified parameters will be derived from the users ~/alveo.config
+        file if present.
+
+        :type api_key: :class:String
+        :param api_key: the API key to use
+        :type cache: :class:Cache
+        :param cache: the Cache to use
+        :type api_url: String
+        :param api_url: the base URL for the API server used
+        :type use_cache: Boolean
+        :param use_cache: True to fetch available data from the
+            cache database, False to always fetch data from the server
+        :type update_cache: Boolean
+        :param update_cache: True to update the cache database with
+            downloaded data, False to never write to the cache
+        :type verifySSL: Boolean
+        :param verifySSL True to enforce checking of SSL certificates, False
+            to disable checking (eg. for staging/testing servers)
+        :type configfile: String
+        :param configfile File name to read configuration from, default ~/alveo.config
+        :type max_connections: int
+        :param max_connections: the maximum number of simultaneous
+            connections to the server
+
+        :rtype: AsyncClient
+        :returns: the new AsyncClient
+        """
+        if aiohttp is None:
+            raise ImportError("AsyncClient requires the aiohttp package")
+
+        config = Client._read_config(configfile)
+
+        self.api_key = api_key or config.get('apiKey', None)
+        self.api_url = api_url or config.get('base_url', None)
+        self.use_cache = use_cache
+        self.update_cache = update_cache
+        self.cache_dir = cache_dir or config.get('cache_dir', None)
+        self.verifySSL = verifySSL
+        self.max_connections = max_connections
+
+        if not self.api_key:
+            raise APIError(http_status_code="0", response="Local Error", msg="Client could not be created. Check your api key")
+
+        if self.use_cache or self.update_cache:
+            if cache is None or isinstance(cache, str):
+                self.cache = Cache(self.cache_dir, config.get('max_age', 0))
+            else:
+                self.cache = cache
+        else:
+            self.cache = None
+
+        self._session = None
+
+    @staticmethod
+    def from_client(client, max_connections=100):
+        """ Create an AsyncClient with the same settings and cache as
+        an existing Client, which must be using an API key
+
+        :type client: Client
+        :param client: the Client to copy
+
+        :rtype: AsyncClient
+        :returns: the new AsyncClient
+        """
+        return AsyncClient(api_key=client.oauth.api_key,
+                           cache=client.cache,
+                           api_url=client.api_url,
+                           use_cache=client.use_cache,
+                           update_cache=client.update_cache,
+                           cache_dir=client.cache_dir,
+                           verifySSL=client.oauth.verifySSL,
+                           max_connections=max_connections)
+
+    def _get_session(self):
+        """ Return the aiohttp session, creating it on first use so that
+        it belongs to the running event loop """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections,
+                                             ssl=None if self.verifySSL else False)
+            headers = {'Accept': 'application/json',
+                       'X-API-KEY': self.api_key}
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  headers=headers)
+        return self._session
+
+    async def _run(self, fn, *args):
+        """ Run a blocking function, such as a Cache method or file
+        operation, in the event loop's default executor """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(fn, *args))
+
+    async def close(self):
+        """ Close the HTTP session and its connections """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def api_request(self, url, data=None, method='GET', raw=False):
+        """ Perform an API request to the given URL, optionally
+        including the specified data
+
+        :type url: String
+        :param url: the URL to which to make the request
+        :type data: String
+        :param data: the data to send with the request, if any
+        :type method: String
+        :param method: the HTTP request method
+        :type raw: Boolean
+        :para raw: if True, return the raw response, otherwise treat as JSON and return the parsed response
+
+        :returns: the response from the server either as a raw response or a Python dictionary
+            generated by parsing the JSON response
+
+        :raises: APIError if the API request is not successful
+
+
+        """
+        if not url.startswith(self.api_url):
+            url = self.api_url + url
+
+        headers = {}
+        if data is not None:
+            headers['Content-Type'] = 'application/json'
+
+        session = self._get_session()
+        async with session.request(method, url, data=data, headers=headers) as response:
+            content = await response.read()
+            if response.status >= 400:
+                raise APIError(response.status,
+                               '',
+                               "Error accessing API (url: %s, method: %s)\nData: %s\nMessage: %s" % (url, method, data, content.decode('utf-8', 'replace')))
+
+        if raw:
+            return content
+        else:
+            return json.loads(content.decode('utf-8'))
+
+    async def get_item(self, item_url, force_download=False):
+        """ Retrieve the item metadata from the server, as an Item object
+
+        :type item_url: String or Item
+        :param item_url: URL of the item, or an Item object
+        :type force_download: Boolean
+        :param force_download: True to download from the server
+            regardless of the cache's contents
+
+        :rtype: Item
+        :returns: the corresponding metadata, as an Item object
+
+        :raises: APIError if the API request is not successful
+
+
+        """
+        item_url = str(item_url)
+
+        metadata = MISS
+        if self.use_cache and not force_download:
+            metadata = await self._run(self.cache.lookup_item_metadata, item_url)
+
+        if metadata is MISS:
+            item_json = await self.api_request(item_url, raw=True)
+            if self.update_cache:
+                await self._run(self.cache.add_item, item_url, item_json)
+            metadata = json.loads(item_json.decode('utf-8'))
+
+        return Item(metadata, self)
+
+    async def get_item_batch(self, item_urls, force_download=False, workers=None):
+        """ Retrieve the metadata for several items concurrently, as
+        Item objects
+
+        :type item_urls: List or ItemGroup
+        :param item_urls: the URLs of the items, or Item objects
+        :type force_download: Boolean
+        :param force_download: True to download from the server
+            regardless of the cache's contents
+        :type workers: int
+        :param workers: the maximum number of requests in flight at once,
+            None to limit only by max_connections
+
+        :rtype: List
+        :returns: a List of Item objects in the same order as item_urls
+
+        :raises: BatchError if any request fails
+
+
+        """
+        item_urls = [str(url) for url in item_urls]
+        limit = asyncio.Semaphore(workers or self.max_connections)
+
+        async def fetch(url):
+            async with limit:
+                return await self.get_item(url, force_download)
+
+        results = await asyncio.gather(*[fetch(url) for url in item_urls],
+                                       return_exceptions=True)
+        errors = [(url, result) for url, result in zip(item_urls, results)
+                  if isinstance(result, Exception)]
+        if errors:
+            raise BatchError([None if isinstance(result, Exception) else result
+                              for result in results], errors)
+        return results
+
+    async def _get_metadata(self, item):
+        """ Return the metadata of an Item object, or fetch it for an item URL """
+        if isinstance(item, Item):
+            return item.metadata()
+        return (await self.get_item(item)).metadata()
+
+    async def get_document(self, doc_url, force_download=False):
+        """ Retrieve the data for the given document from the server
+
+        :type doc_url: String or Document
+        :param doc_url: the URL of the document, or a Document object
+        :type force_download: Boolean
+        :param force_download: True to download from the server
+            regardless of the cache's contents
+
+        :rtype: String
+        :returns: the document data
+
+        :raises: APIError if the API request is not successful
+
+
+        """
+        doc_url = str(doc_url)
+        cached_path = MISS
+        if self.use_cache and not force_download:
+            cached_path = await self._run(self.cache.lookup_document_path, doc_url)
+
+        if cached_path is not MISS:
+            doc_data = await self._run(_read_file, cached_path)
+        else:
+            doc_data = await self.api_request(doc_url, raw=True)
+            if self.update_cache:
+                await self._run(self.cache.add_document, doc_url, doc_data)
+
+        return doc_data
+
+    async def download_document(self, doc_url, file_path, force_download=False):
+        """ Download the content of the given document to a file
+
+        The content is written in chunks as it arrives so that large
+        documents never have to fit in memory. It is also stored in the
+        cache if update_cache is set.
+
+        :type doc_url: String or Document
+        :param doc_url: the URL of the document, or a Document object
+        :type file_path: String
+        :param file_path: the path to which to write the data
+        :type force_download: Boolean
+        :param force_download: True to download from the server
+            regardless of the cache's contents
+
+        :rtype: String
+        :returns: the path to the downloaded file
+
+        :raises: APIError if the API request is not successful
+
+
+        """
+        doc_url = str(doc_url)
+        cached_path = MISS
+        if self.use_cache and not force_download:
+            cached_path = await self._run(self.cache.lookup_document_path, doc_url)
+
+        if cached_path is MISS and self.update_cache:
+            fd, part_path = await self._run(tempfile.mkstemp, '.part', '',
+                                            self.cache.file_dir)
+            os.close(fd)
+            await self.__download(doc_url, part_path)
+            cached_path = await self._run(self.cache.add_document_file, doc_url, part_path)
+
+        if cached_path is not MISS:
+            await self._run(shutil.copyfile, cached_path, file_path)
+        else:
+            part_path = file_path + '.part'
+            await self.__download(doc_url, part_path)
+            await self._run(shutil.move, part_path, file_path)
+
+        return file_path
+
+    async def __download(self, url, file_path):
+        """ Stream the response for the given URL into a file, removing
+        the file if the download fails """
+        if not url.startswith(self.api_url):
+            url = self.api_url + url
+
+        session = self._get_session()
+        try:
+            async with session.get(url) as response:
+                if response.status >= 400:
+                    content = await response.read()
+                    raise APIError(response.status,
+                                   '',
+                                   "Error accessing API (url: %s, method: GET)\nMessage: %s" % (url, content.decode('utf-8', 'replace')))
+                f = await self._run(open, file_path, 'wb')
+                try:
+                    async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        await self._run(f.write, chunk)
+                finally:
+                    await self._run(f.close)
+        except BaseException:
+            await self._run(_remove_file, file_path)
+            raise
+
+    async def get_primary_text(self, item_url, force_download=False):
+        """ Retrieve the primary text for an item from the server
+
+        :type item_url: String or Item
+        :param item_url: URL of the item, or an Item object
+        :type force_download: Boolean
+        :param force_download: True to download from the server
+            regardless of the cache's contents
+
+        :rtype: String
+        :returns: the item's primary text if it has one, otherwise None
+
+        :raises: APIError if the request was not successful
+
+
+        """
+        metadata = await self._get_metadata(item_url)
+        item_url = str(item_url)
+
+        try:
+            primary_text_url = metadata['alveo:primary_text_url']
+        except KeyError:
+            return None
+
+        if primary_text_url == 'No primary text found':
+            return None
+
+        primary_text = MISS
+        if self.use_cache and not force_download:
+            primary_text = await self._run(self.cache.lookup_primary_text, item_url)
+
+        if primary_text is MISS:
+            primary_text = await self.api_request(primary_text_url, raw=True)
+            if self.update_cache:
+                await self._run(self.cache.add_primary_text, item_url, primary_text)
+
+        return primary_text
+
+    async def get_item_annotations(self, item_url, annotation_type=None, label=None,
+                                   force_download=False):
+        """ Retrieve the annotations for an item from the server
+
+        :type item_url: String or Item
+        :param item_url: URL of the item, or an Item object
+        :type annotation_type: String
+        :param annotation_type: return only results with a matching Type field
+        :type label: String
+        :param label: return only results with a matching Label field
+        :type force_download: Boolean
+        :param force_download: True to download from the server
+            regardless of the cache's contents
+
+        :rtype: Dict
+        :returns: the annotations as a dictionary, if the item has
+            annotations, otherwise None
+
+        :raises: APIError if the request was not successful
+
+
+        """
+        metadata = await self._get_metadata(item_url)
+        item_url = str(item_url)
+
+        try:
+            annotation_url = metadata['alveo:annotations_url']
+        except KeyError:
+            return None
+
+        annotations = MISS
+        if self.use_cache and not force_download:
+            annotations = await self._run(self.cache.lookup_item_annotations,
+                                          item_url, annotation_type, label)
+
+        if annotations is MISS:
+            req_url = _annotation_query_url(annotation_url, annotation_type, label)
+            ann_json = await self.api_request(req_url, raw=True)
+            if self.update_cache:
+                await self._run(self.cache.add_item_annotations,
+                                item_url, ann_json, annotation_type, label)
+            annotations = json.loads(ann_json.decode('utf-8'))
+
+        return annotations
+
+    async def search_metadata(self, query):
+        """ Submit a search query to the server and retrieve the results
+
+        :type query: String
+        :param query: the search query
+
+        :rtype: ItemGroup
+        :returns: the search results
+
+        :raises: APIError if the API request is not successful
+
+
+        """
+        query_url = ('/catalog/search?' +
+                     urlencode((('metadata', query),)))
+
+        resp = await self.api_request(query_url)
+        return ItemGroup(resp['items'], self)
+
+    async def sparql_query(self, collection_name, query):
+        """ Submit a sparql query to the server to search metadata
+        and annotations.
+
+        :type collection_name: String
+        :param collection_name: the name of the collection to search
+        :type query: String
+        :param query: the sparql query
+
+        :rtype: Dict
+        :returns: the query result from the server as a Python dictionary
+
+        :raises: APIError if the request was not successful
+
+
+        """
+        request_url = '/sparql/' + collection_name + '?'
+        request_url += urlencode((('query', query),))
+
+        return await self.api_request(request_url)
@@ -1,19 +1,454 @@
 import os
+import hashlib
+import mmap
+import shutil
 import sqlite3
-import datetime
-import uuid
-import warnings
+import threading
+import time
+import weakref
+import tempfile
 import json
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def _table_exists(c, table):
+    """ Return True if the database has a table with the given name """
+    c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?",
+              (table,))
+    return c.fetchone() is not None
+
+
+def _schema_version(c):
+    """ Return the schema version of the database, 0 if it is unversioned """
+    if not _table_exists(c, 'schema_version'):
+        return 0
+    c.execute("SELECT version FROM schema_version")
+    return c.fetchone()[0]
+
+
+def _rebuild_table(c, table, create_sql, columns, select=None):
+    """ Create a table using create_sql (with %s for the table name),
+    copying the given columns from any existing table of the same name,
+    computed by the select expressions if given. Later rows replace
+    earlier ones that have the same key. """
+    if not _table_exists(c, table):
+        c.execute(create_sql % table)
+        return
+    c.execute("ALTER TABLE %s RENAME TO %s_old" % (table, table))
+    c.execute(create_sql % table)
+    c.execute("INSERT OR REPLACE INTO %s (%s) SELECT %s FROM %s_old ORDER BY rowid"
+              % (table, columns, select or columns, table))
+    c.execute("DROP TABLE %s_old" % table)
+
+
+def _migrate_primary_keys(c, file_dir):
+    """ Schema version 1: key each table on its URL so that lookups use
+    an index and entries can be replaced with a single upsert """
+    _rebuild_table(c, 'items',
+                   """CREATE TABLE %s
+                      (url text PRIMARY KEY, metadata text, datetime text)""",
+                   'url, metadata, datetime')
+    _rebuild_table(c, 'documents',
+                   """CREATE TABLE %s
+                      (url text PRIMARY KEY, path text, datetime text)""",
+                   'url, path, datetime')
+    _rebuild_table(c, 'primary_texts',
+                   """CREATE TABLE %s
+                      (item_url text PRIMARY KEY, primary_text text, datetime text)""",
+                   'item_url, primary_text, datetime')
+
+
+def _migrate_timestamps(c, file_dir):
+    """ Schema version 2: replace the ISO 8601 datetime column with an
+    integer timestamp (seconds since the epoch) that can be compared in SQL """
+    # SQLite's strftime understands the ISO 8601 strings, including the
+    # UTC offset, written by earlier versions
+    timestamp = "CAST(strftime('%s', datetime) AS integer)"
+    _rebuild_table(c, 'items',
+                   """CREATE TABLE %s
+                      (url text PRIMARY KEY, metadata text, timestamp integer)""",
+                   'url, metadata, timestamp',
+                   'url, metadata, ' + timestamp)
+    _rebuild_table(c, 'documents',
+                   """CREATE TABLE %s
+                      (url text PRIMARY KEY, path text, timestamp integer)""",
+                   'url, path, timestamp',
+                   'url, path, ' + timestamp)
+    _rebuild_table(c, 'primary_texts',
+                   """CREATE TABLE %s
+                      (item_url text PRIMARY KEY, primary_text text, timestamp integer)""",
+                   'item_url, primary_text, timestamp',
+                   'item_url, primary_text, ' + timestamp)
+
+
+def _migrate_document_sizes(c, file_dir):
+    """ Schema version 3: record the size and last access time of each
+    cached document so that the cache can be trimmed to a byte budget """
+    c.execute("ALTER TABLE documents ADD COLUMN size integer")
+    c.execute("ALTER TABLE documents ADD COLUMN last_access integer")
+    c.execute("SELECT url, path FROM documents")
+    for url, path in c.fetchall():
+        size = os.path.getsize(path) if os.path.isfile(path) else 0
+        c.execute("UPDATE documents SET size=?, last_access=timestamp WHERE url=?",
+                  (size, url))
+    c.execute("CREATE INDEX documents_last_access ON documents (last_access)")
+
+
+def _migrate_document_hashes(c, file_dir):
+    """ Schema version 4: record the SHA-256 hash of each cached document,
+    which names its file in the content-addressed store """
+    c.execute("ALTER TABLE documents ADD COLUMN hash text")
+    c.execute("CREATE INDEX documents_hash ON documents (hash)")
+
+
+def _migrate_relative_paths(c, file_dir):
+    """ Schema version 5: queue the documents cached in the old flat
+    layout to be moved into the content-addressed store, with their
+    paths recorded relative to file_dir so that the cache directory can
+    be moved. Hashing and moving the files can take a long time, so it
+    is done by Cache.__migrate_document_files in small batches after the
+    schema transaction; until then the old paths are still used. """
+    c.execute("""CREATE TABLE legacy_documents
+                 (url text PRIMARY KEY, path text)""")
+    c.execute("INSERT INTO legacy_documents SELECT url, path FROM documents")
+
+
+def _migrate_codecs(c, file_dir):
+    """ Schema version 6: record the compression codec of each item's
+    metadata and primary text, NULL for values stored uncompressed """
+    c.execute("ALTER TABLE items ADD COLUMN codec text")
+    c.execute("ALTER TABLE primary_texts ADD COLUMN codec text")
+
+
+def _migrate_annotations(c, file_dir):
+    """ Schema version 7: add a table of item annotations, keyed on the
+    item URL and the type and label filters ('' for no filter) """
+    c.execute("""CREATE TABLE annotations
+                 (item_url text, annotation_type text, label text,
+                  annotations text, codec text, timestamp integer,
+                  PRIMARY KEY (item_url, annotation_type, label))""")
+
+
+def _migrate_missing(c, file_dir):
+    """ Schema version 8: add a table of negative results, recording
+    URLs known to have no data of some kind """
+    c.execute("""CREATE TABLE missing
+                 (url text, kind text, timestamp integer,
+                  PRIMARY KEY (url, kind))""")
+
+
+def _migrate_validators(c, file_dir):
+    """ Schema version 9: record the ETag and Last-Modified headers sent
+    with each item and document, so that stale entries can be revalidated
+    with a conditional request instead of downloaded again """
+    for table in ('items', 'documents'):
+        c.execute("ALTER TABLE %s ADD COLUMN etag text" % table)
+        c.execute("ALTER TABLE %s ADD COLUMN last_modified text" % table)
+
+
+# the total size of the cached documents, counting content shared by
+# several documents once and each legacy document without a hash separately
+DOCUMENTS_TOTAL_SQL = """coalesce((SELECT sum(size) FROM
+                                   (SELECT max(size) AS size FROM documents
+                                    WHERE hash IS NOT NULL GROUP BY hash)), 0) +
+                         coalesce((SELECT sum(size) FROM documents WHERE hash IS NULL), 0)"""
+
+
+def _migrate_documents_total(c, file_dir):
+    """ Schema version 10: keep a running total of the size of the cached
+    documents, so that it needn't be summed over every document each time
+    one is added """
+    c.execute("CREATE TABLE documents_total (bytes integer)")
+    c.execute("INSERT INTO documents_total SELECT " + DOCUMENTS_TOTAL_SQL)
+
+
+# Schema migrations, in order. Applying MIGRATIONS[n] to a database at
+# schema version n brings it to version n + 1; a database created before
+# the schema was versioned is at version 0.
+MIGRATIONS = [
+    _migrate_primary_keys,
+    _migrate_timestamps,
+    _migrate_document_sizes,
+    _migrate_document_hashes,
+    _migrate_relative_paths,
+    _migrate_codecs,
+    _migrate_annotations,
+    _migrate_missing,
+    _migrate_validators,
+    _migrate_documents_total,
+]
+
+# last_access is only updated when a document is read this many seconds
+# after the previous recorded access, to avoid a write on every cache hit
+ACCESS_TIME_RESOLUTION = 60
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+# seconds to wait for another connection's write lock before failing
+BUSY_TIMEOUT = 30
+
+# number of legacy document files moved into the content-addressed
+# store in each transaction by Cache.__migrate_document_files
+MIGRATION_BATCH_SIZE = 100
+
+def _file_digest(file_path):
+    """ Return the SHA-256 hash of the content of a file, as a hex string """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _blob_name(digest):
+    """ Return the path, relative to the cache's file directory, of the
+    file holding the content with the given hash. Files are sharded into
+    two levels of subdirectories by hash prefix to keep directories small. """
+    return '/'.join((digest[:2], digest[2:4], digest))
+
+
+def _map_file(file_path):
+    """ Return a read-only memoryview over the content of a file,
+    memory-mapped so that only the parts that are used are read """
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # empty files can't be mapped
+            return memoryview(b'')
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+# compression codecs for item metadata and primary texts
+CODECS = ('zlib', 'zstd')
+
+# values smaller than this are stored uncompressed
+MIN_COMPRESS_SIZE = 256
+
+
+def _encode(value, codec, level=None):
+    """ Compress a metadata or primary text value for storage
+
+    :returns: a (value, codec tag) pair; the tag is None if the value is
+        stored as is, otherwise the codec name, followed by '/utf-8' if
+        the value was text rather than bytes
+    """
+    if codec is None or value is None or len(value) < MIN_COMPRESS_SIZE:
+        return value, None
+    tag = codec
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+        tag += '/utf-8'
+    if codec == 'zlib':
+        data = zlib.compress(value, -1 if level is None else level)
+    else:
+        data = zstandard.ZstdCompressor(level=3 if level is None else level).compress(value)
+    return sqlite3.Binary(data), tag
+
+
+def _decode(value, tag):
+    """ Restore a value stored by _encode, given its codec tag
+
+    :raises: ValueError if the codec is not supported
+    """
+    if tag is None:
+        return value
+    codec, _, encoding = tag.partition('/')
+    if codec == 'zlib':
+        value = zlib.decompress(value)
+    elif codec == 'zstd' and zstandard is not None:
+        value = zstandard.ZstdDecompressor().decompress(value)
+    else:
+        raise ValueError("Cache entry uses unsupported codec: %s" % codec)
+    if encoding:
+        value = value.decode(encoding)
+    return value
+
+
+def _filter_annotations(annotations, annotation_type=None, label=None):
+    """ Select the annotations with the given type and label from an
+    annotation set, as the server does for a filtered request """
+    result = dict(annotations)
+    result['alveo:annotations'] = [
+        ann for ann in annotations.get('alveo:annotations', [])
+        if (annotation_type is None or ann.get('type') == annotation_type) and
+           (label is None or ann.get('label') == label)]
+    return result
+
+
+def _linked_kinds(item_metadata):
+    """ Return the kinds of missing data, as recorded by Cache.add_missing,
+    that an item's metadata (a JSON string) now links to """
+    if isinstance(item_metadata, bytes):
+        item_metadata = item_metadata.decode('utf-8', 'replace')
+    kinds = []
+    if ('"alveo:primary_text_url"' in item_metadata and
+            'No primary text found' not in item_metadata):
+        kinds.append('primary_text')
+    if '"alveo:annotations_url"' in item_metadata:
+        kinds.append('annotations')
+    return kinds
+
+
+class _ThreadConnection(object):
+    """ A thread's connection to the cache database """
+
+    def __init__(self, conn):
+        self.conn = conn
+        # nesting depth of transaction() blocks, commits are deferred while > 0
+        self.depth = 0
+        # (path, hash) of the document files released and stored in the
+        # transaction, removed once it commits or rolls back respectively
+        self.released = []
+        self.stored = []
+
+
+def _close_thread_connection(cache_ref, conn, pid):
+    """ Close the connection of a thread that has exited. Connections
+    inherited by a child process are left open, as in Cache.close(). """
+    if os.getpid() != pid:
+        return
+    cache = cache_ref()
+    if cache is not None:
+        cache._forget_connection(conn)
+    conn.close()
+
+
+class _Miss(object):
+    """ Type of the MISS sentinel """
+    def __repr__(self):
+        return 'MISS'
+
+# returned by the Cache.lookup_* methods when there is no fresh entry
+MISS = _Miss()
+
+# the constructor arguments recorded by Cache.to_dict
+CACHE_SETTINGS = ('cache_dir', 'max_age', 'journal_mode', 'synchronous',
+                  'memory_entries', 'memory_bytes', 'max_bytes', 'compression',
+                  'compression_level', 'missing_max_age', 'stale_while_revalidate')
+
+JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+
+class MemoryCache(object):
+    """ A bounded, thread-safe, least recently used in-memory cache,
+    limited both by number of entries and by their total size """
+
+    def __init__(self, max_entries=1000, max_bytes=64 * 1024 * 1024,
+                 max_entry_bytes=1024 * 1024):
+        """ Create a new MemoryCache
+
+        :type max_entries: int
+        :param max_entries: the maximum number of entries to hold
+        :type max_bytes: int
+        :param max_bytes: the maximum total size of the entries
+        :type max_entry_bytes: int
+        :param max_entry_bytes: entries larger than this are not held
+
+        :rtype: MemoryCache
+        :returns: the new MemoryCache
 
-import dateutil.parser
-import dateutil.tz
 
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # key -> (value, size, expiry time or None), least recent first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        """ Pickle just the limits: an unpickled MemoryCache starts empty """
+        return {'max_entries': self.max_entries, 'max_bytes': self.max_bytes,
+                'max_entry_bytes': self.max_entry_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """ Return the value stored for key, or MISS if there is no
+        entry or it has expired """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] is not None and entry[2] < time.time():
+                self.__remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return MISS
+            self.hits += 1
+            # move to the most recently used end
+            del self._entries[key]
+            self._entries[key] = entry
+            return entry[0]
+
+    def put(self, key, value, size, expires=None):
+        """ Store a value, evicting the least recently used entries
+        if necessary to stay within the limits
+
+        :param size: the size of the value in bytes
+        :param expires: the time (seconds since the epoch) after which
+            the entry is no longer valid, None if it doesn't expire
+        """
+        with self._lock:
+            self.__remove(key)
+            if size > self.max_entry_bytes or size > self.max_bytes:
+                return
+            self._entries[key] = (value, size, expires)
+            self.size += size
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                self.__remove(next(iter(self._entries)))
+
+    def invalidate(self, key):
+        """ Remove the entry for key, if any """
+        with self._lock:
+            self.__remove(key)
+
+    def clear(self):
+        """ Remove all entries """
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """ Return a dict of the hit and miss counts and current size """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self._entries), 'bytes': self.size}
+
+    def __remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
 
 
 class Cache(object):
     """ Handles caching for Alveo API Client objects """
 
-    def __init__(self, cache_dir, max_age=0):
+    MISS = MISS
+
+    def __init__(self, cache_dir, max_age=0, journal_mode='WAL',
+                 synchronous='NORMAL', memory_entries=0,
+                 memory_bytes=64 * 1024 * 1024, max_bytes=None,
+                 compression=None, compression_level=None,
+                 missing_max_age=24 * 60 * 60, stale_while_revalidate=0):
         """ Create a new Cache object
 
         :type cache_dir: String
@@ -21,16 +456,60 @@ class Cache(object):
         :type max_age: int
         :param max_age: cache entries older than this many seconds will be
         ignored by the has_item, has_document and has_primary_text methods
+        :type journal_mode: String
+        :param journal_mode: the SQLite journal mode; the default WAL lets
+            readers proceed during writes, use DELETE if the cache is on a
+            network filesystem that doesn't support WAL
+        :type synchronous: String
+        :param synchronous: the SQLite synchronous setting: OFF, NORMAL
+            (the default, safe in WAL mode), FULL or EXTRA
+        :type memory_entries: int
+        :param memory_entries: if nonzero, keep up to this many parsed item
+            metadata dicts and primary texts in an in-memory LRU cache in
+            front of the database. The dicts are shared between the Items
+            returned, so should not be modified.
+        :type memory_bytes: int
+        :param memory_bytes: the maximum total size of the in-memory entries
+        :type max_bytes: int
+        :param max_bytes: if set, the total size of cached document files is
+            kept under this many bytes by removing the least recently used
+            documents whenever a new one is added
+        :type compression: String
+        :param compression: if set, compress item metadata and primary
+            texts written to the database with this codec: 'zlib', or
+            'zstd' if the zstandard package is installed. Entries are
+            tagged with their codec, so a cache can be read whatever
+            compression it was written with.
+        :type compression_level: int
+        :param compression_level: the compression level, or None for
+            the codec's default
+        :type missing_max_age: int
+        :param missing_max_age: how many seconds to remember negative
+            results, such as items with no primary text or documents that
+            were not found; 0 or None to not record them
+        :type stale_while_revalidate: int
+        :param stale_while_revalidate: if nonzero, lookups made with
+            stale=True also return entries up to this many seconds older
+            than max_age, so that a Client can use them straight away
+            while it refreshes them in the background
 
         :rtype: Cache
         :returns: the new Cache
 
 
         """
-        self.max_age = max_age
-        self.cache_dir = os.path.expanduser(cache_dir)
-        self.database = os.path.join(self.cache_dir, 'alveo_cache.db')
-        self.file_dir = os.path.join(self.cache_dir, 'files')
+        if journal_mode.upper() not in JOURNAL_MODES:
+            raise ValueError("Unknown journal mode: %s" % journal_mode)
+        if synchronous.upper() not in SYNCHRONOUS_MODES:
+            raise ValueError("Unknown synchronous setting: %s" % synchronous)
+        if compression is not None and compression not in CODECS:
+            raise ValueError("Unknown compression codec: %s" % compression)
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError("zstd compression requires the zstandard package")
+
+        self.__init_settings(cache_dir, max_age, journal_mode, synchronous,
+                             memory_entries, memory_bytes, max_bytes, compression,
+                             compression_level, missing_max_age, stale_while_revalidate)
 
         # create file_dir using makedirs which will also make cache_dir if needed
         if not os.path.exists(self.file_dir):
@@ -38,12 +517,42 @@ class Cache(object):
         elif not os.path.isdir(self.cache_dir):
             raise Exception("file_dir exists and is not a directory")
 
-        if not os.path.isfile(self.database):
-
-            self.create_cache_database()
+        # each thread gets its own database connection, opened on first use
+        # and reopened in a child process after a fork
+        self.__reset_connections()
+        # connections inherited from a parent process, which are kept
+        # open but never used because closing them could disturb the parent
+        self._inherited = []
+
+        # create the tables, or migrate a database written by an older version
+        self.__upgrade_database(self.conn, self.file_dir)
+        self.__migrate_document_files()
+
+    def __init_settings(self, cache_dir, max_age=0, journal_mode='WAL',
+                        synchronous='NORMAL', memory_entries=0,
+                        memory_bytes=64 * 1024 * 1024, max_bytes=None,
+                        compression=None, compression_level=None,
+                        missing_max_age=24 * 60 * 60, stale_while_revalidate=0):
+        """ Set the attributes given by the constructor's arguments, for
+        __init__ and __setstate__ """
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.missing_max_age = missing_max_age
+        self.stale_while_revalidate = stale_while_revalidate
+        # number of documents removed by evict() or trim()
+        self.evictions = 0
+        self.journal_mode = journal_mode.upper()
+        self.synchronous = synchronous.upper()
+        self.compression = compression
+        self.compression_level = compression_level
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.database = os.path.join(self.cache_dir, 'alveo_cache.db')
+        self.file_dir = os.path.join(self.cache_dir, 'files')
 
-        self.conn = sqlite3.connect(self.database)
-        self.conn.text_factory = str
+        if memory_entries:
+            self.memory = MemoryCache(memory_entries, memory_bytes)
+        else:
+            self.memory = None
 
     def to_dict(self):
         """ 
@@ -53,6 +562,18 @@ class Cache(object):
         data = dict()
         data['max_age'] = self.max_age
         data['cache_dir'] = self.cache_dir
+        data['journal_mode'] = self.journal_mode
+        data['synchronous'] = self.synchronous
+        if self.memory is not None:
+            data['memory_entries'] = self.memory.max_entries
+            data['memory_bytes'] = self.memory.max_bytes
+        else:
+            data['memory_entries'] = 0
+        data['max_bytes'] = self.max_bytes
+        data['compression'] = self.compression
+        data['compression_level'] = self.compression_level
+        data['missing_max_age'] = self.missing_max_age
+        data['stale_while_revalidate'] = self.stale_while_revalidate
         return data
     
     def to_json(self):
@@ -71,8 +592,10 @@ class Cache(object):
             data = json.loads(json_data)
         else:
             data = json_data
-        oauth = Cache(cache_dir=data.get('cache_dir',None), max_age=data.get('max_age',None))
-        return oauth
+        # settings missing from older json take the constructor's defaults
+        settings = dict((k, v) for k, v in data.items() if k in CACHE_SETTINGS)
+        settings.setdefault('max_age', None)
+        return Cache(**settings)
 
     def create_cache_database(self):
         """ Create a new SQLite3 database for use with Cache objects
@@ -84,18 +607,159 @@ class Cache(object):
 
         conn = sqlite3.connect(self.database)
         conn.text_factory = str
+        self.__upgrade_database(conn, self.file_dir)
+        conn.close()
 
+    @staticmethod
+    def __upgrade_database(conn, file_dir):
+        """ Bring the schema of the database up to SCHEMA_VERSION,
+        applying any outstanding migrations in a single transaction
+
+        :type conn: sqlite3.Connection
+        :param conn: the connection to the database
+        :type file_dir: String
+        :param file_dir: the directory holding the cached document files
+
+        :raises: Exception if the database is newer than this module
+
+        """
         c = conn.cursor()
-        c.execute("""CREATE TABLE items
-                     (url text, metadata text, datetime text)""")
-        c.execute("""CREATE TABLE documents
-                     (url text, path text, datetime text)""")
-        c.execute("""CREATE TABLE primary_texts
-                     (item_url text, primary_text text, datetime text)""")
-        conn.commit()
-        conn.close()
+        if _schema_version(c) == SCHEMA_VERSION:
+            c.close()
+            return
 
+        # take the write lock and check again so that only one process migrates
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            version = _schema_version(c)
+            if version > SCHEMA_VERSION:
+                raise Exception("Cache database has schema version %d, this version "
+                                "of pyalveo supports up to %d" % (version, SCHEMA_VERSION))
+
+            for migration in MIGRATIONS[version:]:
+                migration(c, file_dir)
+
+            if version < SCHEMA_VERSION:
+                c.execute("CREATE TABLE IF NOT EXISTS schema_version (version integer)")
+                c.execute("DELETE FROM schema_version")
+                c.execute("INSERT INTO schema_version VALUES (?)", (SCHEMA_VERSION,))
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+        finally:
+            c.close()
+
+
+    def __migrate_document_files(self):
+        """ Move the document files queued by _migrate_relative_paths into
+        the content-addressed store, committing each batch so that other
+        processes can use the cache meanwhile. Each file is linked (or
+        copied) into the store, its row updated, and only then the old
+        file removed, so the work can be resumed if it is interrupted.
+        Only one process at a time does this; the others carry on using
+        the old paths of the documents that haven't been moved yet. """
+        c = self.conn.cursor()
+        try:
+            if not _table_exists(c, 'legacy_documents'):
+                return
+        finally:
+            c.close()
+
+        fd = None
+        if fcntl is not None:
+            fd = os.open(os.path.join(self.cache_dir, 'migrate.lock'),
+                         os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                os.close(fd)
+                return
+        try:
+            while True:
+                c = self.conn.cursor()
+                try:
+                    c.execute("""SELECT l.url, l.path, d.path, d.hash, d.size
+                                 FROM legacy_documents l
+                                 LEFT JOIN documents d ON d.url = l.url
+                                 LIMIT ?""", (MIGRATION_BATCH_SIZE,))
+                    rows = c.fetchall()
+                    if not rows:
+                        with self.transaction():
+                            c.execute("DROP TABLE IF EXISTS legacy_documents")
+                        return
+                finally:
+                    c.close()
+                self.__migrate_document_batch(rows)
+        finally:
+            if fd is not None:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+
+    def __migrate_document_batch(self, rows):
+        """ Move one batch of legacy document files for __migrate_document_files
+
+        :type rows: List
+        :param rows: (url, legacy path, current path, hash, size) for each
+            document, the current path, hash and size being None if its
+            row has been removed since
+        """
+        # hash the files before taking any locks
+        digests = {}
+        for url, old_path, path, digest, size in rows:
+            full_path = os.path.join(self.file_dir, old_path)
+            if path == old_path and digest is None and os.path.isfile(full_path):
+                digests[url] = _file_digest(full_path)
+
+        with self.__files_lock():
+            moved = []
+            with self.transaction():
+                for url, old_path, path, digest, size in rows:
+                    full_path = os.path.join(self.file_dir, old_path)
+                    if path != old_path:
+                        # already moved, replaced or removed: just tidy up
+                        if path is not None and os.path.isfile(full_path):
+                            moved.append(full_path)
+                        continue
+                    if not os.path.isfile(full_path):
+                        self.conn.execute("DELETE FROM documents WHERE url=?", (url,))
+                        self.__add_to_total(-(size or 0))
+                        continue
+                    digest = digest or digests.get(url) or _file_digest(full_path)
+                    blob_path = self.__blob_path(digest)
+                    if not os.path.exists(blob_path):
+                        self.__link_blob(full_path, blob_path)
+                    if self.__is_referenced(digest):
+                        # the content is now counted once, with the other copies
+                        self.__add_to_total(-(size or 0))
+                    self.conn.execute("UPDATE documents SET path=?, hash=? WHERE url=?",
+                                      (_blob_name(digest), digest, url))
+                    if os.path.normpath(full_path) != os.path.normpath(blob_path):
+                        moved.append(full_path)
+
+            # the rows no longer refer to the old files
+            for full_path in moved:
+                os.unlink(full_path)
+            with self.transaction():
+                self.conn.executemany("DELETE FROM legacy_documents WHERE url=?",
+                                      [(row[0],) for row in rows])
 
+    @staticmethod
+    def __link_blob(file_path, blob_path):
+        """ Add a hard link to a file at blob_path, or a copy of it if the
+        filesystem doesn't support links, keeping the original in place """
+        shard_dir = os.path.dirname(blob_path)
+        if not os.path.isdir(shard_dir):
+            os.makedirs(shard_dir)
+        tmp_path = blob_path + '.tmp'
+        if os.path.exists(tmp_path):
+            # left by an interrupted migration
+            os.unlink(tmp_path)
+        try:
+            os.link(file_path, tmp_path)
+        except (AttributeError, OSError):
+            shutil.copyfile(file_path, tmp_path)
+        os.rename(tmp_path, blob_path)
 
     def __eq__(self, other):
         """ Return True if this cache has identical fields to another
@@ -127,27 +791,288 @@ class Cache(object):
         return not self.__eq__(other)
 
 
-    def __del__(self):
-        """ Close the database connection """
-        self.conn.close()
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __getstate__(self):
+        """ Pickle the settings of this Cache, as given by to_dict, but
+        not its connections, so that it can be sent to worker processes
+        cheaply """
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        """ Restore a pickled Cache; the database has already been created,
+        so connections are just opened when they are first needed """
+        self.__init_settings(**state)
+        self.__reset_connections()
+        self._inherited = []
+
+    def __reset_connections(self):
+        """ Forget the connections of this process, or of the parent
+        process after a fork """
+        self._pid = os.getpid()
+        self._local = threading.local()
+        self._connections = []
+        # reentrant, as a thread's connection may be forgotten by a finalizer
+        # running while the thread holds the lock
+        self._connections_lock = threading.RLock()
+        # serialises changes to the document files between threads; see
+        # __files_lock for processes
+        self._lock = threading.RLock()
+        self._files_lock_depth = 0
+
+    def __connection(self):
+        """ Return the per-thread state holding this thread's connection
+        and transaction depth, opening the connection if needed """
+        if self._pid != os.getpid():
+            # in a child process: the parent's connections must not be used
+            self._inherited.extend(self._connections)
+            self.__reset_connections()
+
+        local = getattr(self._local, 'state', None)
+        if local is None:
+            # only this thread uses the connection, but close() may be
+            # called from another one
+            conn = sqlite3.connect(self.database, timeout=BUSY_TIMEOUT, check_same_thread=False)
+            conn.text_factory = str
+            conn.execute("PRAGMA journal_mode=%s" % self.journal_mode)
+            conn.execute("PRAGMA synchronous=%s" % self.synchronous)
+            with self._connections_lock:
+                self._connections.append(conn)
+            local = _ThreadConnection(conn)
+            # the thread's state is dropped when it exits, closing the connection
+            weakref.finalize(local, _close_thread_connection, weakref.ref(self),
+                             conn, os.getpid())
+            self._local.state = local
+        return local
+
+    def _forget_connection(self, conn):
+        """ Stop tracking a connection that has been closed """
+        with self._connections_lock:
+            if conn in self._connections:
+                self._connections.remove(conn)
+
+    @property
+    def conn(self):
+        """ The calling thread's connection to the cache database """
+        return self.__connection().conn
+
+    def close(self):
+        """ Close the database connections opened by this process in
+        every thread. The Cache can still be used afterwards: threads
+        reopen a connection when they next need one. """
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+            self._local = threading.local()
+        for conn in connections:
+            conn.close()
+
+    def __fetchone(self, sql, args):
+        """ Run a query and return the first row of the result, or None """
+        c = self.conn.cursor()
+        try:
+            c.execute(sql, args)
+            return c.fetchone()
+        finally:
+            c.close()
+
+    def __execute(self, sql, args, many=False):
+        """ Run a statement that modifies the database and commit it,
+        unless a transaction() is in progress """
+        local = self.__connection()
+        if many:
+            local.conn.executemany(sql, args)
+        else:
+            local.conn.execute(sql, args)
+        if local.depth == 0:
+            local.conn.commit()
+
+    @contextmanager
+    def transaction(self):
+        """ Group cache updates into a single transaction
+
+        Use in a with statement; all the add_* calls made in the block are
+        committed together at the end of it (or rolled back if it raises an
+        exception), which is much faster than committing each one. The
+        transaction belongs to the calling thread: other threads use their
+        own connections and don't see the updates until the block ends.
+        Blocks may be nested, only the outermost one commits.
+
+        """
+        local = self.__connection()
+        local.depth += 1
+        try:
+            yield self
+        except:
+            local.depth -= 1
+            if local.depth == 0:
+                # files stored for the rolled back rows are no longer needed,
+                # those they replaced are referred to again
+                stored, local.stored, local.released = local.stored, [], []
+                local.conn.rollback()
+                self.__release_files(stored)
+            raise
+        local.depth -= 1
+        if local.depth == 0:
+            released, local.released, local.stored = local.released, [], []
+            local.conn.commit()
+            self.__release_files(released)
+
+    def __lookup_row(self, sql, key, stale=False):
+        """ Run a query for the value and timestamp of a single entry,
+        adding a condition that the entry is no older than max_age, or
+        than max_age plus stale_while_revalidate if stale is True
+
+        :returns: the row, or None if there is no fresh entry
+        """
+        return self.__fetchone(sql + " AND (? <= 0 OR timestamp >= ?)",
+                               (str(key),) + self.__freshness(stale))
+
+    def __freshness(self, stale=False):
+        """ Return the arguments for the max_age condition added by
+        __lookup_row: max_age, and the oldest acceptable timestamp """
+        max_age = self.max_age or 0
+        if max_age > 0 and stale:
+            max_age += self.stale_while_revalidate or 0
+        return (max_age, int(time.time()) - max_age)
+
+    def __remember(self, key, value, size, timestamp):
+        """ Hold a value from the database in the memory cache until it
+        would become too old """
+        expires = None
+        if self.max_age:
+            expires = timestamp + self.max_age
+            if expires <= time.time():
+                # a stale entry, which will be refreshed
+                return
+        self.memory.put(key, value, size, expires)
+
+    def invalidate_memory(self, url):
+        """ Drop any in-memory copies of the metadata and primary text
+        for the given item
+
+        :type url: String or Item
+        :param url: the URL of the item, or an Item object
+
+
+        """
+        if self.memory is not None:
+            self.memory.invalidate(('item', str(url)))
+            self.memory.invalidate(('primary_text', str(url)))
+
+    def lookup_item(self, item_url, stale=False):
+        """ Retrieve the metadata for the given item from the cache,
+        if it is present and not older than max_age
+
+        :type item_url: String or Item
+        :param item_url: the URL of the item, or an Item object
+        :type stale: Boolean
+        :param stale: True to also return an entry that is past max_age
+            but within stale_while_revalidate seconds of it
+
+        :rtype: String
+        :returns: the item metadata, as a JSON string, or Cache.MISS
 
 
-    def __exists_row_not_too_old(self, row):
-        """ Check if the given row exists and is not too old """
+        """
+        row = self.__lookup_row("SELECT metadata, codec FROM items WHERE url=?", item_url, stale)
         if row is None:
-            return False
-        record_time = dateutil.parser.parse(row[2])
-        now = datetime.datetime.now(dateutil.tz.gettz())
-        age = (record_time - now).total_seconds()
-        if age > self.max_age:
-            return False
+            return MISS
+        return _decode(row[0], row[1])
 
-        return True
+    def lookup_item_metadata(self, item_url, stale=False):
+        """ Retrieve the parsed metadata for the given item from the cache,
+        if it is present and not older than max_age
 
-    @staticmethod
-    def __now_iso_8601():
-        """ Get the current local time as an ISO 8601 string """
-        return datetime.datetime.now(dateutil.tz.gettz()).isoformat()
+        If the in-memory cache is enabled the dict is kept there so that
+        repeated lookups don't need to query the database or parse the JSON.
+
+        :type item_url: String or Item
+        :param item_url: the URL of the item, or an Item object
+        :type stale: Boolean
+        :param stale: True to also return an entry that is past max_age
+            but within stale_while_revalidate seconds of it
+
+        :rtype: Dict
+        :returns: the item metadata, or Cache.MISS
+
+
+        """
+        key = ('item', str(item_url))
+        if self.memory is not None:
+            metadata = self.memory.get(key)
+            if metadata is not MISS:
+                return metadata
+
+        row = self.__lookup_row("SELECT metadata, codec, timestamp FROM items WHERE url=?",
+                                item_url, stale)
+        if row is None:
+            return MISS
+        item_json = _decode(row[0], row[1])
+        if isinstance(item_json, bytes):
+            item_json = item_json.decode('utf-8')
+        metadata = json.loads(item_json)
+        if self.memory is not None:
+            self.__remember(key, metadata, len(item_json), row[2])
+        return metadata
+
+    def lookup_document_path(self, doc_url, stale=False):
+        """ Return the path of the cached content for the given document,
+        if it is present and not older than max_age
+
+        :type doc_url: String or Document
+        :param doc_url: the URL of the document, or a Document object
+        :type stale: Boolean
+        :param stale: True to also return an entry that is past max_age
+            but within stale_while_revalidate seconds of it
+
+        :rtype: String
+        :returns: the path to the cached file, or Cache.MISS
+
+
+        """
+        row = self.__lookup_row("SELECT path, last_access FROM documents WHERE url=?",
+                                doc_url, stale)
+        if row is None:
+            return MISS
+        self.__touch_document(doc_url, row[1])
+        return os.path.join(self.file_dir, row[0])
+
+    def lookup_primary_text(self, item_url, stale=False):
+        """ Retrieve the primary text for the given item from the cache,
+        if it is present and not older than max_age
+
+        If the in-memory cache is enabled, primary texts small enough
+        for it are kept there.
+
+        :type item_url: String or Item
+        :param item_url: the URL of the item, or an Item object
+        :type stale: Boolean
+        :param stale: True to also return an entry that is past max_age
+            but within stale_while_revalidate seconds of it
+
+        :rtype: String
+        :returns: the primary text, or Cache.MISS
+
+
+        """
+        key = ('primary_text', str(item_url))
+        if self.memory is not None:
+            primary_text = self.memory.get(key)
+            if primary_text is not MISS:
+                return primary_text
+
+        row = self.__lookup_row("SELECT primary_text, codec, timestamp FROM primary_texts WHERE item_url=?",
+                                item_url, stale)
+        if row is None:
+            return MISS
+        primary_text = _decode(row[0], row[1])
+        if self.memory is not None:
+            self.__remember(key, primary_text, len(primary_text), row[2])
+        return primary_text
 
 
     def has_item(self, item_url):
@@ -165,11 +1090,7 @@ class Cache(object):
 
 
         """
-        c = self.conn.cursor()
-        c.execute("SELECT * FROM items WHERE url=?", (str(item_url),))
-        row = c.fetchone()
-        c.close()
-        return self.__exists_row_not_too_old(row)
+        return self.lookup_item(item_url) is not MISS
 
 
     def has_document(self, doc_url):
@@ -187,11 +1108,7 @@ class Cache(object):
 
 
         """
-        c = self.conn.cursor()
-        c.execute("SELECT * FROM documents WHERE url=?", (str(doc_url),))
-        row = c.fetchone()
-        c.close()
-        return self.__exists_row_not_too_old(row)
+        return self.lookup_document_path(doc_url) is not MISS
 
 
     def has_primary_text(self, item_url):
@@ -209,12 +1126,7 @@ class Cache(object):
 
 
         """
-        c = self.conn.cursor()
-        c.execute("SELECT * FROM primary_texts WHERE item_url=?",
-                      (str(item_url),))
-        row = c.fetchone()
-        c.close()
-        return self.__exists_row_not_too_old(row)
+        return self.lookup_primary_text(item_url) is not MISS
 
 
     def get_item(self, item_url):
@@ -230,13 +1142,11 @@ class Cache(object):
 
 
         """
-        c = self.conn.cursor()
-        c.execute("SELECT * FROM items WHERE url=?", (str(item_url),))
-        row = c.fetchone()
-        c.close()
+        row = self.__fetchone("SELECT metadata, codec FROM items WHERE url=?",
+                              (str(item_url),))
         if row is None:
             raise ValueError("Item not present in cache")
-        return row[1]
+        return _decode(row[0], row[1])
 
 
     def get_document(self, doc_url):
@@ -252,20 +1162,81 @@ class Cache(object):
 
 
         """
-        c = self.conn.cursor()
-        c.execute("SELECT * FROM documents WHERE url=?", (str(doc_url),))
-        row = c.fetchone()
-        c.close()
-        if row is None:
-            raise ValueError("Item not present in cache")
-        file_path = row[1]
+        file_path = self.get_document_path(doc_url)
         try:
             with open(file_path, 'rb') as f:
                 return f.read()
         except IOError as e:
             raise IOError("Error reading file " + file_path +
-                          " to retrieve document " + doc_url +
-                          ": " + e.message)
+                          " to retrieve document " + str(doc_url) +
+                          ": " + str(e))
+
+
+    def get_document_path(self, doc_url):
+        """ Return the path of the file holding the cached content for
+        the given document.
+
+        :type doc_url: String or Document
+        :param doc_url: the URL of the document, or a Document object
+
+        :rtype: String
+        :returns: the path to the cached file
+
+        :raises: ValueError if the item is not in the cache
+
+
+        """
+        row = self.__fetchone("SELECT path, last_access FROM documents WHERE url=?",
+                              (str(doc_url),))
+        if row is None:
+            raise ValueError("Item not present in cache")
+        self.__touch_document(doc_url, row[1])
+        return os.path.join(self.file_dir, row[0])
+
+    def get_document_buffer(self, doc_url):
+        """ Return a read-only buffer over the cached content for the
+        given document, without reading it all into memory
+
+        The file is memory-mapped, so slicing the buffer only reads the
+        parts of the file that are needed. Cached files are never
+        modified in place, so the buffer remains valid even if the
+        document is later replaced or evicted.
+
+        :type doc_url: String or Document
+        :param doc_url: the URL of the document, or a Document object
+
+        :rtype: memoryview
+        :returns: the document's content
+
+        :raises: ValueError if the document is not in the cache
+        :raises: IOError if there is an error reading the cached file
+
+
+        """
+        return _map_file(self.get_document_path(doc_url))
+
+    def __touch_document(self, doc_url, last_access):
+        """ Record that the given document has been used, if its recorded
+        last_access is more than ACCESS_TIME_RESOLUTION seconds old
+
+        This is best effort: readers don't wait for the write lock, so if
+        another connection is writing the update is skipped. """
+        now = int(time.time())
+        if last_access is not None and last_access >= now - ACCESS_TIME_RESOLUTION:
+            return
+        local = self.__connection()
+        try:
+            if local.depth == 0:
+                local.conn.execute("PRAGMA busy_timeout=0")
+            try:
+                self.__execute("UPDATE documents SET last_access=? WHERE url=? AND last_access<?",
+                               (now, str(doc_url), now - ACCESS_TIME_RESOLUTION))
+            finally:
+                if local.depth == 0:
+                    local.conn.execute("PRAGMA busy_timeout=%d" % (BUSY_TIMEOUT * 1000))
+        except sqlite3.OperationalError:
+            if local.depth == 0:
+                local.conn.rollback()
 
 
     def get_primary_text(self, item_url):
@@ -281,17 +1252,14 @@ class Cache(object):
 
 
         """
-        c = self.conn.cursor()
-        c.execute("SELECT * FROM primary_texts WHERE item_url=?",
-                      (str(item_url),))
-        row = c.fetchone()
-        c.close()
+        row = self.__fetchone("SELECT primary_text, codec FROM primary_texts WHERE item_url=?",
+                              (str(item_url),))
         if row is None:
             raise ValueError("Item not present in cache")
-        return row[1]
+        return _decode(row[0], row[1])
 
 
-    def add_item(self, item_url, item_metadata):
+    def add_item(self, item_url, item_metadata, etag=None, last_modified=None):
         """ Add the given item to the cache database, updating
         the existing metadata if the item is already present
 
@@ -299,60 +1267,459 @@ class Cache(object):
         :param item_url: the URL of the item, or an Item object
         :type item_metadata: String
         :param item_metadata: the item's metadata, as a JSON string
+        :type etag: String
+        :param etag: the ETag header sent with the metadata, if any
+        :type last_modified: String
+        :param last_modified: the Last-Modified header sent with the
+            metadata, if any
 
 
         """
-        c = self.conn.cursor()
-        c.execute("DELETE FROM items WHERE url=?", (str(item_url),))
-        self.conn.commit()
-        c.execute("INSERT INTO items VALUES (?, ?, ?)",
-                  (str(item_url), item_metadata, self.__now_iso_8601()))
-        self.conn.commit()
-        c.close()
+        self.add_items_bulk([(item_url, item_metadata, etag, last_modified)])
 
 
-    def __generate_filepath(self):
-        """ Generate a unique (absolute) file path within the file_dir directory
+    def add_items_bulk(self, items):
+        """ Add several items to the cache database in one transaction,
+        updating the existing metadata of any already present. Negative
+        results recorded for the primary text or annotations of an item
+        are dropped if its new metadata links to them.
 
-        :rtype: String
-        :returns: a unique file path
+        :type items: iterable
+        :param items: (item_url, item_metadata) pairs, where item_url is a
+            String or Item and item_metadata a JSON string, optionally
+            followed by the ETag and Last-Modified headers sent with it
 
 
         """
-        file_path = os.path.join(self.file_dir, str(uuid.uuid4()))
-        if os.path.exists(file_path):
-            warnings.warn("something has almost certainly gone wrong")
-            return self.__generate_filepath()
-        return file_path
+        items = [tuple(item) + (None,) * (4 - len(item)) for item in items]
+        for item in items:
+            self.invalidate_memory(item[0])
+        now = int(time.time())
+        with self.transaction():
+            self.__execute("""INSERT INTO items (url, metadata, codec, timestamp, etag, last_modified)
+                              VALUES (?, ?, ?, ?, ?, ?)
+                              ON CONFLICT(url) DO UPDATE
+                              SET metadata=excluded.metadata, codec=excluded.codec,
+                                  timestamp=excluded.timestamp, etag=excluded.etag,
+                                  last_modified=excluded.last_modified""",
+                           [(str(item_url),) +
+                            _encode(item_metadata, self.compression, self.compression_level) +
+                            (now, etag, last_modified)
+                            for item_url, item_metadata, etag, last_modified in items],
+                           many=True)
+            if self.missing_max_age:
+                self.__execute("DELETE FROM missing WHERE url=? AND kind=?",
+                               [(str(item_url), kind)
+                                for item_url, item_metadata, etag, last_modified in items
+                                for kind in _linked_kinds(item_metadata)],
+                               many=True)
+
+    def item_validators(self, item_url):
+        """ Return the ETag and Last-Modified headers recorded for the
+        cached metadata of the given item, however old it is
 
+        :type item_url: String or Item
+        :param item_url: the URL of the item, or an Item object
+
+        :rtype: Tuple
+        :returns: (etag, last_modified), either of which may be None, or
+            None if the item is not cached or has neither
+
+
+        """
+        return self.__validators("items", item_url)
+
+    def refresh_item(self, item_url, etag=None, last_modified=None):
+        """ Record that the cached metadata of the given item has been
+        confirmed to be current by the server, so that it counts as fresh
+        for another max_age seconds
 
-    def add_document(self, doc_url, data):
+        :type item_url: String or Item
+        :param item_url: the URL of the item, or an Item object
+        :type etag: String
+        :param etag: a new ETag header to record, if any
+        :type last_modified: String
+        :param last_modified: a new Last-Modified header to record, if any
+
+
+        """
+        self.__refresh("items", item_url, etag, last_modified)
+
+    def __validators(self, table, url):
+        """ Return the validators of a row of the items or documents table """
+        row = self.__fetchone("SELECT etag, last_modified FROM %s WHERE url=?" % table,
+                              (str(url),))
+        if row is None or row == (None, None):
+            return None
+        return tuple(row)
+
+    def __refresh(self, table, url, etag, last_modified):
+        """ Reset the timestamp of a row of the items or documents table,
+        and update its validators where new ones are given """
+        self.__execute("""UPDATE %s SET timestamp=?, etag=coalesce(?, etag),
+                                 last_modified=coalesce(?, last_modified)
+                          WHERE url=?""" % table,
+                       (int(time.time()), etag, last_modified, str(url)))
+
+
+    def __blob_path(self, digest):
+        """ Return the path of the file holding the content with the given hash """
+        return os.path.join(self.file_dir, _blob_name(digest))
+
+    @contextmanager
+    def __files_lock(self):
+        """ Serialise changes to the document files and the rows referring
+        to them, between threads and (where fcntl is available) between
+        processes sharing the cache, so that one process can't remove a
+        file that another is about to refer to. Blocks may be nested. """
+        with self._lock:
+            fd = None
+            if self._files_lock_depth == 0 and fcntl is not None:
+                fd = os.open(os.path.join(self.cache_dir, 'files.lock'),
+                             os.O_RDWR | os.O_CREAT, 0o666)
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            self._files_lock_depth += 1
+            try:
+                yield
+            finally:
+                self._files_lock_depth -= 1
+                if fd is not None:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                    os.close(fd)
+
+    def __write_blob(self, data, digest):
+        """ Write content to the content-addressed store """
+        fd, file_path = tempfile.mkstemp(suffix='.tmp', dir=self.file_dir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        self.__store_blob(file_path, digest)
+
+    def __store_blob(self, file_path, digest):
+        """ Move a file into the content-addressed store, or discard it if
+        the same content is already stored
+
+        :rtype: String
+        :returns: the path of the stored file
+        """
+        blob_path = self.__blob_path(digest)
+        with self.__files_lock():
+            if os.path.exists(blob_path):
+                os.unlink(file_path)
+            else:
+                shard_dir = os.path.dirname(blob_path)
+                if not os.path.isdir(shard_dir):
+                    os.makedirs(shard_dir)
+                shutil.move(file_path, blob_path)
+        return blob_path
+
+    def __release_file(self, file_path, digest):
+        """ Remove a document file that a row no longer refers to, unless
+        it holds content that other documents still refer to. file_path
+        is as recorded in the database, relative to file_dir. Inside a
+        transaction() the file is only removed once it commits, so that
+        a rollback leaves the restored rows with their files. """
+        local = self.__connection()
+        if local.depth > 0:
+            local.released.append((file_path, digest))
+            return
+        with self.__files_lock():
+            refs = self.__fetchone("SELECT count(*) FROM documents WHERE hash=?",
+                                   (digest,))[0]
+            if refs == 0:
+                self.__remove_file(file_path)
+
+    def __release_files(self, files):
+        """ Release a list of (path, hash) document files """
+        for file_path, digest in files:
+            try:
+                self.__release_file(file_path, digest)
+            except (OSError, sqlite3.Error):
+                # an unreferenced file is only wasted space
+                pass
+
+    def __remove_file(self, file_path):
+        """ Delete a file from the cache, and the shard directories
+        containing it if they are left empty """
+        file_path = os.path.join(self.file_dir, file_path)
+        if os.path.isfile(file_path):
+            os.unlink(file_path)
+        directory = os.path.dirname(file_path)
+        while os.path.normpath(directory) != os.path.normpath(self.file_dir):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
+
+
+    def partial_document_path(self, doc_url):
+        """ Return the path of the file used to hold a partial download
+        of the given document, so that an interrupted download can be
+        resumed. The file may not exist.
+
+        :type doc_url: String or Document
+        :param doc_url: the URL of the document, or a Document object
+
+        :rtype: String
+        :returns: the path to the .part file
+
+
+        """
+        name = hashlib.sha1(str(doc_url).encode('utf-8')).hexdigest()
+        return os.path.join(self.file_dir, name + '.part')
+
+    def add_document(self, doc_url, data, etag=None, last_modified=None):
         """ Add the given document to the cache, updating
         the existing content data if the document is already present
 
+        Documents are stored by the hash of their content, so identical
+        content cached for several URLs is only stored once.
+
         :type doc_url: String or Document
         :param doc_url: the URL of the document, or a Document object
         :type data: String
         :param data: the document's content data
+        :type etag: String
+        :param etag: the ETag header sent with the content, if any
+        :type last_modified: String
+        :param last_modified: the Last-Modified header sent with the
+            content, if any
 
 
         """
-        file_path = self.__generate_filepath()
-        with open(file_path, 'wb') as f:
-            f.write(data)
+        digest = hashlib.sha256(data).hexdigest()
+        blob_path = self.__blob_path(digest)
+        if not os.path.exists(blob_path):
+            self.__write_blob(data, digest)
+
+        with self.__files_lock():
+            if not os.path.exists(blob_path):
+                # another process removed the stored copy since it was checked
+                self.__write_blob(data, digest)
+            self.__add_document_row(doc_url, digest, etag, last_modified)
+
+    def add_document_file(self, doc_url, file_path, etag=None, last_modified=None):
+        """ Add a document whose content has already been written to a
+        file, updating the existing content if the document is already
+        present. The file is moved into the cache, or deleted if the
+        cache already holds identical content.
+
+        This avoids holding the content in memory for large documents;
+        file_path should be on the same filesystem as the cache (eg.
+        a temporary file in file_dir) so that the move is a rename.
+
+        :type doc_url: String or Document
+        :param doc_url: the URL of the document, or a Document object
+        :type file_path: String
+        :param file_path: the file holding the document's content
+        :type etag: String
+        :param etag: the ETag header sent with the content, if any
+        :type last_modified: String
+        :param last_modified: the Last-Modified header sent with the
+            content, if any
+
+        :rtype: String
+        :returns: the path to the cached file
+
+
+        """
+        digest = _file_digest(file_path)
+        with self.__files_lock():
+            blob_path = self.__store_blob(file_path, digest)
+            self.__add_document_row(doc_url, digest, etag, last_modified)
+        return blob_path
+
+    def document_validators(self, doc_url):
+        """ Return the ETag and Last-Modified headers recorded for the
+        cached content of the given document, however old it is
+
+        :type doc_url: String or Document
+        :param doc_url: the URL of the document, or a Document object
+
+        :rtype: Tuple
+        :returns: (etag, last_modified), either of which may be None, or
+            None if the document is not cached or has neither
+
+
+        """
+        return self.__validators("documents", doc_url)
+
+    def refresh_document(self, doc_url, etag=None, last_modified=None):
+        """ Record that the cached content of the given document has been
+        confirmed to be current by the server, so that it counts as fresh
+        for another max_age seconds
+
+        :type doc_url: String or Document
+        :param doc_url: the URL of the document, or a Document object
+        :type etag: String
+        :param etag: a new ETag header to record, if any
+        :type last_modified: String
+        :param last_modified: a new Last-Modified header to record, if any
+
+
+        """
+        self.__refresh("documents", doc_url, etag, last_modified)
+
+    def __add_document_row(self, doc_url, digest, etag=None, last_modified=None):
+        """ Record the stored content with the given hash as the cached
+        content for the given document, releasing any previously cached file.
+        The file must be stored by the caller under the same __files_lock,
+        so that the row is committed (unless a transaction() is in
+        progress) before another process can release the file. """
+        file_path = _blob_name(digest)
+        now = int(time.time())
+        with self.__files_lock(), self.transaction():
+            size = os.path.getsize(self.__blob_path(digest))
+            old_row = self.__fetchone("SELECT path, hash, size FROM documents WHERE url=?",
+                                      (str(doc_url),))
+            # removed again if the transaction is rolled back
+            self.__connection().stored.append((file_path, digest))
+            if ((old_row is None or old_row[1] != digest) and
+                    not self.__is_referenced(digest)):
+                self.__add_to_total(size)
+            self.__execute("""INSERT INTO documents (url, path, timestamp, size, last_access, hash,
+                                                     etag, last_modified)
+                              VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                              ON CONFLICT(url) DO UPDATE
+                              SET path=excluded.path, timestamp=excluded.timestamp,
+                                  size=excluded.size, last_access=excluded.last_access,
+                                  hash=excluded.hash, etag=excluded.etag,
+                                  last_modified=excluded.last_modified""",
+                           (str(doc_url), file_path, now, size, now, digest,
+                            etag, last_modified))
+            if old_row is not None and old_row[1] != digest:
+                if old_row[1] is None or not self.__is_referenced(old_row[1]):
+                    self.__add_to_total(-(old_row[2] or 0))
+            if old_row is not None and old_row[0] != file_path:
+                self.__release_file(old_row[0], old_row[1])
+            self.__forget_missing([doc_url], 'document')
+
+        if self.max_bytes is not None:
+            self.trim(self.max_bytes, keep=doc_url)
+
+    def verify_document(self, doc_url):
+        """ Check that the cached file for the given document still holds
+        the content that was downloaded, by comparing its hash. If it does
+        not, the document and any others sharing the file are removed
+        from the cache.
+
+        :type doc_url: String or Document
+        :param doc_url: the URL of the document, or a Document object
+
+        :rtype: Boolean
+        :returns: True if the cached content is intact, False if it was removed
+
+        :raises: ValueError if the document is not in the cache
 
-        c = self.conn.cursor()
-        c.execute("SELECT * FROM documents WHERE url=?", (str(doc_url),))
-        for row in c.fetchall():
-            old_file_path = row[1]
-            if os.path.isfile(old_file_path):
-                os.unlink(old_file_path)
-        c.execute("DELETE FROM documents WHERE url=?", (str(doc_url),))
-        self.conn.commit()
-        c.execute("INSERT INTO documents VALUES (?, ?, ?)",
-                  (str(doc_url), file_path, self.__now_iso_8601()))
-        self.conn.commit()
-        c.close()
+
+        """
+        row = self.__fetchone("SELECT path, hash, size FROM documents WHERE url=?",
+                              (str(doc_url),))
+        if row is None:
+            raise ValueError("Item not present in cache")
+        file_path, digest, size = row
+        full_path = os.path.join(self.file_dir, file_path)
+        if digest is None and os.path.isfile(full_path):
+            # a legacy file not yet moved into the store has no hash to check
+            return True
+        if os.path.isfile(full_path) and _file_digest(full_path) == digest:
+            return True
+
+        # the file may be shared, so drop every document that refers to it
+        with self.__files_lock(), self.transaction():
+            self.__execute("DELETE FROM documents WHERE url=? OR hash=?",
+                           (str(doc_url), digest))
+            self.__add_to_total(-(size or 0))
+            self.__release_file(file_path, digest)
+        return False
+
+    def documents_size(self):
+        """ Return the total size of the cached document files, counting
+        content shared by several documents once
+
+        :rtype: int
+        :returns: the size in bytes
+
+
+        """
+        return self.__fetchone("SELECT bytes FROM documents_total", ())[0]
+
+    def __add_to_total(self, size):
+        """ Adjust the running total returned by documents_size """
+        if size:
+            self.__execute("UPDATE documents_total SET bytes = bytes + ?", (size,))
+
+    def __is_referenced(self, digest):
+        """ Return True if any document refers to the content with the given hash """
+        return self.__fetchone("SELECT 1 FROM documents WHERE hash=? LIMIT 1",
+                               (digest,)) is not None
+
+    def evict(self):
+        """ Remove least recently used documents until the cached
+        documents fit within max_bytes. Does nothing if max_bytes is not set.
+
+        :rtype: int
+        :returns: the number of documents removed
+
+
+        """
+        if self.max_bytes is None:
+            return 0
+        return self.trim(self.max_bytes)
+
+    def trim(self, max_bytes, keep=None):
+        """ Remove least recently used documents, and their files, until
+        the total size of the cached documents is at most max_bytes
+
+        :type max_bytes: int
+        :param max_bytes: the size to trim the document cache to
+        :type keep: String or Document
+        :param keep: the URL of a document that should not be removed
+
+        :rtype: int
+        :returns: the number of documents removed
+
+
+        """
+        removed = []
+        with self.__files_lock():
+            # the running total makes this cheap when nothing needs removing
+            total = start_total = self.documents_size()
+            if total <= max_bytes:
+                return 0
+            conn = self.conn
+            c = conn.cursor()
+            # files with shared content are only freed when every
+            # document referring to them has been removed
+            refs = {}
+            c.execute("SELECT url, path, size, hash FROM documents ORDER BY last_access, rowid")
+            for url, path, size, digest in c:
+                if total <= max_bytes:
+                    break
+                if url == str(keep):
+                    continue
+                removed.append((url, path, digest))
+                if digest is None:
+                    # a legacy document, not shared
+                    total -= size or 0
+                    continue
+                if digest not in refs:
+                    refs[digest] = self.__fetchone("SELECT count(*) FROM documents WHERE hash=?",
+                                                   (digest,))[0]
+                refs[digest] -= 1
+                if refs[digest] == 0:
+                    total -= size or 0
+            c.close()
+            with self.transaction():
+                for url, path, digest in removed:
+                    conn.execute("DELETE FROM documents WHERE url=?", (url,))
+                self.__add_to_total(total - start_total)
+            self.evictions += len(removed)
+
+            for url, path, digest in removed:
+                if digest is None or refs[digest] == 0:
+                    self.__release_file(path, digest)
+        return len(removed)
 
     def add_primary_text(self, item_url, primary_text):
         """ Add the given primary text to the cache database, updating
@@ -365,11 +1732,150 @@ class Cache(object):
 
 
         """
-        c = self.conn.cursor()
-        c.execute("DELETE FROM primary_texts WHERE item_url=?",
-                      (str(item_url),))
-        self.conn.commit()
-        c.execute("INSERT INTO primary_texts VALUES (?, ?, ?)",
-                  (str(item_url), primary_text, self.__now_iso_8601()))
-        self.conn.commit()
-        c.close()
+        self.add_primary_texts_bulk([(item_url, primary_text)])
+
+    def add_primary_texts_bulk(self, primary_texts):
+        """ Add several primary texts to the cache database in one
+        transaction, updating any that are already present
+
+        :type primary_texts: iterable
+        :param primary_texts: (item_url, primary_text) pairs
+
+
+        """
+        primary_texts = list(primary_texts)
+        for item_url, primary_text in primary_texts:
+            self.invalidate_memory(item_url)
+        now = int(time.time())
+        with self.transaction():
+            self.__execute("""INSERT INTO primary_texts (item_url, primary_text, codec, timestamp)
+                              VALUES (?, ?, ?, ?)
+                              ON CONFLICT(item_url) DO UPDATE
+                              SET primary_text=excluded.primary_text, codec=excluded.codec,
+                                  timestamp=excluded.timestamp""",
+                           [(str(item_url),) +
+                            _encode(primary_text, self.compression, self.compression_level) +
+                            (now,)
+                            for item_url, primary_text in primary_texts],
+                           many=True)
+            self.__forget_missing([item_url for item_url, primary_text in primary_texts],
+                                  'primary_text')
+
+    def lookup_item_annotations(self, item_url, annotation_type=None, label=None):
+        """ Retrieve the annotations for the given item from the cache,
+        if they are present and not older than max_age
+
+        A request filtered by type or label is answered from the cached
+        unfiltered annotations if there is no cached result for the
+        filtered request itself.
+
+        :type item_url: String or Item
+        :param item_url: the URL of the item, or an Item object
+        :type annotation_type: String
+        :param annotation_type: return only results with a matching Type field
+        :type label: String
+        :param label: return only results with a matching Label field
+
+        :rtype: Dict
+        :returns: the annotations, or Cache.MISS
+
+
+        """
+        sql = """SELECT annotations, codec FROM annotations
+                 WHERE annotation_type=? AND label=? AND item_url=?
+                 AND (? <= 0 OR timestamp >= ?)"""
+        row = self.__fetchone(sql, self.__annotation_key(item_url, annotation_type, label) +
+                              self.__freshness())
+        if row is not None:
+            return json.loads(_decode(row[0], row[1]))
+        if annotation_type is None and label is None:
+            return MISS
+
+        row = self.__fetchone(sql, self.__annotation_key(item_url) + self.__freshness())
+        if row is None:
+            return MISS
+        return _filter_annotations(json.loads(_decode(row[0], row[1])),
+                                   annotation_type, label)
+
+    def add_item_annotations(self, item_url, annotations, annotation_type=None, label=None):
+        """ Add the annotations for the given item to the cache database,
+        replacing any already present for the same filters
+
+        Adding the unfiltered annotations also drops any cached filtered
+        results for the item, which are then served from the new set.
+
+        :type item_url: String or Item
+        :param item_url: the URL of the item, or an Item object
+        :type annotations: String
+        :param annotations: the annotations, as a JSON string
+        :type annotation_type: String
+        :param annotation_type: the type filter the annotations were requested with
+        :type label: String
+        :param label: the label filter the annotations were requested with
+
+
+        """
+        key = self.__annotation_key(item_url, annotation_type, label)
+        data, codec = _encode(annotations, self.compression, self.compression_level)
+        with self.transaction():
+            if annotation_type is None and label is None:
+                self.__execute("DELETE FROM annotations WHERE item_url=?",
+                               (str(item_url),))
+            self.__forget_missing([item_url], 'annotations')
+            self.__execute("""INSERT INTO annotations
+                              (annotation_type, label, item_url, annotations, codec, timestamp)
+                              VALUES (?, ?, ?, ?, ?, ?)
+                              ON CONFLICT(item_url, annotation_type, label) DO UPDATE
+                              SET annotations=excluded.annotations, codec=excluded.codec,
+                                  timestamp=excluded.timestamp""",
+                           key + (data, codec, int(time.time())))
+
+    @staticmethod
+    def __annotation_key(item_url, annotation_type=None, label=None):
+        """ Return the annotation_type, label and item_url key values
+        for an annotations row """
+        return (annotation_type or '', label or '', str(item_url))
+
+    def add_missing(self, url, kind):
+        """ Record that the server has no data of the given kind for a URL,
+        eg. that an item has no primary text or that a document was not
+        found. Does nothing if missing_max_age is not set.
+
+        :type url: String
+        :param url: the URL of the item or document
+        :type kind: String
+        :param kind: the kind of data that is missing: 'primary_text',
+            'annotations' or 'document'
+
+
+        """
+        if not self.missing_max_age:
+            return
+        self.__execute("""INSERT INTO missing (url, kind, timestamp) VALUES (?, ?, ?)
+                          ON CONFLICT(url, kind) DO UPDATE SET timestamp=excluded.timestamp""",
+                       (str(url), kind, int(time.time())))
+
+    def is_missing(self, url, kind):
+        """ Check whether the server is known to have no data of the given
+        kind for a URL, from a negative result recorded by add_missing no
+        more than missing_max_age seconds ago
+
+        :type url: String
+        :param url: the URL of the item or document
+        :type kind: String
+        :param kind: the kind of data
+
+        :rtype: Boolean
+        :returns: True if the data is known to be missing
+
+
+        """
+        if not self.missing_max_age:
+            return False
+        return self.__fetchone("SELECT 1 FROM missing WHERE url=? AND kind=? AND timestamp >= ?",
+                               (str(url), kind, int(time.time()) - self.missing_max_age)) is not None
+
+    def __forget_missing(self, urls, kind):
+        """ Drop any negative results for data that is now cached """
+        self.__execute("DELETE FROM missing WHERE url=? AND kind=?",
+                       [(str(url), kind) for url in urls], many=True)
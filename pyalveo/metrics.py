@@ -0,0 +1,271 @@
+import re
+import threading
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+
+# upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# the kinds of API endpoint that requests are counted under, matched
+# against the URL path in order
+ENDPOINT_KINDS = [
+    (re.compile(r'/document/'), 'document'),
+    (re.compile(r'/primary_text'), 'primary_text'),
+    (re.compile(r'/annotations'), 'annotations'),
+    (re.compile(r'^/catalog/search'), 'search'),
+    (re.compile(r'^/catalog/[^/]+/[^/]+/?$'), 'item'),
+    (re.compile(r'^/catalog'), 'collection'),
+    (re.compile(r'^/item_lists'), 'item_list'),
+    (re.compile(r'^/sparql'), 'sparql'),
+    (re.compile(r'^/contrib'), 'contribution'),
+    (re.compile(r'^/speakers'), 'speaker'),
+    (re.compile(r'^/oauth|^/account'), 'account'),
+]
+
+
+def endpoint_kind(url):
+    """ Return the kind of API endpoint a URL refers to, such as 'item'
+    or 'document', or 'other'
+
+    :type url: String
+    :param url: an absolute URL, or a path relative to the API URL
+
+    :rtype: String
+    :returns: the endpoint kind
+    """
+    path = urlparse(url).path
+    for pattern, kind in ENDPOINT_KINDS:
+        if pattern.search(path):
+            return kind
+    return 'other'
+
+
+class Metrics(object):
+    """ Counts the API requests made by a Client, their latency and size,
+    and the Client's cache hits and misses
+
+    Pass a Metrics to Client(metrics=...) to enable it; a Client without
+    one records nothing. One Metrics may be shared by several Clients and
+    threads. Use Client.metrics_snapshot() to read the counts together
+    with those kept by the Client's RetryPolicy, Cache and RateLimiter,
+    and Client.metrics_text() to export them for Prometheus.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """ Create a new Metrics
+
+        :type buckets: tuple
+        :param buckets: the upper bounds in seconds of the request
+            latency histogram buckets
+
+        :rtype: Metrics
+        :returns: the new Metrics
+
+
+        """
+        self.buckets = tuple(sorted(buckets))
+        self.__init_counters()
+
+    def __init_counters(self):
+        self._lock = threading.Lock()
+        # per endpoint kind: request counts by status, bytes and latencies
+        self._requests = {}
+        # per kind of cached data: [hits, misses]
+        self._cache = {}
+
+    def __getstate__(self):
+        """ Pickle the settings, but not the counts """
+        return {'buckets': self.buckets}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__init_counters()
+
+    def __endpoint(self, kind):
+        """ Return the counters for an endpoint kind; call with the lock held """
+        counters = self._requests.get(kind)
+        if counters is None:
+            counters = {'statuses': {}, 'bytes_in': 0, 'bytes_out': 0,
+                        'seconds': 0.0, 'buckets': [0] * (len(self.buckets) + 1)}
+            self._requests[kind] = counters
+        return counters
+
+    def record_request(self, url, status, seconds, bytes_in=0, bytes_out=0):
+        """ Record a request sent to the server
+
+        :type url: String
+        :param url: the URL requested
+        :type status: int
+        :param status: the response status, or None if no response was
+            received
+        :type seconds: float
+        :param seconds: the time taken to receive the response
+        :type bytes_in: int
+        :param bytes_in: the size of the response body, if read
+        :type bytes_out: int
+        :param bytes_out: the size of the request body
+
+
+        """
+        kind = endpoint_kind(url)
+        index = 0
+        while index < len(self.buckets) and seconds > self.buckets[index]:
+            index += 1
+        with self._lock:
+            counters = self.__endpoint(kind)
+            counters['statuses'][status] = counters['statuses'].get(status, 0) + 1
+            counters['bytes_in'] += bytes_in
+            counters['bytes_out'] += bytes_out
+            counters['seconds'] += seconds
+            counters['buckets'][index] += 1
+
+    def record_bytes_in(self, url, bytes_in):
+        """ Record response body bytes read after the request was
+        recorded, such as a streamed document download
+
+        :type url: String
+        :param url: the URL requested
+        :type bytes_in: int
+        :param bytes_in: the number of bytes read
+
+
+        """
+        kind = endpoint_kind(url)
+        with self._lock:
+            self.__endpoint(kind)['bytes_in'] += bytes_in
+
+    def record_cache(self, kind, hit):
+        """ Record a Client cache lookup
+
+        :type kind: String
+        :param kind: the kind of data looked up, eg. 'item' or 'document'
+        :type hit: Boolean
+        :param hit: True if the data was found in the cache
+
+
+        """
+        with self._lock:
+            counts = self._cache.setdefault(kind, [0, 0])
+            counts[0 if hit else 1] += 1
+
+    def snapshot(self):
+        """ Return the counts recorded so far
+
+        :rtype: Dict
+        :returns: a dict with keys 'requests', mapping each endpoint kind
+            to its counts by status, bytes in and out, total seconds and
+            latency histogram (a list of (upper bound, cumulative count)
+            pairs ending with None for +Inf), and 'cache', mapping each
+            kind of data to its hits and misses
+
+
+        """
+        with self._lock:
+            requests = {}
+            for kind, counters in self._requests.items():
+                cumulative = 0
+                histogram = []
+                for bound, count in zip(self.buckets + (None,), counters['buckets']):
+                    cumulative += count
+                    histogram.append((bound, cumulative))
+                requests[kind] = {'count': cumulative,
+                                  'statuses': dict(counters['statuses']),
+                                  'bytes_in': counters['bytes_in'],
+                                  'bytes_out': counters['bytes_out'],
+                                  'seconds': counters['seconds'],
+                                  'latency': histogram}
+            cache = dict((kind, {'hits': hits, 'misses': misses})
+                         for kind, (hits, misses) in self._cache.items())
+        return {'requests': requests, 'cache': cache}
+
+
+def _labels(**labels):
+    """ Format Prometheus labels, in name order """
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for name, value in sorted(labels.items()))
+
+
+def _number(value):
+    """ Format a sample value, using the integer form where possible """
+    if value is None:
+        return '+Inf'
+    if float(value) == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+def to_prometheus(snapshot, prefix='pyalveo'):
+    """ Format a metrics snapshot from Client.metrics_snapshot() in the
+    Prometheus text exposition format
+
+    :type snapshot: Dict
+    :param snapshot: the snapshot
+    :type prefix: String
+    :param prefix: the prefix of the metric names
+
+    :rtype: String
+    :returns: the metrics as text
+
+
+    """
+    lines = []
+
+    def metric(name, kind, description, samples):
+        lines.append('# HELP %s_%s %s' % (prefix, name, description))
+        lines.append('# TYPE %s_%s %s' % (prefix, name, kind))
+        for suffix, labels, value in samples:
+            lines.append('%s_%s%s%s %s' % (prefix, name, suffix,
+                                           _labels(**labels) if labels else '',
+                                           _number(value)))
+
+    requests = sorted(snapshot.get('requests', {}).items())
+    metric('requests_total', 'counter', 'API requests sent, by endpoint kind and status',
+           [('', {'kind': kind, 'status': 'error' if status is None else status}, count)
+            for kind, counters in requests
+            for status, count in sorted(counters['statuses'].items(),
+                                        key=lambda entry: str(entry[0]))])
+    samples = []
+    for kind, counters in requests:
+        for bound, count in counters['latency']:
+            samples.append(('_bucket', {'kind': kind, 'le': _number(bound)}, count))
+        samples.append(('_sum', {'kind': kind}, counters['seconds']))
+        samples.append(('_count', {'kind': kind}, counters['count']))
+    metric('request_duration_seconds', 'histogram',
+           'Time taken to receive API responses', samples)
+    metric('request_bytes_total', 'counter', 'Bytes sent and received in API request bodies',
+           [('', {'kind': kind, 'direction': direction}, counters['bytes_' + direction])
+            for kind, counters in requests for direction in ('in', 'out')])
+
+    cache = sorted(snapshot.get('cache', {}).items())
+    metric('cache_hits_total', 'counter', 'Client lookups answered from the cache',
+           [('', {'kind': kind}, counts['hits']) for kind, counts in cache])
+    metric('cache_misses_total', 'counter', 'Client lookups not answered from the cache',
+           [('', {'kind': kind}, counts['misses']) for kind, counts in cache])
+    if 'evictions' in snapshot:
+        metric('cache_evictions_total', 'counter', 'Documents removed from the cache',
+               [('', None, snapshot['evictions'])])
+    if 'memory' in snapshot:
+        memory = snapshot['memory']
+        metric('memory_cache_hits_total', 'counter', 'Lookups answered by the in-memory cache',
+               [('', None, memory['hits'])])
+        metric('memory_cache_misses_total', 'counter', 'Lookups not answered by the in-memory cache',
+               [('', None, memory['misses'])])
+
+    if 'retries' in snapshot:
+        retries = snapshot['retries']
+        metric('retries_total', 'counter', 'API requests retried, by the status that failed',
+               [('', {'status': 'error' if status is None else status}, count)
+                for status, count in sorted(retries['retries_by_status'].items(),
+                                            key=lambda entry: str(entry[0]))])
+        metric('retries_exhausted_total', 'counter', 'API requests that failed after retrying',
+               [('', None, retries['exhausted'])])
+
+    if 'rate_limit' in snapshot:
+        metric('rate_limit_wait_seconds_total', 'counter', 'Time spent waiting for the rate limiter',
+               [('', None, snapshot['rate_limit']['waited'])])
+
+    return '\n'.join(lines) + '\n'
@@ -167,7 +167,7 @@ class ItemGroup(object):
         return len(self.item_urls)
 
 
-    def get_all(self, force_download=False):
+    def get_all(self, force_download=False, workers=None):
         """ Retrieve the metadata for all items in this list from the server,
         as Item objects
 
@@ -176,13 +176,40 @@ class ItemGroup(object):
         :type force_download: Boolean
         :param force_download: True to download from the server
             regardless of the cache's contents
+        :type workers: int
+        :param workers: if set, fetch the items concurrently using a pool
+            of this many threads
 
         :raises: APIError if the API request is not successful
+        :raises: BatchError if any item could not be retrieved when
+            workers is set; the exception holds the items that were
+            retrieved and the failures
 
 
         """
-        cl = self.client
-        return [cl.get_item(item, force_download) for item in self.item_urls]
+        return self.client.get_item_batch(self.item_urls, force_download, workers)
+
+
+    def map(self, fn, workers=None, force_download=False):
+        """ Call a function on each item in this group using a pool of
+        worker processes, each with a copy of the Client
+
+        :type fn: function
+        :param fn: a picklable function, called with each Item
+        :type workers: int
+        :param workers: the number of processes, None for one per CPU
+        :type force_download: Boolean
+        :param force_download: True to download the items from the server
+            regardless of the cache's contents
+
+        :rtype: List
+        :returns: a List of the results of fn for each item, in order
+
+        :raises: BatchError if fn could not be applied to every item
+
+
+        """
+        return self.client.map_items(fn, self.item_urls, workers, force_download)
 
 
     def item_url(self, item_index):
@@ -492,16 +519,19 @@ class Item(object):
 
 
         """
-        return self.client.get_primary_text(self.url(), force_download)
+        return self.client.get_primary_text(self, force_download)
 
 
-    def get_annotations(self, atype=None, label=None):
+    def get_annotations(self, atype=None, label=None, force_download=False):
         """ Retrieve the annotations for this item from the server
 
         :type atype: String
         :param atype: return only results with a matching Type field
         :type label: String
         :param label: return only results with a matching Label field
+        :type force_download: Boolean
+        :param force_download: True to download from the server
+            regardless of the cache's contents
 
         :rtype: String
         :returns: the annotations as a JSON string
@@ -510,7 +540,7 @@ class Item(object):
 
 
         """
-        return self.client.get_item_annotations(self.url(), atype, label)
+        return self.client.get_item_annotations(self, atype, label, force_download)
 
 
     def get_annotation_types(self):
@@ -716,6 +746,43 @@ class Document(object):
         return self.client.get_document(self.url(), force_download)
 
 
+    def get_content_buffer(self, force_download=False):
+        """ Retrieve the content for this Document as a read-only buffer,
+        memory-mapped from the cache where possible, so that slices of a
+        large document can be used without reading all of it
+
+        :type force_download: Boolean
+        :param force_download: True to download from the server
+            regardless of the cache's contents
+
+        :rtype: memoryview
+        :returns: the content data
+
+        :raises: APIError if the API request is not successful
+
+
+        """
+        return self.client.get_document_buffer(self.url(), force_download)
+
+
+    def open_content(self, force_download=False):
+        """ Open the content for this Document as a seekable binary file,
+        read from the cache where possible
+
+        :type force_download: Boolean
+        :param force_download: True to download from the server
+            regardless of the cache's contents
+
+        :rtype: file
+        :returns: the open file, which the caller should close
+
+        :raises: APIError if the API request is not successful
+
+
+        """
+        return self.client.open_document(self.url(), force_download)
+
+
     def get_filename(self):
         """ Get the original filename for this document
 
@@ -750,7 +817,4 @@ class Document(object):
         if filename is None:
             filename = self.get_filename()
         path = os.path.join(dir_path, filename)
-        data = self.client.get_document(self.url(), force_download)
-        with open(path, 'wb') as f:
-            f.write(data)
-        return path
+        return self.client.download_document(self.url(), path, force_download)
@@ -1,4 +1,7 @@
+import io
 import os
+import shutil
+import sys
 from oauthlib.oauth2.rfc6749.errors import TokenExpiredError
 
 try:
@@ -6,12 +9,20 @@ try:
 except ImportError:
     from urllib import urlencode, unquote
 
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
 import requests
+from requests.adapters import HTTPAdapter
 from requests_toolbelt.multipart import encoder
 from requests_oauthlib import OAuth2Session
 import json
+import pickle
 
-from .cache import Cache
+from .cache import Cache, MemoryCache, MISS, _map_file
+from .retry import RetryPolicy
+from .metrics import to_prometheus
 from .objects import ItemGroup, ItemList, Item, Document
 
 
@@ -33,6 +44,62 @@ class APIError(Exception):
         return ret + self.msg
 
 
+class BatchError(APIError):
+    """ Raised when some of the requests in a batch operation fail.
+
+    The whole batch is attempted before this is raised: results holds the
+    result for each request in the original order (None where it failed)
+    and errors is a list of (url, exception) pairs for the failures.
+    """
+    def __init__(self, results, errors):
+        self.results = results
+        self.errors = errors
+        msg = "%d of %d requests failed" % (len(errors), len(results))
+        for url, error in errors:
+            msg += "\n%s: %s" % (url, error)
+        APIError.__init__(self, msg=msg)
+
+
+class _SingleFlight(object):
+    """ Coalesces concurrent calls that have the same key, so that the
+    first caller does the work and the others wait for its result """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args):
+        """ Call fn(*args), unless a call with the same key is already in
+        progress in another thread, in which case wait for that one
+
+        :rtype: Tuple
+        :returns: the result, and True if this caller made the call or
+            False if it shared the result of another caller
+
+        :raises: whatever exception the call raised
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Future()
+
+        if not leader:
+            return call.result(), False
+
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+        finally:
+            with self._lock:
+                del self._calls[key]
+        return result, True
+
+
 CONFIG_DEFAULT = {'max_age': 0,
                   'use_cache': "true",
                   'update_cache': "true",
@@ -40,6 +107,15 @@ CONFIG_DEFAULT = {'max_age': 0,
                   'alveo_config': '~/alveo.config',
               }
 
+# size of the blocks in which document content is written to disk
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# number of threads refreshing stale cache entries in the background
+REFRESH_WORKERS = 2
+
+# item metadata keys whose URLs are remembered by Client._item_link
+ITEM_LINKS = ('alveo:primary_text_url', 'alveo:annotations_url')
+
 CONTEXT ={'ausnc': 'http://ns.ausnc.org.au/schemas/ausnc_md_model/',
           'corpus': 'http://ns.ausnc.org.au/corpora/',
           'dcterms': 'http://purl.org/dc/terms/',
@@ -53,14 +129,140 @@ CONTEXT ={'ausnc': 'http://ns.ausnc.org.au/schemas/ausnc_md_model/',
           'xsd': "http://www.w3.org/2001/XMLSchema#",
           }
 
+def _annotation_query_url(annotation_url, annotation_type=None, label=None):
+    """ Add the type and label filters, if any, to an annotation URL """
+    req_url = annotation_url
+    if annotation_type is not None:
+        req_url += '?'
+        req_url += urlencode((('type', annotation_type),))
+    if label is not None:
+        if annotation_type is None:
+            req_url += '?'
+        else:
+            req_url += '&'
+        req_url += urlencode((('label',label),))
+    return req_url
+
+
+# the Client used by Client.map_items tasks in a worker process
+_worker_client = None
+
+
+def _init_worker(client_pickle):
+    """ Set up a map_items worker process with a copy of the Client
+
+    The Client is passed pickled, so that it is unpickled with fresh
+    runtime state even when the worker is forked: a forked copy would
+    share the parent's locks and in-flight requests, which no thread in
+    the worker could ever complete.
+    """
+    global _worker_client
+    _worker_client = pickle.loads(client_pickle)
+
+
+def _map_item(fn, item_url, force_download, client_pickle=None):
+    """ Run a map_items task in a worker process. Before Python 3.7,
+    which added the initializer of ProcessPoolExecutor, each task
+    carries the pickled Client and the worker unpickles the first. """
+    if client_pickle is not None and _worker_client is None:
+        _init_worker(client_pickle)
+    return fn(_worker_client.get_item(item_url, force_download))
+
+
+def _parse_json(content):
+    """ Parse a JSON response body, which may be bytes """
+    if isinstance(content, bytes):
+        content = content.decode('utf-8')
+    return json.loads(content)
+
+
+def _conditional_headers(validators):
+    """ Return the headers for a conditional request given the
+    (etag, last_modified) of a cached copy, if there is one """
+    headers = {}
+    if validators is not None:
+        etag, last_modified = validators
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+    return headers
+
+
+def _if_range_path(file_path):
+    """ Return the path of the file holding the If-Range validator for
+    a partial download """
+    return file_path + '.validator'
+
+
+def _read_if_range(file_path):
+    """ Return the If-Range validator saved for a partial download, or None """
+    try:
+        with open(_if_range_path(file_path)) as f:
+            return f.read().strip() or None
+    except IOError:
+        return None
+
+
+def _write_if_range(file_path, validators):
+    """ Save the validator to send as If-Range when resuming a download
+    into file_path, given the (etag, last_modified) of the response. A
+    weak ETag can't be used for If-Range. With validators None, or if
+    there is no usable validator, any saved one is removed. """
+    if_range = None
+    if validators is not None:
+        etag, last_modified = validators
+        if etag and not etag.startswith('W/'):
+            if_range = etag
+        else:
+            if_range = last_modified
+    path = _if_range_path(file_path)
+    if if_range:
+        with open(path, 'w') as f:
+            f.write(if_range)
+    elif os.path.exists(path):
+        os.unlink(path)
+
+
+def _discard_partial(file_path):
+    """ Remove a partial download and its saved validator """
+    for path in (file_path, _if_range_path(file_path)):
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+def _parse_content_range(content_range):
+    """ Parse a Content-Range header of the form 'bytes start-end/length'
+
+    :rtype: Tuple
+    :returns: the start offset and the complete length (None if unknown)
+
+    :raises: APIError if the header is missing or malformed
+    """
+    try:
+        unit, spec = content_range.split(' ', 1)
+        byte_range, length = spec.split('/')
+        start = int(byte_range.split('-')[0])
+        if length == '*':
+            return start, None
+        return start, int(length)
+    except (AttributeError, ValueError):
+        raise APIError(206, '', "Invalid Content-Range header: %s" % (content_range,))
+
+
 class OAuth2(object):
     """ An OAuth2 Manager class for the retrieval and storage of
         all relevant URI's, tokens and client login data.  """
 
-    def __init__(self, api_url, api_key=None, oauth=None, verifySSL=True):
+    def __init__(self, api_url, api_key=None, oauth=None, verifySSL=True,
+                 pool_connections=10, pool_maxsize=10, pool_block=False):
         """ Construct the OAuth requests module along with support for using
             an API Key if Allowed.
 
+        All requests are made through a single pooled HTTP session owned by
+        this object, so connections to the server are kept alive and reused
+        between calls (and shared safely between threads).
+
         :type api_url: String
         :param api_url: the base URL for the API server used
         :type oauth: Dictionary
@@ -72,6 +274,14 @@ class OAuth2(object):
         :type verifySSL: Boolean
         :param verifySSL True to enforce checking of SSL certificates, False
             to disable checking (eg. for staging/testing servers)
+        :type pool_connections: int
+        :param pool_connections: the number of per-host connection pools to keep
+        :type pool_maxsize: int
+        :param pool_maxsize: the maximum number of connections kept alive
+            for each host
+        :type pool_block: Boolean
+        :param pool_block: if True, block when all connections to a host are
+            in use rather than opening a new (unpooled) connection
 
         :rtype: OAuth2
         :returns: the new OAuth2 client that can be used to make API requests
@@ -107,6 +317,14 @@ class OAuth2(object):
         self.auto_refresh = False
         self.state = None
         self.auth_url = None
+
+        # connection pooling settings and the lazily created session
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self._session = None
+        self._session_lock = threading.Lock()
+        self._pid = os.getpid()
         
         #This is here to prevent continuous attempts at getting
         #the api key once it is fully phased out
@@ -133,10 +351,10 @@ class OAuth2(object):
         """
         if not isinstance(other, OAuth2):
             return False
-        d1 = dict(self.__dict__)
+        d1 = self._public_dict()
         d1.pop('state',None)
         d1.pop('auth_url',None)
-        d2 = dict(other.__dict__)
+        d2 = other._public_dict()
         d2.pop('state',None)
         d2.pop('auth_url',None)
         return (d1 == d2)
@@ -154,6 +372,27 @@ class OAuth2(object):
         """
         return not self.__eq__(other)
 
+    def _public_dict(self):
+        """ Return a copy of __dict__ without the private runtime
+        resources (session, locks) held by this object """
+        return dict((k, v) for k, v in self.__dict__.items()
+                    if not k.startswith('_'))
+
+    def __getstate__(self):
+        """ Pickle the settings and token given by to_dict, but not the
+        session """
+        state = self.to_dict()
+        state['auto_refresh'] = self.auto_refresh
+        state['API_KEY_DEFAULT'] = self.API_KEY_DEFAULT
+        return state
+
+    def __setstate__(self, state):
+        """ Restore a pickled OAuth2 as from_json does; the session is
+        created on first use """
+        self.__dict__.update(OAuth2.from_json(state).__dict__)
+        self.auto_refresh = state['auto_refresh']
+        self.API_KEY_DEFAULT = state['API_KEY_DEFAULT']
+
     def to_dict(self):
         """
             Returns a dict of all of it's necessary components.
@@ -169,6 +408,9 @@ class OAuth2(object):
         data['token'] = self.token
         data['state'] = self.state
         data['auth_url'] = self.auth_url
+        data['pool_connections'] = self.pool_connections
+        data['pool_maxsize'] = self.pool_maxsize
+        data['pool_block'] = self.pool_block
         return data
 
     def to_json(self):
@@ -192,7 +434,11 @@ class OAuth2(object):
                       'client_secret':data.get('client_secret',None),
                       'redirect_url':data.get('redirect_url',None),
                       }
-        oauth = OAuth2(api_url=data.get('api_url',None), api_key=data.get('api_key',None),oauth=oauth_dict, verifySSL=data.get('verifySSL',True))
+        # pool settings missing from older json take the constructor's defaults
+        pool = dict((k, data[k]) for k in ('pool_connections', 'pool_maxsize', 'pool_block')
+                    if k in data)
+        oauth = OAuth2(api_url=data.get('api_url',None), api_key=data.get('api_key',None),oauth=oauth_dict, verifySSL=data.get('verifySSL',True),
+                       **pool)
         oauth.token = data.get('token',None)
         oauth.state = data.get('state',None)
         oauth.auth_url = data.get('auth_url',None)
@@ -314,6 +560,77 @@ class OAuth2(object):
             # print("Failed to get API KEY!!")
             return False
 
+    def _mount_adapters(self, session):
+        """ Install pooled HTTP adapters on the given session """
+        for prefix in ('https://', 'http://'):
+            adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                                  pool_maxsize=self.pool_maxsize,
+                                  pool_block=self.pool_block)
+            session.mount(prefix, adapter)
+        return session
+
+    def ensure_pool_size(self, size):
+        """ Grow the connection pool, if needed, so that at least size
+        connections to each host are kept alive, eg. for that many
+        threads making requests at once
+
+        :type size: int
+        :param size: the number of connections needed
+
+
+        """
+        with self._session_lock:
+            if size <= self.pool_maxsize:
+                return
+            self.pool_maxsize = size
+            if self._session is not None and self._pid == os.getpid():
+                # the old adapters' connections are dropped as they are returned
+                self._mount_adapters(self._session)
+
+    def session(self):
+        """ Return the long-lived pooled session used to make requests,
+        creating it if necessary.
+
+        A plain requests Session is used with an API key, otherwise an
+        OAuth2Session holding the current token. The session is replaced
+        if the authentication method or token changes.
+
+        :rtype: requests.Session
+        :returns: the shared session
+
+        :raises: APIError if there is no API key and no OAuth token
+        """
+        if self._pid != os.getpid():
+            # in a child process: leave the parent's connections alone
+            self._session = None
+            self._session_lock = threading.Lock()
+            self._pid = os.getpid()
+
+        with self._session_lock:
+            session = self._session
+            if self.api_key:
+                if session is None or isinstance(session, OAuth2Session):
+                    session = requests.Session()
+            elif self.token:
+                if (not isinstance(session, OAuth2Session) or
+                        session.token != self.token):
+                    session = OAuth2Session(self.client_id, token=self.token)
+            else:
+                raise APIError("No API key and no OAuth session available")
+
+            if session is not self._session:
+                if self._session is not None:
+                    self._session.close()
+                self._session = self._mount_adapters(session)
+            return session
+
+    def close(self):
+        """ Close the pooled session and any connections it holds """
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
     def request(self):
         """ Returns an OAuth2 Session to be used to make requests.
         Returns None if a token hasn't yet been received."""
@@ -323,17 +640,11 @@ class OAuth2(object):
         # Use API Key if possible
         if self.api_key:
             headers['X-API-KEY'] = self.api_key
-            return requests,headers
-        else:
-            # Try to use OAuth
-            if self.token:
-                return OAuth2Session(self.client_id, token=self.token),headers
-            else:
-                raise APIError("No API key and no OAuth session available")
+        return self.session(),headers
 
     def get(self, url, **kwargs):
         request,headers = self.request()
-        headers.update(kwargs.get('headers',{}))
+        headers.update(kwargs.pop('headers',{}))
         if not url.startswith(self.api_url):
             url = self.api_url + url
         return request.get(url, headers=headers, verify=self.verifySSL, **kwargs)
@@ -368,21 +679,21 @@ class OAuth2(object):
             # If there is data but no file then set content type to json
             if kwargs.get('data',None):
                 headers['Content-Type'] = 'application/json'
-            headers.update(kwargs.get('headers',{}))
+            headers.update(kwargs.pop('headers',{}))
             response = request.post(url, headers=headers, verify=self.verifySSL, **kwargs)
         return response
 
     def put(self, url, **kwargs):
         request,headers = self.request()
         headers['Content-Type'] = 'application/json'
-        headers.update(kwargs.get('headers',{}))
+        headers.update(kwargs.pop('headers',{}))
         if not url.startswith(self.api_url):
             url = self.api_url + url
         return request.put(url, headers=headers, verify=self.verifySSL, **kwargs)
 
     def delete(self, url, **kwargs):
         request,headers = self.request()
-        headers.update(kwargs.get('headers',{}))
+        headers.update(kwargs.pop('headers',{}))
         if not url.startswith(self.api_url):
             url = self.api_url + url
         return request.delete(url, headers=headers, verify=self.verifySSL, **kwargs)
@@ -395,7 +706,9 @@ class Client(object):
     def __init__(self, api_key=None, cache=None, api_url=None,
                  use_cache=True, update_cache=True, cache_dir=None,
                  verifySSL=True,
-                 oauth=None, configfile=None):
+                 oauth=None, configfile=None,
+                 pool_connections=10, pool_maxsize=10, pool_block=False,
+                 retry=None, rate_limit=None, metrics=None):
 
         """ Construct a new Client with the specified parameters.
         Unspecified parameters will be derived from the users ~/alveo.config
@@ -422,6 +735,26 @@ class Client(object):
             api_key instead
         :type configfile: String
         :param configfile File name to read configuration from, default ~/alveo.config
+        :type pool_connections: int
+        :param pool_connections: the number of per-host connection pools kept
+            by the underlying HTTP session
+        :type pool_maxsize: int
+        :param pool_maxsize: the maximum number of keep-alive connections to
+            each host, should be at least the number of threads making requests;
+            get_item_batch grows it to its number of workers
+        :type pool_block: Boolean
+        :param pool_block: if True, block when all connections to a host are
+            in use rather than opening a new (unpooled) connection
+        :type retry: RetryPolicy
+        :param retry: the policy for retrying failed requests, None for the
+            default RetryPolicy(); use RetryPolicy(max_attempts=1) to never retry
+        :type rate_limit: RateLimiter
+        :param rate_limit: the RateLimiter pacing the requests sent, which
+            may be shared with other Clients, None to send requests unpaced
+        :type metrics: Metrics
+        :param metrics: the Metrics in which to record requests and cache
+            lookups, which may be shared with other Clients; None to
+            record nothing
 
         :rtype: Client
         :returns: the new Client
@@ -470,17 +803,103 @@ class Client(object):
         self.oauth = OAuth2(api_url=self.api_url,
                             oauth=oauth,
                             api_key=self.api_key,
-                            verifySSL=verifySSL)
+                            verifySSL=verifySSL,
+                            pool_connections=pool_connections,
+                            pool_maxsize=pool_maxsize,
+                            pool_block=pool_block)
+
+        self._retry = retry if retry is not None else RetryPolicy()
+        self._rate_limit = rate_limit
+        self._metrics = metrics
+        self.__init_runtime()
+
+    @property
+    def retry_policy(self):
+        """ The RetryPolicy used for requests, whose counts can be
+        read for monitoring """
+        return self._retry
+
+    @property
+    def rate_limiter(self):
+        """ The RateLimiter pacing requests, or None """
+        return self._rate_limit
+
+    def __init_runtime(self):
+        """ Create the private runtime state of the Client """
+        # primary text and annotation URLs of recently seen items, so that
+        # fetching them doesn't need the item metadata again
+        self._links = MemoryCache(max_entries=10000)
+        # requests in progress, shared by threads asking for the same URL
+        self._inflight = _SingleFlight()
+        # background refreshes of stale cache entries, started when needed
+        self._refresher = None
+        self._refreshing = set()
+        self._refresh_lock = threading.Lock()
+
+    def __getstate__(self):
+        """ Pickle the settings of this Client, its OAuth2 and Cache, as
+        given by to_dict, so that it can be sent to worker processes
+        without re-reading the configuration file. The RateLimiter and
+        Metrics, which aren't part of the json, are pickled as they are.
+        Connections are reopened when first used. """
+        state = self.to_dict()
+        state['context'] = self.context
+        state['_rate_limit'] = self._rate_limit
+        state['_metrics'] = self._metrics
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        self.oauth = OAuth2.from_json(state.pop('oauth'))
+        cache = state.pop('cache')
+        self.cache = None if cache is None else Cache.from_json(cache)
+        self._retry = RetryPolicy.from_json(state.pop('retry'))
+        self.__dict__.update(state)
+        self.__init_runtime()
+
+    def close(self):
+        """ Close the HTTP connections and cache database connections
+        held by this Client. It can still be used afterwards, new
+        connections are opened when needed. Background refreshes of
+        stale cache entries are finished first. """
+        with self._refresh_lock:
+            refresher, self._refresher = self._refresher, None
+        if refresher is not None:
+            refresher.shutdown(wait=True)
+        self.oauth.close()
+        if self.cache is not None:
+            self.cache.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _public_dict(self):
+        """ Return a copy of __dict__ without the private runtime
+        state held by this object """
+        return dict((k, v) for k, v in self.__dict__.items()
+                    if not k.startswith('_'))
 
-    def to_json(self):
+    def to_dict(self):
         """
-            Returns a json string containing all relevant data to recreate this pyalveo.Client.
+            Returns a dict of all of it's necessary components, including
+            those of its OAuth2, Cache and RetryPolicy.
+            Not the same as the __dict__ method
         """
-        data = dict(self.__dict__)
+        data = self._public_dict()
         data.pop('context',None)
         data['oauth'] = self.oauth.to_dict()
-        data['cache'] = self.cache.to_dict()
-        return json.dumps(data)
+        data['cache'] = self.cache.to_dict() if self.cache is not None else None
+        data['retry'] = self._retry.to_dict()
+        return data
+
+    def to_json(self):
+        """
+            Returns a json string containing all relevant data to recreate this pyalveo.Client.
+        """
+        return json.dumps(self.to_dict())
 
     @staticmethod
     def from_json(json_data):
@@ -503,9 +922,11 @@ class Client(object):
                         use_cache=data.get('use_cache',None),
                         cache_dir=data.get('cache_dir',None),
                         update_cache=data.get('update_cache',None),
-                        verifySSL=data.get('oauth',{}).get('verifySSL',None)
+                        verifySSL=data.get('oauth',{}).get('verifySSL',None),
+                        retry=RetryPolicy.from_json(data['retry']) if data.get('retry') else None
                         )
-        client.cache = Cache.from_json(data.get('cache',None))
+        if data.get('cache') is not None:
+            client.cache = Cache.from_json(data['cache'])
         client.oauth = OAuth2.from_json(data.get('oauth',None))
         return client
 
@@ -543,13 +964,13 @@ class Client(object):
         """
         if not isinstance(other, Client):
             return False
-        d1 = dict(self.__dict__)
+        d1 = self._public_dict()
         d1oauth = d1['oauth']
         d1.pop('oauth',None)
         d1cache = d1['cache']
         d1.pop('cache',None)
 
-        d2 = dict(other.__dict__)
+        d2 = other._public_dict()
         d2oauth = d2['oauth']
         d2.pop('oauth',None)
         d2cache = d2['cache']
@@ -593,30 +1014,186 @@ class Client(object):
 
         """
 
-        if method is 'GET':
-            response = self.oauth.get(url)
-        elif method is 'POST':
+        response = self._request(url, data=data, method=method, file=file)
+
+        if raw:
+            return response.content
+        else:
+            return response.json()
+
+    def _request(self, url, data=None, method='GET', file=None, stream=False,
+                 headers=None):
+        """ Send a request to the server and check the response status,
+        retrying failures as allowed by the Client's RetryPolicy
+
+        :type stream: Boolean
+        :param stream: if True, don't read the response body until it is
+            accessed, so that it can be consumed with iter_content. The
+            response then keeps the RateLimiter's concurrency slot until
+            it is passed to _close_response
+        :type headers: Dict
+        :param headers: extra headers to send with a GET request
+
+        :returns: the requests Response object
+
+        :raises: APIError if the API request is not successful
+        :raises: requests.ConnectionError or requests.Timeout if the
+            server can't be reached
+
+        """
+        started = time.time()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response = self.__send(url, data, method, file, stream, headers)
+            except (requests.ConnectionError, requests.Timeout):
+                delay = self._retry.next_delay(method, attempt, started)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+
+            if response.status_code < 400:
+                return response
+
+            delay = self._retry.next_delay(method, attempt, started, response.status_code,
+                                           response.headers.get('Retry-After'))
+            if delay is None:
+                try:
+                    message = response.text
+                finally:
+                    self._close_response(response)
+                raise APIError(response.status_code,
+                               '',
+                               "Error accessing API (url: %s, method: %s)\nData: %s\nMessage: %s" % (url, method, data, message))
+            self._close_response(response)
+            time.sleep(delay)
+
+    def _close_response(self, response):
+        """ Close a response returned by _request, releasing the
+        RateLimiter's concurrency slot if a streamed response holds it """
+        try:
+            response.close()
+        finally:
+            token = response.__dict__.pop('_rate_limit_token', None)
+            if token is not None:
+                self._rate_limit.release(token[0])
+
+    def __send(self, url, data, method, file, stream, headers):
+        """ Send a single request for _request, waiting for the
+        RateLimiter if there is one. A streamed response takes the
+        RateLimiter's token with it, to be released by _close_response
+        once the body has been read """
+        if self._rate_limit is None:
+            return self.__record_dispatch(url, data, method, file, stream, headers)
+
+        token = self._rate_limit.acquire()
+        response = None
+        try:
+            response = self.__record_dispatch(url, data, method, file, stream, headers)
+            if stream:
+                # wrapped, as the token of a RateLimiter without a path is None
+                response._rate_limit_token = (token,)
+            return response
+        finally:
+            if response is None or not stream:
+                self._rate_limit.release(token)
+
+    def __record_dispatch(self, url, data, method, file, stream, headers):
+        """ Dispatch a request, recording it in the Client's Metrics if
+        there are any """
+        if self._metrics is None:
+            return self.__dispatch(url, data, method, file, stream, headers)
+
+        started = time.time()
+        response = None
+        try:
+            response = self.__dispatch(url, data, method, file, stream, headers)
+            return response
+        finally:
+            self.__record_request(url, data, file, stream, response,
+                                  time.time() - started)
+
+    def __dispatch(self, url, data, method, file, stream, headers):
+        """ Send a request using the HTTP method given """
+        if method == 'GET':
+            return self.oauth.get(url, stream=stream, headers=headers or {})
+        elif method == 'POST':
             if file is not None:
-                response = self.oauth.post(url, data=data, file=file)
+                return self.oauth.post(url, data=data, file=file)
             else:
-                response = self.oauth.post(url, data=data)
-        elif method is 'PUT':
-            response = self.oauth.put(url, data=data)
-        elif method is 'DELETE':
-            response = self.oauth.delete(url)
+                return self.oauth.post(url, data=data)
+        elif method == 'PUT':
+            return self.oauth.put(url, data=data)
+        elif method == 'DELETE':
+            return self.oauth.delete(url)
         else:
             raise APIError("Unknown request method: %s" % (method,))
 
-        # check for error responses
-        if response.status_code >= 400:
-            raise APIError(response.status_code,
-                           '',
-                           "Error accessing API (url: %s, method: %s)\nData: %s\nMessage: %s" % (url, method, data, response.text))
-
-        if raw:
-            return response.content
+    def __record_request(self, url, data, file, stream, response, seconds):
+        """ Record a request in the Client's Metrics """
+        bytes_out = 0
+        if isinstance(data, (str, bytes)):
+            bytes_out = len(data)
+        if file is not None and os.path.isfile(file):
+            bytes_out += os.path.getsize(file)
+        if response is None:
+            self._metrics.record_request(url, None, seconds, bytes_out=bytes_out)
         else:
-            return response.json()
+            # a streamed body is counted by _download as it is read
+            bytes_in = 0 if stream else len(response.content)
+            self._metrics.record_request(url, response.status_code, seconds,
+                                         bytes_in, bytes_out)
+
+    def _record_cache(self, kind, hit):
+        """ Record a cache lookup in the Client's Metrics, if it has one """
+        if self._metrics is not None:
+            self._metrics.record_cache(kind, hit)
+
+    @property
+    def metrics(self):
+        """ The Metrics recording this Client's requests, or None """
+        return self._metrics
+
+    def metrics_snapshot(self):
+        """ Return the request and cache counts recorded by this Client's
+        Metrics, with the retry counts of its RetryPolicy, the eviction
+        and in-memory cache counts of its Cache and the waiting time of
+        its RateLimiter
+
+        :rtype: Dict
+        :returns: the counts; see Metrics.snapshot() for the layout of
+            the 'requests' and 'cache' entries
+
+        :raises: ValueError if the Client has no Metrics
+
+
+        """
+        if self._metrics is None:
+            raise ValueError("Metrics are not enabled for this Client")
+        snapshot = self._metrics.snapshot()
+        snapshot['retries'] = self._retry.stats()
+        if self.cache is not None:
+            snapshot['evictions'] = self.cache.evictions
+            if self.cache.memory is not None:
+                snapshot['memory'] = self.cache.memory.stats()
+        if self._rate_limit is not None:
+            snapshot['rate_limit'] = self._rate_limit.stats()
+        return snapshot
+
+    def metrics_text(self):
+        """ Return metrics_snapshot() in the Prometheus text exposition
+        format, eg. to serve from a /metrics endpoint
+
+        :rtype: String
+        :returns: the metrics
+
+        :raises: ValueError if the Client has no Metrics
+
+
+        """
+        return to_prometheus(self.metrics_snapshot())
 
     def add_context(self, prefix, url):
         """ Add a new entry to the context that will be used
@@ -707,21 +1284,304 @@ class Client(object):
 
         """
         item_url = str(item_url)
+        metadata, download = self._get_item_metadata(item_url, force_download)
+        if download is not None and self.update_cache:
+            self.cache.add_item(item_url, *download)
+        self._remember_links(item_url, metadata)
 
-        if (self.use_cache and
-                not force_download and
-                self.cache.has_item(item_url)):
-            item_json = self.cache.get_item(item_url)
-        else:
-            item_json = self.api_request(item_url, raw=True)
-            if self.update_cache:
-                self.cache.add_item(item_url, item_json)
+        return Item(metadata, self)
+
+    def _item_link(self, item, key):
+        """ Return a URL linked from an item's metadata, such as
+        its alveo:primary_text_url
+
+        The metadata of an Item object is used directly. For an item URL
+        the links are remembered after its metadata is first fetched, so
+        that later calls don't need to fetch or parse it again.
+
+        :type item: String or Item
+        :param item: URL of the item, or an Item object
+        :type key: String
+        :param key: the metadata key holding the link
+
+        :returns: the link, or None if the item's metadata has no such key
+
+        :raises: APIError if the item metadata has to be fetched and the
+            request is not successful
+        """
+        link = self._known_item_link(item, key)
+        if link is MISS:
+            return self.get_item(str(item)).metadata().get(key)
+        return link
+
+    def _known_item_link(self, item, key):
+        """ Return a URL linked from an item's metadata, as _item_link
+        does, if it is known without fetching the metadata
+
+        :returns: the link, None if the item's metadata has no such
+            key, or MISS if the metadata would have to be fetched
+        """
+        if isinstance(item, Item):
+            return item.metadata().get(key)
+
+        links = self._links.get(str(item))
+        if links is MISS:
+            return MISS
+        return links.get(key)
+
+    def _remember_links(self, item_url, metadata):
+        """ Keep the primary text and annotation URLs from an item's metadata """
+        links = dict((key, metadata[key]) for key in ITEM_LINKS if key in metadata)
+        self._links.put(item_url, links, 1)
+        return links
+
+    def _get_item_metadata(self, item_url, force_download=False, allow_stale=True):
+        """ Get the metadata for an item from the cache or the server,
+        without writing new metadata to the cache
+
+        Metadata that is cached but older than the cache's max_age is
+        revalidated with a conditional request; if the server reports it
+        unchanged, its cache timestamp is refreshed and it is used again.
+        If the cache allows stale entries (and allow_stale is True) a
+        stale entry is returned at once and revalidated in the background.
+
+        :rtype: Tuple
+        :returns: the parsed item metadata, and if it was downloaded from
+            the server by this call a tuple of its JSON string, ETag and
+            Last-Modified header; None if it came from the cache or
+            another thread's request
+        """
+        if self.use_cache and not force_download:
+            metadata = self.cache.lookup_item_metadata(item_url)
+            if metadata is not MISS:
+                self._record_cache('item', True)
+                return metadata, None
+            if allow_stale and self._serve_stale():
+                metadata = self.cache.lookup_item_metadata(item_url, stale=True)
+                if metadata is not MISS:
+                    self._record_cache('item', True)
+                    self._refresh_later(('item', item_url), self.__refresh_item, item_url)
+                    return metadata, None
+            if allow_stale:
+                self._record_cache('item', False)
+            validators = self.cache.item_validators(item_url)
+            if validators is not None:
+                (item_json, validators), leader = self._inflight.do(
+                    ('revalidate', item_url), self._conditional_get, item_url, validators)
+                if item_json is None:
+                    if leader and self.update_cache:
+                        self.cache.refresh_item(item_url, *validators)
+                    try:
+                        return _parse_json(self.cache.get_item(item_url)), None
+                    except ValueError:
+                        # the cached copy has gone since, fetch it again
+                        pass
+                else:
+                    return _parse_json(item_json), (item_json,) + validators if leader else None
+        elif force_download and self.cache is not None:
+            self.cache.invalidate_memory(item_url)
+
+        (item_json, validators), leader = self._inflight.do(
+            ('item', item_url), self._conditional_get, item_url)
+        # only the thread that made the request writes it to the cache
+        return _parse_json(item_json), (item_json,) + validators if leader else None
+
+    def __refresh_item(self, item_url):
+        """ Revalidate or download the metadata of an item whose cached
+        copy is stale """
+        metadata, download = self._get_item_metadata(item_url, allow_stale=False)
+        if download is not None:
+            self.cache.add_item(item_url, *download)
+        self._remember_links(item_url, metadata)
+
+    def _serve_stale(self):
+        """ Return True if stale cache entries may be used while they
+        are refreshed in the background """
+        return bool(self.update_cache and self.cache.max_age and
+                    self.cache.stale_while_revalidate)
+
+    def _refresh_later(self, key, fn, *args):
+        """ Call fn(*args) in a background thread to refresh a stale cache
+        entry, unless a refresh of the same entry is already waiting or
+        in progress. A refresh that fails is dropped, leaving the stale
+        entry to be tried again next time it is used. """
+        with self._refresh_lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+            if self._refresher is None:
+                self._refresher = ThreadPoolExecutor(max_workers=REFRESH_WORKERS)
+            future = self._refresher.submit(fn, *args)
+        future.add_done_callback(lambda future: self.__refreshed(key))
+
+    def __refreshed(self, key):
+        with self._refresh_lock:
+            self._refreshing.discard(key)
+
+    def _conditional_get(self, url, validators=None):
+        """ GET the raw content at a URL, sending the validators of a
+        cached copy if given so that the server can reply that the copy
+        is still current
+
+        :type validators: Tuple
+        :param validators: the (etag, last_modified) of the cached copy
+
+        :rtype: Tuple
+        :returns: the content, or None if the server replied 304 Not
+            Modified; and the (etag, last_modified) sent with the response
+
+        :raises: APIError if the API request is not successful
+        """
+        response = self._request(url, headers=_conditional_headers(validators))
+        validators = (response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        if response.status_code == 304:
+            return None, validators
+        return response.content, validators
+
+    def _shared_get(self, url):
+        """ GET the raw content at a URL. If other threads are already
+        requesting the same URL, wait for and share that response instead
+        of making another request.
+
+        :rtype: Tuple
+        :returns: the content, and True if this thread made the request
+
+        :raises: APIError if the API request is not successful
+        """
+        return self._inflight.do(('GET', url), self.api_request, url, None, 'GET', True)
+
+    def get_item_batch(self, item_urls, force_download=False, workers=None):
+        """ Retrieve the metadata for several items, as Item objects
+
+        With workers set, the items are fetched concurrently by a pool of
+        that many threads sharing this Client's connection pool and cache;
+        the connection pool is grown to keep a connection for each thread.
+        A failure to fetch one item does not stop the others being fetched;
+        once all are done a BatchError is raised reporting every failure.
+        Downloaded metadata is written to the cache in a single transaction.
+
+        :type item_urls: List or ItemGroup
+        :param item_urls: the URLs of the items, or Item objects
+        :type force_download: Boolean
+        :param force_download: True to download from the server
+            regardless of the cache's contents
+        :type workers: int
+        :param workers: the number of threads to use, None or 1 to fetch
+            the items one at a time
+
+        :rtype: List
+        :returns: a List of Item objects in the same order as item_urls
+
+        :raises: APIError if the API request is not successful (serial mode)
+        :raises: BatchError if any request fails (concurrent mode)
+
+
+        """
+        item_urls = [str(url) for url in item_urls]
+        results = [None] * len(item_urls)
+        # downloaded metadata is written to the cache in one transaction
+        downloaded = []
+
+        try:
+            if not workers or workers < 2:
+                for index, url in enumerate(item_urls):
+                    results[index] = self.__get_batch_item(url, force_download, downloaded)
+                return results
+
+            errors = []
+            self.oauth.ensure_pool_size(workers)
+            executor = ThreadPoolExecutor(max_workers=workers)
+            try:
+                futures = dict((executor.submit(self.__get_batch_item, url, force_download, downloaded), index)
+                               for index, url in enumerate(item_urls))
+                for future in as_completed(futures):
+                    index = futures[future]
+                    try:
+                        results[index] = future.result()
+                    except Exception as e:
+                        errors.append((index, e))
+            finally:
+                executor.shutdown(wait=True)
+        finally:
+            if downloaded and self.update_cache:
+                self.cache.add_items_bulk(downloaded)
+
+        if errors:
+            errors.sort(key=lambda error: error[0])
+            raise BatchError(results, [(item_urls[index], e) for index, e in errors])
+        return results
+
+    def map_items(self, fn, item_urls, workers=None, force_download=False):
+        """ Call a function on each of several items in a pool of worker
+        processes, for CPU-bound processing of many items
+
+        This Client is pickled and sent once to each worker process
+        (with every task before Python 3.7), where it fetches the items (from the shared cache where possible)
+        and calls fn(item). fn and its results must be picklable, so fn
+        should be a function defined at module level. As with
+        get_item_batch, every item is attempted before any failures are
+        reported.
+
+        :type fn: function
+        :param fn: the function to call on each Item
+        :type item_urls: List or ItemGroup
+        :param item_urls: the URLs of the items, or Item objects
+        :type workers: int
+        :param workers: the number of processes, None for one per CPU
+        :type force_download: Boolean
+        :param force_download: True to download the items from the server
+            regardless of the cache's contents
+
+        :rtype: List
+        :returns: a List of the results of fn in the same order as item_urls
+
+        :raises: BatchError if fetching an item or calling fn fails
 
-        return Item(json.loads(item_json.decode('utf-8')), self)
+
+        """
+        item_urls = [str(url) for url in item_urls]
+        results = [None] * len(item_urls)
+        errors = []
+
+        client_pickle = pickle.dumps(self)
+        if sys.version_info >= (3, 7):
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                           initargs=(client_pickle,))
+            task_args = ()
+        else:
+            executor = ProcessPoolExecutor(max_workers=workers)
+            task_args = (client_pickle,)
+
+        with executor:
+            futures = dict((executor.submit(_map_item, fn, url, force_download, *task_args), index)
+                           for index, url in enumerate(item_urls))
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    results[index] = future.result()
+                except Exception as e:
+                    errors.append((index, e))
+
+        if errors:
+            errors.sort(key=lambda error: error[0])
+            raise BatchError(results, [(item_urls[index], e) for index, e in errors])
+        return results
+
+    def __get_batch_item(self, item_url, force_download, downloaded):
+        """ Get an Item for get_item_batch, adding (url, metadata) to the
+        downloaded list if it was fetched from the server """
+        metadata, download = self._get_item_metadata(item_url, force_download)
+        if download is not None:
+            downloaded.append((item_url,) + download)
+        return Item(metadata, self)
 
     def get_document(self, doc_url, force_download=False):
         """ Retrieve the data for the given document from the server
 
+        When the cache is being updated the content is streamed into the
+        cache file and read back from there, rather than being held in
+        memory while it is also written out.
+
         :type doc_url: String or Document
         :param doc_url: the URL of the document, or a Document object
         :type force_download: Boolean
@@ -734,22 +1594,268 @@ class Client(object):
         :raises: APIError if the API request is not successful
 
 
+        """
+        cached_path = self._get_document_path(doc_url, force_download)
+        if cached_path is None:
+            return self._shared_get(str(doc_url))[0]
+
+        with open(cached_path, 'rb') as f:
+            return f.read()
+
+    def get_document_buffer(self, doc_url, force_download=False):
+        """ Retrieve the content of the given document as a read-only
+        buffer, so that parts of a large document can be used without
+        copying all of it
+
+        When the document is in the cache (or is downloaded into it) the
+        buffer is a memory-mapped view of the cache file. Otherwise the
+        content is downloaded into memory.
+
+        :type doc_url: String or Document
+        :param doc_url: the URL of the document, or a Document object
+        :type force_download: Boolean
+        :param force_download: True to download from the server
+            regardless of the cache's contents
+
+        :rtype: memoryview
+        :returns: the document data
+
+        :raises: APIError if the API request is not successful
+
+
+        """
+        cached_path = self._get_document_path(doc_url, force_download)
+        if cached_path is None:
+            return memoryview(self._shared_get(str(doc_url))[0])
+        return _map_file(cached_path)
+
+    def open_document(self, doc_url, force_download=False):
+        """ Open the content of the given document as a seekable,
+        read-only binary file object
+
+        When the document is in the cache (or is downloaded into it) the
+        cache file itself is opened. Otherwise the content is downloaded
+        into memory.
+
+        :type doc_url: String or Document
+        :param doc_url: the URL of the document, or a Document object
+        :type force_download: Boolean
+        :param force_download: True to download from the server
+            regardless of the cache's contents
+
+        :rtype: file
+        :returns: the open file, which the caller should close
+
+        :raises: APIError if the API request is not successful
+
+
+        """
+        cached_path = self._get_document_path(doc_url, force_download)
+        if cached_path is None:
+            return io.BytesIO(self._shared_get(str(doc_url))[0])
+        return open(cached_path, 'rb')
+
+    def _get_document_path(self, doc_url, force_download=False):
+        """ Return the path of the cache file holding the given document,
+        downloading it into the cache if needed, or None if the cache is
+        not being used for documents. If the cache allows stale entries,
+        a stale copy is returned and refreshed in the background.
+
+        :raises: APIError if the document is known not to exist or the
+            download fails
+        """
+        doc_url = str(doc_url)
+        if self.use_cache and not force_download:
+            cached_path = self.cache.lookup_document_path(doc_url)
+            if cached_path is not MISS:
+                self._record_cache('document', True)
+                return cached_path
+            if self.cache.is_missing(doc_url, 'document'):
+                self._record_cache('document', True)
+                raise APIError(404, '', "Document not found (cached result): %s" % doc_url)
+            if self._serve_stale():
+                cached_path = self.cache.lookup_document_path(doc_url, stale=True)
+                if cached_path is not MISS:
+                    self._record_cache('document', True)
+                    self._refresh_later(('document', doc_url), self._download_to_cache, doc_url)
+                    return cached_path
+            self._record_cache('document', False)
+
+        if self.update_cache:
+            return self._download_to_cache(doc_url, force_download)
+        return None
+
+    def download_document(self, doc_url, file_path, force_download=False):
+        """ Download the content of the given document to a file
+
+        The content is written in chunks as it arrives so that large
+        documents never have to fit in memory. It is also stored in the
+        cache if update_cache is set. An interrupted download is resumed
+        from where it stopped the next time this is called.
+
+        :type doc_url: String or Document
+        :param doc_url: the URL of the document, or a Document object
+        :type file_path: String
+        :param file_path: the path to which to write the data
+        :type force_download: Boolean
+        :param force_download: True to download from the server
+            regardless of the cache's contents
+
+        :rtype: String
+        :returns: the path to the downloaded file
+
+        :raises: APIError if the API request is not successful
+
+
         """
         doc_url = str(doc_url)
-        if (self.use_cache and
-                not force_download and
-                self.cache.has_document(doc_url)):
-            doc_data = self.cache.get_document(doc_url)
+        cached_path = self._get_document_path(doc_url, force_download)
+        if cached_path is not None:
+            shutil.copyfile(cached_path, file_path)
         else:
-            doc_data = self.api_request(doc_url, raw=True)
-            if self.update_cache:
-                self.cache.add_document(doc_url, doc_data)
+            part_path = file_path + '.part'
+            self._download(doc_url, part_path, resume=not force_download)
+            shutil.move(part_path, file_path)
 
-        return doc_data
+        return file_path
+
+    def _download(self, url, file_path, resume=False, validators=None):
+        """ Stream the response for the given URL into a file
+
+        If resume is True and file_path holds the start of the content
+        from an interrupted download, only the remainder is requested using
+        an HTTP Range request. The ETag or Last-Modified of the response
+        the partial file came from is kept beside it and sent as If-Range,
+        so that if the document has changed since, the server sends all
+        of it again; a partial file without one is downloaded again. The
+        length of the file is checked against the length reported by the
+        server; if the download is cut short the partial file is left in
+        place so that it can be resumed.
+
+        If the validators of a cached copy are given and no download is
+        being resumed, the request is conditional and nothing is written
+        if the server replies that the cached copy is still current.
+
+        :rtype: Tuple
+        :returns: True if the content was downloaded, False if the server
+            replied 304 Not Modified; and the (etag, last_modified) sent
+            with the response
+
+        :raises: APIError if the request fails or the download is incomplete
+        """
+        offset = 0
+        if_range = None
+        if resume and os.path.isfile(file_path):
+            if_range = _read_if_range(file_path)
+            if if_range is None:
+                # there is no telling whether the partial content is current
+                _discard_partial(file_path)
+            else:
+                offset = os.path.getsize(file_path)
+
+        # ask for the content unencoded so that byte ranges and lengths
+        # refer to the bytes we write to the file
+        headers = {'Accept-Encoding': 'identity'}
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+            headers['If-Range'] = if_range
+        else:
+            headers.update(_conditional_headers(validators))
+
+        try:
+            response = self._request(url, stream=True, headers=headers)
+        except APIError as e:
+            if offset and e.http_status_code == 416:
+                # the partial file doesn't match the document, start again
+                _discard_partial(file_path)
+                return self._download(url, file_path, validators=validators)
+            raise
+
+        validators = (response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        try:
+            if response.status_code == 304:
+                return False, validators
+            elif response.status_code == 206:
+                start, length = _parse_content_range(response.headers.get('Content-Range'))
+                if start != offset:
+                    raise APIError(response.status_code, '',
+                                   "Unexpected Content-Range %s resuming %s" %
+                                   (response.headers.get('Content-Range'), url))
+                mode = 'ab'
+            else:
+                # the server sent the whole document
+                length = response.headers.get('Content-Length')
+                if length is not None:
+                    length = int(length)
+                mode = 'wb'
+                _write_if_range(file_path, validators)
+
+            with open(file_path, mode) as f:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+        finally:
+            self._close_response(response)
+
+        size = os.path.getsize(file_path)
+        if self._metrics is not None:
+            self._metrics.record_bytes_in(url, size - (offset if mode == 'ab' else 0))
+        if length is not None and size != length:
+            raise APIError(msg="Incomplete download of %s: expected %d bytes, received %d" %
+                           (url, length, size))
+        _write_if_range(file_path, None)
+        return True, validators
+
+    def _download_to_cache(self, doc_url, force_download=False):
+        """ Stream a document into the cache and return the path of
+        the cached file
+
+        The content is downloaded to a .part file in the cache directory
+        and only added to the cache once it is complete. A .part file left
+        by an earlier failed attempt is resumed unless force_download is set.
+        A stale cached copy is revalidated with a conditional request and
+        kept if the server reports it unchanged. A document that is not
+        found is recorded in the cache as missing.
+        Threads asking for a document that is already being downloaded
+        wait for that download rather than starting another.
+        """
+        return self._inflight.do(('download', str(doc_url)), self.__download_to_cache,
+                                 doc_url, force_download)[0]
+
+    def __download_to_cache(self, doc_url, force_download):
+        """ Download a document into the cache for _download_to_cache """
+        part_path = self.cache.partial_document_path(doc_url)
+        validators = None
+        if force_download:
+            _discard_partial(part_path)
+        else:
+            validators = self.cache.document_validators(doc_url)
+        try:
+            downloaded, validators = self._download(doc_url, part_path, resume=True,
+                                                    validators=validators)
+        except APIError as e:
+            if e.http_status_code == 404:
+                self.cache.add_missing(doc_url, 'document')
+            raise
+        if not downloaded:
+            self.cache.refresh_document(doc_url, *validators)
+            try:
+                return self.cache.get_document_path(doc_url)
+            except ValueError:
+                # the cached copy has gone since, download it again
+                return self.__download_to_cache(doc_url, True)
+        return self.cache.add_document_file(doc_url, part_path, *validators)
 
     def get_primary_text(self, item_url, force_download=False):
         """ Retrieve the primary text for an item from the server
 
+        Passing an Item object, rather than its URL, saves looking up
+        the item's metadata to find its primary text URL.
+
+        If the Cache was created with stale_while_revalidate, a cached
+        primary text older than max_age (but within that bound) is
+        returned at once and refreshed in a background thread; get_item
+        and get_document do the same.
+
         :type item_url: String or Item
         :param item_url: URL of the item, or an Item object
         :type force_download: Boolean
@@ -763,37 +1869,58 @@ class Client(object):
 
 
         """
-        item_url = str(item_url)
-        metadata = self.get_item(item_url).metadata()
-
-        try:
-            primary_text_url = metadata['alveo:primary_text_url']
-        except KeyError:
-            return None
-
-        if primary_text_url == 'No primary text found':
+        if self.use_cache and not force_download:
+            primary_text = self.cache.lookup_primary_text(str(item_url))
+            if primary_text is not MISS:
+                self._record_cache('primary_text', True)
+                return primary_text
+            # a negative result only saves fetching the item's metadata,
+            # the links in metadata already at hand are more recent
+            if (self._known_item_link(item_url, 'alveo:primary_text_url') is MISS and
+                    self.cache.is_missing(str(item_url), 'primary_text')):
+                self._record_cache('primary_text', True)
+                return None
+            if self._serve_stale():
+                primary_text = self.cache.lookup_primary_text(str(item_url), stale=True)
+                if primary_text is not MISS:
+                    self._record_cache('primary_text', True)
+                    self._refresh_later(('primary_text', str(item_url)),
+                                        self.get_primary_text, item_url, True)
+                    return primary_text
+            self._record_cache('primary_text', False)
+        elif force_download and self.cache is not None:
+            self.cache.invalidate_memory(str(item_url))
+
+        primary_text_url = self._item_link(item_url, 'alveo:primary_text_url')
+        if primary_text_url is None or primary_text_url == 'No primary text found':
+            if self.update_cache:
+                self.cache.add_missing(str(item_url), 'primary_text')
             return None
 
-        if (self.use_cache and
-                not force_download and
-                self.cache.has_primary_text(item_url)):
-            primary_text = self.cache.get_primary_text(item_url)
-        else:
-            primary_text = self.api_request(primary_text_url, raw=True)
-            if self.update_cache:
-                self.cache.add_primary_text(item_url, primary_text)
+        primary_text, leader = self._shared_get(primary_text_url)
+        if self.update_cache and leader:
+            self.cache.add_primary_text(str(item_url), primary_text)
 
         return primary_text
 
-    def get_item_annotations(self, item_url, annotation_type=None, label=None):
+    def get_item_annotations(self, item_url, annotation_type=None, label=None,
+                             force_download=False):
         """ Retrieve the annotations for an item from the server
 
+        A request filtered by type or label can be answered from the
+        cached unfiltered annotations for the item, if present. Passing an
+        Item object, rather than its URL, saves looking up the item's
+        metadata to find its annotations URL.
+
         :type item_url: String or Item
         :param item_url: URL of the item, or an Item object
         :type annotation_type: String
         :param annotation_type: return only results with a matching Type field
         :type label: String
         :param label: return only results with a matching Label field
+        :type force_download: Boolean
+        :param force_download: True to download from the server
+            regardless of the cache's contents
 
         :rtype: String
         :returns: the annotations as a dictionary, if the item has
@@ -808,30 +1935,30 @@ class Client(object):
 
 
         """
-        # get the annotation URL from the item metadata, if not present then there are no annotations
-        item_url = str(item_url)
-        metadata = self.get_item(item_url).metadata()
+        if self.use_cache and not force_download:
+            annotations = self.cache.lookup_item_annotations(str(item_url), annotation_type, label)
+            if annotations is not MISS:
+                self._record_cache('annotations', True)
+                return annotations
+            if (self._known_item_link(item_url, 'alveo:annotations_url') is MISS and
+                    self.cache.is_missing(str(item_url), 'annotations')):
+                self._record_cache('annotations', True)
+                return None
+            self._record_cache('annotations', False)
 
-        try:
-            annotation_url = metadata['alveo:annotations_url']
-        except KeyError:
+        # get the annotation URL from the item metadata, if not present then there are no annotations
+        annotation_url = self._item_link(item_url, 'alveo:annotations_url')
+        if annotation_url is None:
+            if self.update_cache:
+                self.cache.add_missing(str(item_url), 'annotations')
             return None
 
+        req_url = _annotation_query_url(annotation_url, annotation_type, label)
+        ann_json, leader = self._shared_get(req_url)
+        if self.update_cache and leader:
+            self.cache.add_item_annotations(str(item_url), ann_json, annotation_type, label)
 
-        req_url = annotation_url
-        if annotation_type is not None:
-            req_url += '?'
-            req_url += urlencode((('type', annotation_type),))
-        if label is not None:
-            if annotation_type is None:
-                req_url += '?'
-            else:
-                req_url += '&'
-            req_url += urlencode((('label',label),))
-        try:
-            return self.api_request(req_url)
-        except KeyError:
-            return None
+        return json.loads(ann_json.decode('utf-8'))
 
     def get_annotation_types(self, item_url):
         """ Retrieve the annotation types for the given item from the server
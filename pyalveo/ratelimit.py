@@ -0,0 +1,187 @@
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class RateLimiter(object):
+    """ Limits the rate and concurrency of API requests
+
+    Requests are paced with a token bucket: the bucket holds up to burst
+    tokens, is refilled at rate tokens per second and each request takes
+    one, waiting for it if the bucket is empty. Independently, at most
+    max_concurrent requests are sent at once.
+
+    One RateLimiter may be shared by several Clients and threads. To share
+    it between processes as well, give a path: the bucket is then kept in
+    that file and the concurrency slots are locks on files next to it, so
+    every process using the same path counts against the same limits.
+    Without a path, each process unpickling the RateLimiter (eg. the
+    workers of Client.map_items) has limits of its own.
+    """
+
+    def __init__(self, rate=None, burst=None, max_concurrent=None, path=None):
+        """ Create a new RateLimiter
+
+        :type rate: float
+        :param rate: the sustained number of requests per second, None
+            for no limit
+        :type burst: float
+        :param burst: the number of requests that may be sent at once
+            after a quiet period, defaults to one second's worth
+        :type max_concurrent: int
+        :param max_concurrent: the maximum number of requests in progress
+            at once, None for no limit
+        :type path: String
+        :param path: the file used to share the limits between processes,
+            None to share them between threads only
+
+        :rtype: RateLimiter
+        :returns: the new RateLimiter
+
+        :raises: ValueError if a limit is not positive, or if path is given
+            on a platform without fcntl
+
+
+        """
+        if rate is not None and rate <= 0:
+            raise ValueError("rate must be positive")
+        if burst is not None and burst < 1:
+            raise ValueError("burst must be at least 1")
+        if max_concurrent is not None and max_concurrent < 1:
+            raise ValueError("max_concurrent must be at least 1")
+        if path is not None and fcntl is None:
+            raise ValueError("Sharing a RateLimiter between processes needs fcntl")
+
+        self.rate = rate
+        if burst is None and rate is not None:
+            burst = max(1.0, rate)
+        self.burst = burst
+        self.max_concurrent = max_concurrent
+        self.path = path
+        self.__init_state()
+
+    def __init_state(self):
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._updated = time.time()
+        self._slots = None
+        if self.max_concurrent is not None:
+            self._slots = threading.BoundedSemaphore(self.max_concurrent)
+        # number of requests let through and seconds spent waiting
+        self.requests = 0
+        self.waited = 0.0
+
+    def __getstate__(self):
+        """ Pickle the settings, but not the state of the bucket """
+        return dict((k, v) for k, v in self.__dict__.items()
+                    if k in ('rate', 'burst', 'max_concurrent', 'path'))
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__init_state()
+
+    def __take(self, tokens, updated, now):
+        """ Take a token from a bucket holding tokens at time updated
+
+        :rtype: tuple
+        :returns: (tokens left, seconds to wait for the token taken)
+        """
+        tokens = min(self.burst, tokens + max(0.0, now - updated) * self.rate)
+        # a request that can't be let through yet reserves the next token,
+        # leaving the bucket in debt, so that waiting requests go in turn
+        tokens -= 1
+        if tokens >= 0:
+            return tokens, 0.0
+        return tokens, -tokens / self.rate
+
+    def __reserve(self):
+        """ Reserve a token, returning the number of seconds to wait for it """
+        now = time.time()
+        with self._lock:
+            if self.path is None:
+                self._tokens, wait = self.__take(self._tokens, self._updated, now)
+                self._updated = now
+                return wait
+
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                state = os.read(fd, 64).split()
+                try:
+                    tokens, updated = float(state[0]), float(state[1])
+                except (IndexError, ValueError):
+                    tokens, updated = self.burst, now
+                tokens, wait = self.__take(tokens, updated, now)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, ("%r %r" % (tokens, now)).encode('ascii'))
+                return wait
+            finally:
+                os.close(fd)
+
+    def __acquire_file_slot(self):
+        """ Lock one of the max_concurrent slot files, waiting until one
+        is free, and return its file descriptor """
+        delay = 0.001
+        while True:
+            for n in range(self.max_concurrent):
+                fd = os.open("%s.%d" % (self.path, n), os.O_RDWR | os.O_CREAT, 0o666)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return fd
+                except (IOError, OSError):
+                    os.close(fd)
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+    def acquire(self):
+        """ Wait until a request may be sent
+
+        :rtype: object
+        :returns: a token to pass to release() once the request is done
+
+
+        """
+        started = time.time()
+        fd = None
+        if self._slots is not None:
+            self._slots.acquire()
+            if self.path is not None:
+                try:
+                    fd = self.__acquire_file_slot()
+                except BaseException:
+                    self._slots.release()
+                    raise
+        if self.rate is not None:
+            wait = self.__reserve()
+            if wait > 0:
+                time.sleep(wait)
+        with self._lock:
+            self.requests += 1
+            self.waited += time.time() - started
+        return fd
+
+    def release(self, token):
+        """ Record that a request let through by acquire() is done
+
+        :type token: object
+        :param token: the value returned by acquire()
+
+
+        """
+        if token is not None:
+            fcntl.flock(token, fcntl.LOCK_UN)
+            os.close(token)
+        if self._slots is not None:
+            self._slots.release()
+
+    def stats(self):
+        """ Return a dict of the number of requests let through and the
+        total seconds they waited """
+        with self._lock:
+            return {'requests': self.requests, 'waited': self.waited}
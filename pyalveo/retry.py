@@ -0,0 +1,180 @@
+import json
+import random
+import threading
+import time
+from email.utils import parsedate_tz, mktime_tz
+
+
+# methods that can safely be sent again if a request fails
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+# response statuses that are worth retrying
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def parse_retry_after(value, now=None):
+    """ Parse the value of a Retry-After header, which is either a
+    number of seconds or an HTTP date
+
+    :type value: String
+    :param value: the header value
+    :type now: float
+    :param now: the current time, defaults to time.time()
+
+    :rtype: float
+    :returns: the number of seconds to wait, or None if the value
+        can't be parsed
+    """
+    if value is None:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    if now is None:
+        now = time.time()
+    return max(0.0, mktime_tz(date) - now)
+
+
+class RetryPolicy(object):
+    """ Decides whether and when a failed API request is retried
+
+    Requests using idempotent methods are retried after connection errors
+    and on the statuses in RETRY_STATUSES, waiting an exponentially
+    increasing, randomly jittered time between attempts. A Retry-After
+    header sent with a 429 or 503 response is honoured. Requests are
+    given up once max_attempts have been made or when the next attempt
+    would start after the deadline.
+
+    One RetryPolicy may be shared by several Clients and threads; it
+    counts the retries made, for monitoring.
+    """
+
+    def __init__(self, max_attempts=5, backoff=0.5, max_backoff=30,
+                 deadline=300, statuses=RETRY_STATUSES,
+                 methods=IDEMPOTENT_METHODS):
+        """ Create a new RetryPolicy
+
+        :type max_attempts: int
+        :param max_attempts: the maximum number of times to send a
+            request, 1 to never retry
+        :type backoff: float
+        :param backoff: the base delay in seconds; the delay before
+            attempt n + 1 is chosen at random up to backoff * 2 ** (n - 1)
+        :type max_backoff: float
+        :param max_backoff: the maximum delay between attempts, unless the
+            server asks for a longer one with Retry-After
+        :type deadline: float
+        :param deadline: the maximum number of seconds from the first
+            attempt to the start of the last, None for no limit
+        :type statuses: tuple
+        :param statuses: the response statuses to retry
+        :type methods: tuple
+        :param methods: the request methods to retry
+
+        :rtype: RetryPolicy
+        :returns: the new RetryPolicy
+
+
+        """
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.statuses = tuple(statuses)
+        self.methods = tuple(method.upper() for method in methods)
+        self.__init_counters()
+
+    def __init_counters(self):
+        self._lock = threading.Lock()
+        # number of retries made
+        self.retries = 0
+        # retries made for each response status, None for connection errors
+        self.retries_by_status = {}
+        # requests that failed after being retried
+        self.exhausted = 0
+
+    def to_dict(self):
+        """ Return a dict of the settings of this RetryPolicy, from which
+        from_json can recreate it """
+        return {'max_attempts': self.max_attempts, 'backoff': self.backoff,
+                'max_backoff': self.max_backoff, 'deadline': self.deadline,
+                'statuses': list(self.statuses), 'methods': list(self.methods)}
+
+    def to_json(self):
+        """ Return a json string of the settings of this RetryPolicy """
+        return json.dumps(self.to_dict())
+
+    @staticmethod
+    def from_json(json_data):
+        """ Return a RetryPolicy given a json string or dict built by
+        to_json() or to_dict() """
+        if isinstance(json_data, str):
+            json_data = json.loads(json_data)
+        return RetryPolicy(**json_data)
+
+    def __getstate__(self):
+        """ Pickle the settings, but not the counters """
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def next_delay(self, method, attempt, started, status=None, retry_after=None):
+        """ Decide whether to retry a failed request, and count the retry
+        if so
+
+        :type method: String
+        :param method: the request method
+        :type attempt: int
+        :param attempt: the number of attempts made so far, starting at 1
+        :type started: float
+        :param started: the time.time() of the first attempt
+        :type status: int
+        :param status: the response status, or None for a connection error
+        :type retry_after: String
+        :param retry_after: the response's Retry-After header, if any
+
+        :rtype: float
+        :returns: the number of seconds to wait before the next attempt,
+            or None if the request should not be retried
+
+
+        """
+        if method.upper() not in self.methods:
+            return None
+        if status is not None and status not in self.statuses:
+            return None
+
+        if attempt >= self.max_attempts:
+            delay = None
+        else:
+            delay = random.uniform(0, min(self.max_backoff,
+                                          self.backoff * 2 ** (attempt - 1)))
+            if status in (429, 503):
+                wait = parse_retry_after(retry_after)
+                if wait is not None:
+                    delay = wait
+            if (self.deadline is not None and
+                    time.time() + delay - started > self.deadline):
+                delay = None
+
+        with self._lock:
+            if delay is None:
+                if attempt > 1:
+                    self.exhausted += 1
+            else:
+                self.retries += 1
+                self.retries_by_status[status] = self.retries_by_status.get(status, 0) + 1
+        return delay
+
+    def stats(self):
+        """ Return a dict of the retry counts """
+        with self._lock:
+            return {'retries': self.retries,
+                    'retries_by_status': dict(self.retries_by_status),
+                    'exhausted': self.exhausted}
@@ -36,12 +36,17 @@ setup(
     packages = ['pyalveo'],
 
     install_requires=[
-        "python-dateutil",
         "requests",
         "oauthlib",
         "requests-oauthlib",
+        'futures; python_version < "3"',
     ],
 
+    extras_require={
+        "async": ["aiohttp"],
+        "zstd": ["zstandard"],
+    },
+
     tests_require=[
         "requests-mock"
     ],
@@ -0,0 +1,141 @@
+import unittest
+import asyncio
+import os
+import shutil
+import tempfile
+
+import pyalveo
+
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
+
+API_KEY = "fakekeyvalue"
+
+
+@unittest.skipIf(web is None or not hasattr(pyalveo, 'AsyncClient'),
+                 "aiohttp or Python 3.7 is not available")
+class AsyncClientTest(unittest.TestCase):
+
+    def run_with_server(self, test):
+        """Run the coroutine function test(client) against a local
+        server that serves the canned responses"""
+
+        with open('tests/responses/1-190.json', 'rb') as fd:
+            item_json = fd.read()
+        with open('tests/responses/1-190-plain.txt', 'rb') as fd:
+            doc_text = fd.read()
+
+        self.requests = []
+
+        async def handler(request):
+            self.requests.append(request.path_qs)
+            if request.headers.get('X-API-KEY') != API_KEY:
+                return web.Response(status=401)
+            if request.path == '/sparql/cooee':
+                return web.json_response({'results': {'bindings': []}})
+            base_url = str(request.url.origin())
+            if request.path == '/catalog/cooee/1-190':
+                return web.Response(body=item_json.replace(b'https://app.alveo.edu.au', base_url.encode()))
+            if request.path == '/catalog/cooee/1-190/document/1-190-plain.txt':
+                return web.Response(body=doc_text)
+            return web.Response(status=404)
+
+        async def main():
+            app = web.Application()
+            app.router.add_route('GET', '/{tail:.*}', handler)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, '127.0.0.1', 0)
+            await site.start()
+            port = runner.addresses[0][1]
+            api_url = "http://127.0.0.1:%d" % port
+            try:
+                async with pyalveo.AsyncClient(api_url=api_url, api_key=API_KEY,
+                                               cache_dir="tmp",
+                                               configfile="missing.config") as client:
+                    await test(client)
+            finally:
+                await runner.cleanup()
+
+        self.addCleanup(shutil.rmtree, "tmp", True)
+        asyncio.run(main())
+
+    def test_get_item_and_document(self):
+        """Items and documents can be fetched and are cached"""
+
+        async def test(client):
+            item_url = client.api_url + '/catalog/cooee/1-190'
+            item = await client.get_item(item_url)
+            self.assertEqual(item.url(), item_url)
+            self.assertTrue(client.cache.has_item(item_url))
+
+            content = await item.get_document(0).get_content()
+            self.assertEqual(content[:20].decode(), "Sydney, New South Wa")
+
+            # cache hits don't touch the server
+            count = len(self.requests)
+            await client.get_item(item_url)
+            await client.get_document(item.get_document(0).url())
+            self.assertEqual(count, len(self.requests))
+
+            result = await client.sparql_query('cooee', 'select * where { ?a ?b ?c }')
+            self.assertIn('results', result)
+
+        self.run_with_server(test)
+
+    def test_download_document(self):
+        """Documents can be downloaded to a file, from the server the
+        first time and from the cache after that"""
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp, True)
+
+        async def test(client):
+            item = await client.get_item(client.api_url + '/catalog/cooee/1-190')
+            document = item.get_document(0)
+            path = await document.download_content(tmp)
+            self.assertEqual(path, os.path.join(tmp, '1-190-plain.txt'))
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read()[:20].decode(), "Sydney, New South Wa")
+            self.assertTrue(client.cache.has_document(document.url()))
+            self.assertEqual([], [name for name in os.listdir(client.cache.file_dir)
+                                  if name.endswith('.part')])
+
+            count = len(self.requests)
+            other_path = os.path.join(tmp, 'copy.txt')
+            await client.download_document(document, other_path)
+            self.assertEqual(count, len(self.requests))
+            with open(other_path, 'rb') as f:
+                self.assertEqual(f.read()[:20].decode(), "Sydney, New South Wa")
+
+            missing_path = os.path.join(tmp, 'missing.txt')
+            with self.assertRaises(pyalveo.APIError):
+                await client.download_document(client.api_url + '/catalog/cooee/missing.txt',
+                                               missing_path)
+            self.assertEqual(sorted(os.listdir(tmp)), ['1-190-plain.txt', 'copy.txt'])
+            self.assertEqual([], [name for name in os.listdir(client.cache.file_dir)
+                                  if name.endswith('.part')])
+
+        self.run_with_server(test)
+
+    def test_errors(self):
+        """Failed requests raise APIError, batches report all failures"""
+
+        async def test(client):
+            with self.assertRaises(pyalveo.APIError) as cm:
+                await client.get_item(client.api_url + '/catalog/cooee/missing')
+            self.assertEqual(cm.exception.http_status_code, 404)
+
+            urls = [client.api_url + '/catalog/cooee/1-190',
+                    client.api_url + '/catalog/cooee/missing']
+            with self.assertRaises(pyalveo.BatchError) as cm:
+                await client.get_item_batch(urls)
+            self.assertEqual(cm.exception.results[0].url(), urls[0])
+            self.assertEqual([url for url, e in cm.exception.errors], [urls[1]])
+
+        self.run_with_server(test)
+
+
+if __name__ == "__main__" :
+    unittest.main(verbosity=5)
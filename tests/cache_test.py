@@ -4,6 +4,11 @@ import os
 import json
 import sqlite3
 import shutil
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from pyalveo.cache import fcntl
 
 class CacheTest(unittest.TestCase):
 
@@ -26,12 +31,170 @@ class CacheTest(unittest.TestCase):
         cursor.execute(sql)
         result = cursor.fetchall()
 
-        self.assertEqual(3, len(result), "there should be 4 tables in the database")
+        self.assertEqual(7, len(result), "there should be 7 tables in the database")
         self.assertEqual(result[0][1], 'items', "first table should be items")
         self.assertEqual(result[1][1], 'documents', "second table should be documents")
         self.assertEqual(result[2][1], 'primary_texts', "third table should be primary_texts")
+        self.assertEqual(result[3][1], 'annotations', "fourth table should be annotations")
+        self.assertEqual(result[4][1], 'missing', "fifth table should be missing")
+        self.assertEqual(result[5][1], 'documents_total', "sixth table should be documents_total")
+        self.assertEqual(result[6][1], 'schema_version', "seventh table should be schema_version")
+
+        cursor.execute("SELECT version FROM schema_version")
+        self.assertEqual(cursor.fetchall(), [(pyalveo.cache.SCHEMA_VERSION,)])
+        conn.close()
+
+    def test_migrate_cache(self):
+        """ Test that a cache database from an older version is upgraded """
+
+        file_dir = 'tmp'
+        cache_db_path = os.path.join(file_dir, 'alveo_cache.db')
+        self.addCleanup(shutil.rmtree, file_dir, True)
+        os.makedirs(file_dir)
+
+        # the original unversioned schema, with a duplicated item
+        conn = sqlite3.connect(cache_db_path)
+        conn.execute("CREATE TABLE items (url text, metadata text, datetime text)")
+        conn.execute("CREATE TABLE documents (url text, path text, datetime text)")
+        conn.execute("CREATE TABLE primary_texts (item_url text, primary_text text, datetime text)")
+        conn.execute("INSERT INTO items VALUES ('http://foo.org/1', 'old', '2019-01-01T00:00:00+00:00')")
+        conn.execute("INSERT INTO items VALUES ('http://foo.org/1', 'new', '2019-01-02T00:00:00+00:00')")
+        conn.execute("INSERT INTO primary_texts VALUES ('http://foo.org/1', 'text', '2019-01-02T00:00:00+00:00')")
+        conn.commit()
+        conn.close()
+
+        cache = pyalveo.Cache(file_dir)
+        self.assertEqual('new', cache.get_item('http://foo.org/1'))
+        self.assertEqual('text', cache.get_primary_text('http://foo.org/1'))
+
+        # timestamps are carried over, so the entries are now stale
+        self.assertTrue(cache.has_item('http://foo.org/1'))
+        self.assertFalse(pyalveo.Cache(file_dir, max_age=3600).has_item('http://foo.org/1'))
+
+        cache.add_item('http://foo.org/1', 'newer')
+        self.assertEqual('newer', cache.get_item('http://foo.org/1'))
+        self.assertTrue(pyalveo.Cache(file_dir, max_age=3600).has_item('http://foo.org/1'))
+
+        conn = sqlite3.connect(cache_db_path)
+        self.assertEqual(conn.execute("SELECT count(*) FROM items").fetchone()[0], 1)
+        self.assertEqual(conn.execute("SELECT version FROM schema_version").fetchone()[0],
+                         pyalveo.cache.SCHEMA_VERSION)
         conn.close()
 
+    def test_migrate_flat_documents(self):
+        """ Documents in the old flat layout are moved into the sharded store """
+
+        file_dir = 'tmp'
+        cache_db_path = os.path.join(file_dir, 'alveo_cache.db')
+        self.addCleanup(shutil.rmtree, file_dir, True)
+        self.addCleanup(shutil.rmtree, 'tmp2', True)
+        os.makedirs(os.path.join(file_dir, 'files'))
+
+        old_paths = [os.path.abspath(os.path.join(file_dir, 'files', name))
+                     for name in ('one', 'two', 'missing')]
+        for path in old_paths[:2]:
+            with open(path, 'wb') as f:
+                f.write(b'content')
+
+        conn = sqlite3.connect(cache_db_path)
+        conn.execute("CREATE TABLE items (url text, metadata text, datetime text)")
+        conn.execute("CREATE TABLE documents (url text, path text, datetime text)")
+        conn.execute("CREATE TABLE primary_texts (item_url text, primary_text text, datetime text)")
+        for n, path in enumerate(old_paths):
+            conn.execute("INSERT INTO documents VALUES (?, ?, '2019-01-01T00:00:00+00:00')",
+                         ('http://foo.org/%d' % n, path))
+        conn.commit()
+        conn.close()
+
+        cache = pyalveo.Cache(file_dir)
+        self.assertEqual(b'content', cache.get_document('http://foo.org/0'))
+        self.assertEqual(cache.get_document_path('http://foo.org/0'),
+                         cache.get_document_path('http://foo.org/1'))
+        self.assertFalse(cache.has_document('http://foo.org/2'))
+        self.assertEqual(['ed'], os.listdir(cache.file_dir))
+        # the shared content is counted once
+        self.assertEqual(len(b'content'), cache.documents_size())
+
+        conn = sqlite3.connect(cache_db_path)
+        for path, in conn.execute("SELECT path FROM documents"):
+            self.assertFalse(os.path.isabs(path))
+        conn.close()
+        del cache
+
+        # paths are relative, so the cache directory can be moved
+        shutil.move(file_dir, 'tmp2')
+        cache = pyalveo.Cache('tmp2')
+        self.assertEqual(b'content', cache.get_document('http://foo.org/1'))
+
+    @unittest.skipIf(fcntl is None, "needs fcntl")
+    def test_migrate_documents_in_batches(self):
+        """ Legacy files are moved in committed batches, without holding
+        the database write lock while they are hashed, and an interrupted
+        migration is resumed by the next Cache """
+
+        file_dir = 'tmp'
+        cache_db_path = os.path.join(file_dir, 'alveo_cache.db')
+        self.addCleanup(shutil.rmtree, file_dir, True)
+        os.makedirs(os.path.join(file_dir, 'files'))
+
+        conn = sqlite3.connect(cache_db_path)
+        conn.execute("CREATE TABLE items (url text, metadata text, datetime text)")
+        conn.execute("CREATE TABLE documents (url text, path text, datetime text)")
+        conn.execute("CREATE TABLE primary_texts (item_url text, primary_text text, datetime text)")
+        for n in range(3):
+            path = os.path.abspath(os.path.join(file_dir, 'files', str(n)))
+            with open(path, 'wb') as f:
+                f.write(b'content %d' % n)
+            conn.execute("INSERT INTO documents VALUES (?, ?, '2019-01-01T00:00:00+00:00')",
+                         ('http://foo.org/%d' % n, path))
+        conn.commit()
+        conn.close()
+
+        file_digest = pyalveo.cache._file_digest
+        calls = []
+
+        def slow_digest(file_path):
+            # other connections can write while files are hashed
+            other = sqlite3.connect(cache_db_path, timeout=0.1)
+            other.execute("BEGIN IMMEDIATE")
+            other.rollback()
+            other.close()
+            calls.append(file_path)
+            if len(calls) == 2:
+                raise IOError("interrupted")
+            return file_digest(file_path)
+
+        self.addCleanup(setattr, pyalveo.cache, '_file_digest', file_digest)
+        self.addCleanup(setattr, pyalveo.cache, 'MIGRATION_BATCH_SIZE',
+                        pyalveo.cache.MIGRATION_BATCH_SIZE)
+        pyalveo.cache._file_digest = slow_digest
+        pyalveo.cache.MIGRATION_BATCH_SIZE = 1
+        with self.assertRaises(IOError):
+            pyalveo.Cache(file_dir)
+
+        # while another process is migrating, the old paths are used
+        fd = os.open(os.path.join(file_dir, 'migrate.lock'), os.O_RDWR)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        cache = pyalveo.Cache(file_dir)
+        self.assertFalse(os.path.isabs(cache.conn.execute(
+            "SELECT path FROM documents WHERE url='http://foo.org/0'").fetchone()[0]))
+        self.assertTrue(os.path.isabs(cache.get_document_path('http://foo.org/1')))
+        self.assertEqual(b'content 1', cache.get_document('http://foo.org/1'))
+        self.assertTrue(cache.verify_document('http://foo.org/1'))
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+        cache.close()
+
+        cache = pyalveo.Cache(file_dir)
+        for n in range(3):
+            self.assertEqual(b'content %d' % n, cache.get_document('http://foo.org/%d' % n))
+            self.assertFalse(os.path.isabs(cache.conn.execute(
+                "SELECT path FROM documents WHERE url=?",
+                ('http://foo.org/%d' % n,)).fetchone()[0]))
+        self.assertEqual([], [name for name in os.listdir(cache.file_dir)
+                              if name in ('0', '1', '2')])
+        self.assertFalse(pyalveo.cache._table_exists(cache.conn.cursor(), 'legacy_documents'))
+
     def test_add_item(self):
         """Test adding an item to the cache and retrieving it"""
 
@@ -49,11 +212,91 @@ class CacheTest(unittest.TestCase):
         self.assertTrue(cache.has_item(item_url))
         self.assertEqual(item_meta, cache.get_item(item_url))
 
+    def test_transaction(self):
+        """Test grouping cache updates into a transaction"""
+
+        file_dir = 'tmp'
+        self.addCleanup(shutil.rmtree, file_dir, True)
+
+        cache = pyalveo.Cache(file_dir)
+        self.assertEqual(cache.conn.execute("PRAGMA journal_mode").fetchone()[0], 'wal')
+
+        items = [('http://foo.org/%d' % n, '{"n": %d}' % n) for n in range(100)]
+        cache.add_items_bulk(items)
+        self.assertEqual(items[50][1], cache.get_item(items[50][0]))
+
+        with cache.transaction():
+            cache.add_item('http://foo.org/new', 'new')
+            cache.add_primary_texts_bulk([('http://foo.org/new', 'text')])
+            # nothing is visible to other connections until the block ends
+            other = pyalveo.Cache(file_dir)
+            self.assertFalse(other.has_item('http://foo.org/new'))
+        self.assertTrue(other.has_item('http://foo.org/new'))
+        self.assertEqual('text', other.get_primary_text('http://foo.org/new'))
+
+        # updates are discarded if the block fails
+        with self.assertRaises(KeyError):
+            with cache.transaction():
+                cache.add_item('http://foo.org/failed', 'failed')
+                raise KeyError()
+        self.assertFalse(cache.has_item('http://foo.org/failed'))
+
+    def test_threads(self):
+        """Each thread uses its own connection to the database"""
+
+        file_dir = 'tmp'
+        self.addCleanup(shutil.rmtree, file_dir, True)
+
+        cache = pyalveo.Cache(file_dir)
+
+        def work(n):
+            with cache.transaction():
+                for m in range(20):
+                    cache.add_item('http://foo.org/%d/%d' % (n, m), str(m))
+            return cache.conn, cache.get_item('http://foo.org/%d/19' % n)
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(work, range(8)))
+
+        self.assertEqual(['19'] * 8, [item for conn, item in results])
+        # the pool's threads didn't use this thread's connection
+        self.assertFalse(any(conn is cache.conn for conn, item in results))
+        self.assertLessEqual(len(set(id(conn) for conn, item in results)), 4)
+
+        # connections can be closed, and are reopened on next use
+        cache.close()
+        self.assertEqual('0', cache.get_item('http://foo.org/3/0'))
+
+    @unittest.skipUnless(hasattr(os, 'fork'), "needs os.fork")
+    def test_fork(self):
+        """A child process opens its own connection"""
+
+        file_dir = 'tmp'
+        self.addCleanup(shutil.rmtree, file_dir, True)
+
+        cache = pyalveo.Cache(file_dir)
+        cache.add_item('http://foo.org/parent', 'parent')
+        parent_conn = cache.conn
+
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                if cache.conn is not parent_conn and cache.get_item('http://foo.org/parent') == 'parent':
+                    cache.add_item('http://foo.org/child', 'child')
+                    status = 0
+            finally:
+                os._exit(status)
+
+        self.assertEqual(0, os.waitpid(pid, 0)[1])
+        self.assertEqual('child', cache.get_item('http://foo.org/child'))
+        self.assertIs(parent_conn, cache.conn)
+
     def test_to_from_json(self):
         """ Test packing the cache into a json form then reloading it. """
         
         file_dir = 'tmp'
-        expected_json = '{"max_age": 0, "cache_dir": "tmp"}'
+        expected_json = '{"max_age": 0, "cache_dir": "tmp", "journal_mode": "WAL", "synchronous": "NORMAL", "memory_entries": 0, "max_bytes": null, "compression": null, "compression_level": null, "missing_max_age": 86400, "stale_while_revalidate": 0}'
         cache = pyalveo.Cache(file_dir)
         
         json_string = cache.to_json()
@@ -113,7 +356,450 @@ class CacheTest(unittest.TestCase):
         self.assertTrue(cache.has_document(item_url))
         self.assertEqual(item_data, cache.get_document(item_url))
 
-    # TODO: test max_age expiry of cache contents
+    def test_memory_cache(self):
+        """Parsed metadata and primary texts are kept in memory"""
+
+        file_dir = 'tmp'
+        self.addCleanup(shutil.rmtree, file_dir, True)
+
+        cache = pyalveo.Cache(file_dir, memory_entries=2)
+        cache.add_item('http://foo.org/1', '{"n": 1}')
+        cache.add_item('http://foo.org/2', '{"n": 2}')
+        cache.add_primary_text('http://foo.org/1', 'text')
+
+        metadata = cache.lookup_item_metadata('http://foo.org/1')
+        self.assertEqual({'n': 1}, metadata)
+        self.assertIs(metadata, cache.lookup_item_metadata('http://foo.org/1'))
+        self.assertEqual('text', cache.lookup_primary_text('http://foo.org/1'))
+        self.assertEqual({'hits': 1, 'misses': 2, 'entries': 2, 'bytes': 12},
+                         cache.memory.stats())
+
+        # adding a third entry evicts the least recently used
+        self.assertEqual({'n': 2}, cache.lookup_item_metadata('http://foo.org/2'))
+        self.assertEqual(2, len(cache.memory))
+        self.assertIs(cache.MISS, cache.memory.get(('item', 'http://foo.org/1')))
+
+        # updating the database invalidates the memory copy
+        cache.add_item('http://foo.org/2', '{"n": 3}')
+        self.assertEqual({'n': 3}, cache.lookup_item_metadata('http://foo.org/2'))
+
+        # entries are limited by size too
+        memory = pyalveo.cache.MemoryCache(max_entries=10, max_bytes=10)
+        memory.put('a', 'aaaa', 4)
+        memory.put('b', 'bbbb', 4)
+        memory.put('c', 'cccc', 4)
+        self.assertIs(memory.get('a'), pyalveo.cache.MISS)
+        self.assertEqual(memory.get('c'), 'cccc')
+        self.assertEqual(memory.size, 8)
+
+    def test_evict_documents(self):
+        """The least recently used documents are removed to stay in budget"""
+
+        file_dir = 'tmp'
+        cache_db_path = os.path.join(file_dir, 'alveo_cache.db')
+        self.addCleanup(shutil.rmtree, file_dir, True)
+
+        cache = pyalveo.Cache(file_dir, max_bytes=25)
+        cache.add_document('http://foo.org/a', b'a' * 10)
+        cache.add_document('http://foo.org/b', b'b' * 10)
+
+        # make b the least recently used
+        conn = sqlite3.connect(cache_db_path)
+        conn.execute("UPDATE documents SET last_access = last_access - 1000")
+        conn.commit()
+        b_path = conn.execute("SELECT path FROM documents WHERE url='http://foo.org/b'").fetchone()[0]
+        b_path = os.path.join(cache.file_dir, b_path)
+        conn.close()
+        cache.get_document('http://foo.org/a')
+
+        cache.add_document('http://foo.org/c', b'c' * 10)
+        self.assertEqual(20, cache.documents_size())
+        self.assertFalse(cache.has_document('http://foo.org/b'))
+        self.assertFalse(os.path.exists(b_path))
+        self.assertTrue(cache.has_document('http://foo.org/a'))
+        self.assertTrue(cache.has_document('http://foo.org/c'))
+        self.assertEqual(1, cache.evictions)
+
+        # a document bigger than the budget is kept until the next one
+        cache.add_document('http://foo.org/big', b'x' * 30)
+        self.assertEqual(b'x' * 30, cache.get_document('http://foo.org/big'))
+        self.assertEqual(3, cache.evictions)
+
+        self.assertEqual(1, cache.evict())
+        self.assertEqual(0, cache.documents_size())
+        self.assertEqual([], os.listdir(cache.file_dir))
+
+        cache.add_document('http://foo.org/a', b'a' * 10)
+        self.assertEqual(1, cache.trim(5))
+        self.assertFalse(cache.has_document('http://foo.org/a'))
+
+    def test_documents_total(self):
+        """The total size of the documents is kept up to date as they are
+        added and removed, so adding one within budget doesn't scan them all"""
+
+        file_dir = 'tmp'
+        self.addCleanup(shutil.rmtree, file_dir, True)
+
+        cache = pyalveo.Cache(file_dir, max_bytes=100)
+
+        def check():
+            expected = cache.conn.execute(
+                "SELECT " + pyalveo.cache.DOCUMENTS_TOTAL_SQL).fetchone()[0]
+            self.assertEqual(expected, cache.documents_size())
+
+        statements = []
+        cache.conn.set_trace_callback(statements.append)
+        for n in range(5):
+            cache.add_document('http://foo.org/%d' % n, b'%d' % n * 10)
+        cache.conn.set_trace_callback(None)
+        self.assertEqual([], [sql for sql in statements
+                              if 'GROUP BY' in sql or 'ORDER BY' in sql])
+        check()
+
+        cache.add_document('http://foo.org/shared', b'0' * 10)
+        cache.add_document('http://foo.org/0', b'changed')
+        check()
+        cache.add_document('http://foo.org/shared', b'1' * 10)
+        check()
+        with open(cache.get_document_path('http://foo.org/1'), 'wb') as f:
+            f.write(b'broken')
+        self.assertFalse(cache.verify_document('http://foo.org/1'))
+        check()
+        self.assertEqual(37, cache.documents_size())
+
+        cache.add_document('http://foo.org/big', b'x' * 80)
+        check()
+        self.assertTrue(cache.documents_size() <= 100)
+        self.assertTrue(cache.has_document('http://foo.org/big'))
+        self.assertEqual(0, cache.trim(100))
+        self.assertTrue(cache.trim(0) > 0)
+        self.assertEqual(0, cache.documents_size())
+        check()
+
+    def test_dedup_documents(self):
+        """Identical content is stored once and verified by its hash"""
+
+        file_dir = 'tmp'
+        self.addCleanup(shutil.rmtree, file_dir, True)
+
+        cache = pyalveo.Cache(file_dir, max_bytes=25)
+        cache.add_document('http://foo.org/a', b'same' * 5)
+        cache.add_document('http://foo.org/b', b'same' * 5)
+        path = cache.get_document_path('http://foo.org/a')
+        self.assertEqual(path, cache.get_document_path('http://foo.org/b'))
+        self.assertEqual(20, cache.documents_size())
+
+        # the shared file stays until no document refers to it
+        cache.add_document('http://foo.org/a', b'other')
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(25, cache.documents_size())
+        cache.add_document('http://foo.org/b', b'other')
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(5, cache.documents_size())
+
+        # damaged content is detected and dropped
+        self.assertTrue(cache.verify_document('http://foo.org/a'))
+        with open(cache.get_document_path('http://foo.org/a'), 'wb') as f:
+            f.write(b'broken')
+        self.assertFalse(cache.verify_document('http://foo.org/a'))
+        self.assertFalse(cache.has_document('http://foo.org/a'))
+        self.assertFalse(cache.has_document('http://foo.org/b'))
+        self.assertEqual([], os.listdir(cache.file_dir))
+        self.assertRaises(ValueError, cache.verify_document, 'http://foo.org/a')
+
+    def test_transaction_files(self):
+        """Document files replaced or removed in a transaction are only
+        deleted once it commits"""
+
+        file_dir = 'tmp'
+        self.addCleanup(shutil.rmtree, file_dir, True)
+
+        cache = pyalveo.Cache(file_dir)
+        cache.add_document('http://foo.org/a', b'one')
+        one_path = cache.get_document_path('http://foo.org/a')
+
+        with self.assertRaises(KeyError):
+            with cache.transaction():
+                cache.add_document('http://foo.org/a', b'two')
+                two_path = cache.get_document_path('http://foo.org/a')
+                self.assertTrue(os.path.exists(one_path))
+                raise KeyError()
+        self.assertEqual(b'one', cache.get_document('http://foo.org/a'))
+        self.assertFalse(os.path.exists(two_path))
+
+        with cache.transaction():
+            cache.add_document('http://foo.org/a', b'two')
+            self.assertTrue(os.path.exists(one_path))
+        self.assertEqual(b'two', cache.get_document('http://foo.org/a'))
+        self.assertFalse(os.path.exists(one_path))
+
+        with self.assertRaises(KeyError):
+            with cache.transaction():
+                self.assertEqual(1, cache.trim(0))
+                raise KeyError()
+        self.assertEqual(b'two', cache.get_document('http://foo.org/a'))
+        self.assertEqual(1, cache.trim(0))
+        self.assertEqual([], os.listdir(cache.file_dir))
+
+    @unittest.skipIf(pyalveo.cache.fcntl is None, "needs fcntl")
+    def test_files_lock(self):
+        """Document files are stored under a lock shared with other
+        processes, and rewritten if another process removed them"""
+
+        file_dir = 'tmp'
+        self.addCleanup(shutil.rmtree, file_dir, True)
+
+        cache = pyalveo.Cache(file_dir)
+        cache.add_document('http://foo.org/1', b'data')
+        blob_path = cache.get_document_path('http://foo.org/1')
+
+        # another process holds the lock, and releases the file
+        fd = os.open(os.path.join(file_dir, 'files.lock'), os.O_RDWR)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        thread = threading.Thread(target=cache.add_document, args=('http://foo.org/2', b'data'))
+        thread.start()
+        thread.join(0.2)
+        self.assertTrue(thread.is_alive())
+        os.unlink(blob_path)
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+        thread.join()
+
+        self.assertEqual(b'data', cache.get_document('http://foo.org/2'))
+        self.assertTrue(cache.verify_document('http://foo.org/1'))
+
+    def test_document_buffer(self):
+        """Cached documents can be read through a memory-mapped buffer"""
+
+        file_dir = 'tmp'
+        self.addCleanup(shutil.rmtree, file_dir, True)
+
+        cache = pyalveo.Cache(file_dir)
+        cache.add_document('http://foo.org/a', b'0123456789')
+        cache.add_document('http://foo.org/empty', b'')
+
+        buf = cache.get_document_buffer('http://foo.org/a')
+        self.assertEqual(b'345', buf[3:6].tobytes())
+        self.assertTrue(buf.readonly)
+        self.assertEqual(0, len(cache.get_document_buffer('http://foo.org/empty')))
+        self.assertRaises(ValueError, cache.get_document_buffer, 'http://foo.org/b')
+
+    def test_compression(self):
+        """Metadata and primary texts can be stored compressed"""
+
+        file_dir = 'tmp'
+        cache_db_path = os.path.join(file_dir, 'alveo_cache.db')
+        self.addCleanup(shutil.rmtree, file_dir, True)
+
+        metadata = json.dumps({'alveo:metadata': {'dcterms:title': 'title ' * 100}})
+        text = b'some text ' * 100
+
+        cache = pyalveo.Cache(file_dir, compression='zlib')
+        cache.add_item('http://foo.org/1', metadata)
+        cache.add_item('http://foo.org/2', 'small')
+        cache.add_primary_text('http://foo.org/1', text)
+
+        self.assertEqual(metadata, cache.get_item('http://foo.org/1'))
+        self.assertEqual('small', cache.get_item('http://foo.org/2'))
+        self.assertEqual(json.loads(metadata), cache.lookup_item_metadata('http://foo.org/1'))
+        self.assertEqual(text, cache.get_primary_text('http://foo.org/1'))
+
+        conn = sqlite3.connect(cache_db_path)
+        rows = dict(conn.execute("SELECT url, codec FROM items"))
+        self.assertEqual({'http://foo.org/1': 'zlib/utf-8', 'http://foo.org/2': None}, rows)
+        stored = conn.execute("SELECT primary_text, codec FROM primary_texts").fetchone()
+        self.assertLess(len(stored[0]), len(text))
+        self.assertEqual('zlib', stored[1])
+        conn.close()
+
+        # entries are readable whatever compression the cache now uses
+        cache = pyalveo.Cache(file_dir)
+        self.assertEqual(metadata, cache.lookup_item('http://foo.org/1'))
+        self.assertEqual(text, cache.lookup_primary_text('http://foo.org/1'))
+
+        self.assertRaises(ValueError, pyalveo.Cache, file_dir, compression='lzma')
+
+    def test_annotations(self):
+        """Annotations are cached per filter and filtered from a full set"""
+
+        file_dir = 'tmp'
+        self.addCleanup(shutil.rmtree, file_dir, True)
+
+        cache = pyalveo.Cache(file_dir)
+        item_url = 'http://foo.org/1'
+        anns = {'commonProperties': {},
+                'alveo:annotations': [{'type': 'a', 'label': 'x'},
+                                      {'type': 'b', 'label': 'y'}]}
+
+        self.assertIs(cache.MISS, cache.lookup_item_annotations(item_url))
+        cache.add_item_annotations(item_url, json.dumps({'alveo:annotations': []}), 'c')
+        self.assertEqual([], cache.lookup_item_annotations(item_url, 'c')['alveo:annotations'])
+        self.assertIs(cache.MISS, cache.lookup_item_annotations(item_url, 'a'))
+
+        cache.add_item_annotations(item_url, json.dumps(anns))
+        self.assertEqual(anns, cache.lookup_item_annotations(item_url))
+        self.assertEqual([{'type': 'b', 'label': 'y'}],
+                         cache.lookup_item_annotations(item_url, 'b')['alveo:annotations'])
+        self.assertEqual([{'type': 'a', 'label': 'x'}],
+                         cache.lookup_item_annotations(item_url, label='x')['alveo:annotations'])
+        # the filtered entry was replaced by the full set
+        self.assertEqual([], cache.lookup_item_annotations(item_url, 'c')['alveo:annotations'])
+        self.assertEqual([], cache.lookup_item_annotations(item_url, 'a', 'y')['alveo:annotations'])
+
+    def test_missing(self):
+        """Negative results are remembered for missing_max_age seconds"""
+
+        file_dir = 'tmp'
+        cache_db_path = os.path.join(file_dir, 'alveo_cache.db')
+        self.addCleanup(shutil.rmtree, file_dir, True)
+
+        cache = pyalveo.Cache(file_dir, missing_max_age=60)
+        cache.add_missing('http://foo.org/1', 'primary_text')
+        cache.add_missing('http://foo.org/2', 'primary_text')
+        cache.add_missing('http://foo.org/doc', 'document')
+        self.assertTrue(cache.is_missing('http://foo.org/1', 'primary_text'))
+        self.assertFalse(cache.is_missing('http://foo.org/1', 'annotations'))
+
+        # caching the data drops the negative result
+        cache.add_primary_text('http://foo.org/1', 'text')
+        cache.add_document('http://foo.org/doc', b'content')
+        self.assertFalse(cache.is_missing('http://foo.org/1', 'primary_text'))
+        self.assertFalse(cache.is_missing('http://foo.org/doc', 'document'))
+
+        conn = sqlite3.connect(cache_db_path)
+        conn.execute("UPDATE missing SET timestamp = timestamp - 120")
+        conn.commit()
+        conn.close()
+        self.assertFalse(cache.is_missing('http://foo.org/2', 'primary_text'))
+
+        cache = pyalveo.Cache(file_dir, missing_max_age=0)
+        cache.add_missing('http://foo.org/3', 'annotations')
+        self.assertFalse(cache.is_missing('http://foo.org/3', 'annotations'))
+
+    def test_max_age(self):
+        """Entries older than max_age are treated as missing"""
+
+        file_dir = 'tmp'
+        cache_db_path = os.path.join(file_dir, 'alveo_cache.db')
+        self.addCleanup(shutil.rmtree, file_dir, True)
+
+        cache = pyalveo.Cache(file_dir, max_age=60)
+        cache.add_item('http://foo.org/1', 'one')
+        cache.add_primary_text('http://foo.org/1', 'text')
+        self.assertEqual('one', cache.lookup_item('http://foo.org/1'))
+        self.assertIs(cache.MISS, cache.lookup_item('http://foo.org/2'))
+
+        # age the entries
+        conn = sqlite3.connect(cache_db_path)
+        conn.execute("UPDATE items SET timestamp = timestamp - 120")
+        conn.commit()
+        conn.close()
+
+        self.assertIs(cache.MISS, cache.lookup_item('http://foo.org/1'))
+        self.assertFalse(cache.has_item('http://foo.org/1'))
+        self.assertTrue(cache.has_primary_text('http://foo.org/1'))
+        # get_item ignores max_age
+        self.assertEqual('one', cache.get_item('http://foo.org/1'))
+
+        # max_age of zero means entries never expire
+        self.assertEqual('one', pyalveo.Cache(file_dir).lookup_item('http://foo.org/1'))
+
+    def test_document_reads_dont_write(self):
+        """Reading a document only records its access time when that is
+        out of date, and doesn't wait for another writer to do it"""
+
+        file_dir = 'tmp'
+        cache_db_path = os.path.join(file_dir, 'alveo_cache.db')
+        self.addCleanup(shutil.rmtree, file_dir, True)
+
+        cache = pyalveo.Cache(file_dir)
+        cache.add_document('http://foo.org/1', b'data')
+        cache.lookup_document_path('http://foo.org/1')
+        self.assertFalse(cache.conn.in_transaction)
+
+        writer = sqlite3.connect(cache_db_path)
+        writer.execute("UPDATE documents SET last_access = last_access - 1000")
+        writer.commit()
+        # hold the write lock
+        writer.execute("BEGIN IMMEDIATE")
+        start = time.time()
+        self.assertIsNot(cache.MISS, cache.lookup_document_path('http://foo.org/1'))
+        self.assertEqual(b'data', cache.get_document('http://foo.org/1'))
+        self.assertLess(time.time() - start, 5)
+        self.assertFalse(cache.conn.in_transaction)
+        writer.rollback()
+
+        # once the lock is free the access time is updated
+        cache.lookup_document_path('http://foo.org/1')
+        last_access = writer.execute("SELECT last_access FROM documents").fetchone()[0]
+        self.assertGreaterEqual(last_access, time.time() - 10)
+        writer.close()
+
+    def test_validators(self):
+        """ETag and Last-Modified are kept so stale entries can be refreshed"""
+
+        file_dir = 'tmp'
+        cache_db_path = os.path.join(file_dir, 'alveo_cache.db')
+        self.addCleanup(shutil.rmtree, file_dir, True)
+
+        cache = pyalveo.Cache(file_dir, max_age=60)
+        cache.add_item('http://foo.org/1', 'one', etag='"v1"')
+        cache.add_items_bulk([('http://foo.org/2', 'two')])
+        cache.add_document('http://foo.org/1/doc', b'data',
+                           last_modified='Wed, 21 Oct 2015 07:28:00 GMT')
+        self.assertEqual(('"v1"', None), cache.item_validators('http://foo.org/1'))
+        self.assertIsNone(cache.item_validators('http://foo.org/2'))
+        self.assertIsNone(cache.item_validators('http://foo.org/3'))
+        self.assertEqual((None, 'Wed, 21 Oct 2015 07:28:00 GMT'),
+                         cache.document_validators('http://foo.org/1/doc'))
+
+        conn = sqlite3.connect(cache_db_path)
+        conn.execute("UPDATE items SET timestamp = timestamp - 120")
+        conn.execute("UPDATE documents SET timestamp = timestamp - 120")
+        conn.commit()
+        conn.close()
+        self.assertFalse(cache.has_item('http://foo.org/1'))
+        self.assertFalse(cache.has_document('http://foo.org/1/doc'))
+
+        cache.refresh_item('http://foo.org/1', last_modified='Thu, 22 Oct 2015 07:28:00 GMT')
+        cache.refresh_document('http://foo.org/1/doc')
+        self.assertEqual('one', cache.lookup_item('http://foo.org/1'))
+        self.assertTrue(cache.has_document('http://foo.org/1/doc'))
+        self.assertFalse(cache.has_item('http://foo.org/2'))
+        self.assertEqual(('"v1"', 'Thu, 22 Oct 2015 07:28:00 GMT'),
+                         cache.item_validators('http://foo.org/1'))
+
+    def test_stale_lookup(self):
+        """Stale lookups return entries within stale_while_revalidate of max_age"""
+
+        file_dir = 'tmp'
+        cache_db_path = os.path.join(file_dir, 'alveo_cache.db')
+        self.addCleanup(shutil.rmtree, file_dir, True)
+
+        cache = pyalveo.Cache(file_dir, max_age=60, stale_while_revalidate=100,
+                              memory_entries=10)
+        cache.add_item('http://foo.org/1', '{"n": 1}')
+        cache.add_primary_text('http://foo.org/1', 'text')
+        cache.add_document('http://foo.org/1/doc', b'data')
+
+        conn = sqlite3.connect(cache_db_path)
+        for table in ('items', 'primary_texts', 'documents'):
+            conn.execute("UPDATE %s SET timestamp = timestamp - 120" % table)
+        conn.commit()
+
+        self.assertIs(cache.MISS, cache.lookup_item('http://foo.org/1'))
+        self.assertEqual('{"n": 1}', cache.lookup_item('http://foo.org/1', stale=True))
+        self.assertEqual({'n': 1}, cache.lookup_item_metadata('http://foo.org/1', stale=True))
+        # stale entries are not kept in memory
+        self.assertIs(cache.MISS, cache.lookup_item_metadata('http://foo.org/1'))
+        self.assertEqual('text', cache.lookup_primary_text('http://foo.org/1', stale=True))
+        self.assertTrue(cache.lookup_document_path('http://foo.org/1/doc', stale=True)
+                        is not cache.MISS)
+
+        conn.execute("UPDATE items SET timestamp = timestamp - 60")
+        conn.commit()
+        conn.close()
+        self.assertIs(cache.MISS, cache.lookup_item('http://foo.org/1', stale=True))
 
 
 
@@ -0,0 +1,99 @@
+import unittest
+import pyalveo
+import shutil
+import pickle
+import requests_mock
+
+from pyalveo.metrics import endpoint_kind, to_prometheus
+
+API_URL = "https://app.alveo.edu.au"
+API_KEY = "fakekeyvalue"
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_endpoint_kind(self):
+        """Requests are counted by the kind of endpoint"""
+        item_url = API_URL + '/catalog/cooee/1-190'
+        self.assertEqual('item', endpoint_kind(item_url))
+        self.assertEqual('document', endpoint_kind(item_url + '/document/sample.wav'))
+        self.assertEqual('primary_text', endpoint_kind(item_url + '/primary_text.json'))
+        self.assertEqual('annotations', endpoint_kind(item_url + '/annotations.json?type=x'))
+        self.assertEqual('collection', endpoint_kind('/catalog'))
+        self.assertEqual('search', endpoint_kind('/catalog/search?metadata=x'))
+        self.assertEqual('item_list', endpoint_kind(API_URL + '/item_lists.json'))
+        self.assertEqual('other', endpoint_kind('/version'))
+
+    def test_snapshot(self):
+        """Requests and cache lookups are counted in a snapshot"""
+        metrics = pyalveo.Metrics(buckets=(0.1, 1))
+        url = API_URL + '/catalog/cooee/1-190'
+        metrics.record_request(url, 200, 0.05, bytes_in=100)
+        metrics.record_request(url, 200, 0.5, bytes_in=200)
+        metrics.record_request(url, None, 5)
+        metrics.record_request('/catalog', 201, 0.01, bytes_out=10)
+        metrics.record_cache('item', True)
+        metrics.record_cache('item', False)
+        metrics.record_cache('item', True)
+
+        snapshot = metrics.snapshot()
+        self.assertEqual({'count': 3, 'statuses': {200: 2, None: 1},
+                          'bytes_in': 300, 'bytes_out': 0, 'seconds': 5.55,
+                          'latency': [(0.1, 1), (1, 2), (None, 3)]},
+                         snapshot['requests']['item'])
+        self.assertEqual(10, snapshot['requests']['collection']['bytes_out'])
+        self.assertEqual({'item': {'hits': 2, 'misses': 1}}, snapshot['cache'])
+
+        text = to_prometheus(snapshot)
+        self.assertIn('# TYPE pyalveo_requests_total counter\n', text)
+        self.assertIn('pyalveo_requests_total{kind="item",status="error"} 1\n', text)
+        self.assertIn('pyalveo_request_duration_seconds_bucket{kind="item",le="1"} 2\n', text)
+        self.assertIn('pyalveo_request_duration_seconds_bucket{kind="item",le="+Inf"} 3\n', text)
+        self.assertIn('pyalveo_request_duration_seconds_count{kind="item"} 3\n', text)
+        self.assertIn('pyalveo_cache_hits_total{kind="item"} 2\n', text)
+
+        copy = pickle.loads(pickle.dumps(metrics))
+        self.assertEqual((0.1, 1), copy.buckets)
+        self.assertEqual({'requests': {}, 'cache': {}}, copy.snapshot())
+
+
+@requests_mock.Mocker()
+class ClientMetricsTest(unittest.TestCase):
+
+    def test_client(self, m):
+        """A Client with Metrics records its requests, retries and cache use"""
+        m.get(API_URL + "/item_lists.json", json={'success': 'yes'})
+        self.addCleanup(shutil.rmtree, "tmp", True)
+        client = pyalveo.Client(api_url=API_URL, api_key=API_KEY, cache_dir="tmp",
+                                retry=pyalveo.RetryPolicy(backoff=0),
+                                metrics=pyalveo.Metrics())
+
+        item_url = client.oauth.api_url + '/catalog/cooee/1-190'
+        document_url = item_url + '/document/sample.wav'
+        m.get(item_url, [{'status_code': 503}, {'json': {'alveo:catalog_url': item_url}}])
+        m.get(document_url, content=b'0123456789')
+        client.get_item(item_url)
+        client.get_item(item_url)
+        client.get_document(document_url)
+
+        snapshot = client.metrics_snapshot()
+        self.assertEqual({503: 1, 200: 1}, snapshot['requests']['item']['statuses'])
+        self.assertEqual(10, snapshot['requests']['document']['bytes_in'])
+        self.assertEqual({'hits': 1, 'misses': 1}, snapshot['cache']['item'])
+        self.assertEqual({'hits': 0, 'misses': 1}, snapshot['cache']['document'])
+        self.assertEqual({503: 1}, snapshot['retries']['retries_by_status'])
+        self.assertEqual(0, snapshot['evictions'])
+
+        text = client.metrics_text()
+        self.assertIn('pyalveo_retries_total{status="503"} 1\n', text)
+        self.assertIn('pyalveo_cache_evictions_total 0\n', text)
+
+        # without Metrics nothing is recorded
+        client = pyalveo.Client(api_url=API_URL, api_key=API_KEY, cache_dir="tmp")
+        self.assertIsNone(client.metrics)
+        with self.assertRaises(ValueError):
+            client.metrics_snapshot()
+
+
+if __name__ == "__main__" :
+    unittest.main()
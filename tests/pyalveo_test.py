@@ -5,11 +5,22 @@ import shutil
 import requests_mock
 import json
 import tempfile
+import threading
+import time
+import pickle
 
 API_URL = "https://app.alveo.edu.au"
 API_KEY = "fakekeyvalue"
 
 
+def item_identifier(item):
+    """Function for test_map_items, run in worker processes"""
+    identifier = item.metadata()['alveo:metadata']['dcterms:identifier']
+    if identifier == 'bad':
+        raise ValueError(identifier)
+    return identifier, os.getpid()
+
+
 @requests_mock.Mocker()
 class ClientTest(unittest.TestCase):
 
@@ -67,7 +78,7 @@ class ClientTest(unittest.TestCase):
                       'client_secret':'secretrandomtext',
                       'redirect_url':'https://anotherfake.com'
                       }
-        expected_json = '{"use_cache": false, "api_url": "https://example.org", "cache": {"max_age": 0, "cache_dir": "tmp"}, "cache_dir": "tmp", "update_cache": true, "oauth": {"client_id": "morerandomtext", "state": "cgLXfsICCMsuTeY6HWkzsqMPyxTA8K", "token": null, "auth_url": "https://example.org/oauth/authorize?response_type=code&client_id=morerandomtext&redirect_uri=https%3A%2F%2Fanotherfake.com&state=cgLXfsICCMsuTeY6HWkzsqMPyxTA8K", "redirect_url": "https://anotherfake.com", "client_secret": "secretrandomtext", "api_key": "secretkey", "verifySSL": false, "api_url": "https://example.org"}, "api_key": "secretkey"}'
+        expected_json = '{"use_cache": false, "api_url": "https://example.org", "cache": {"max_age": 0, "cache_dir": "tmp", "journal_mode": "WAL", "synchronous": "NORMAL", "memory_entries": 0, "max_bytes": null, "compression": null, "compression_level": null, "missing_max_age": 86400, "stale_while_revalidate": 0}, "cache_dir": "tmp", "update_cache": true, "oauth": {"client_id": "morerandomtext", "state": "cgLXfsICCMsuTeY6HWkzsqMPyxTA8K", "token": null, "auth_url": "https://example.org/oauth/authorize?response_type=code&client_id=morerandomtext&redirect_uri=https%3A%2F%2Fanotherfake.com&state=cgLXfsICCMsuTeY6HWkzsqMPyxTA8K", "redirect_url": "https://anotherfake.com", "client_secret": "secretrandomtext", "api_key": "secretkey", "verifySSL": false, "api_url": "https://example.org", "pool_connections": 10, "pool_maxsize": 10, "pool_block": false}, "retry": {"max_attempts": 5, "backoff": 0.5, "max_backoff": 30, "deadline": 300, "statuses": [429, 500, 502, 503, 504], "methods": ["GET", "HEAD", "OPTIONS", "PUT", "DELETE"]}, "api_key": "secretkey"}'
         client = pyalveo.Client(api_url=api_url,oauth=oauth_dict,verifySSL=verifySSL,use_cache=False,cache_dir=cache_dir, configfile="tests/alveo.config")
         json_string = client.to_json()
         #Test json comes out as expected
@@ -160,10 +171,12 @@ class ClientTest(unittest.TestCase):
             self.assertEqual(doc_content[:20].decode(), "Sydney, New South Wa")
 
         # there should be a cached file somewhere under cache_dir
-        ldir = os.listdir(os.path.join(cache_dir, "files"))
+        ldir = [os.path.join(dirpath, name)
+                for dirpath, dirnames, filenames in os.walk(os.path.join(cache_dir, "files"))
+                for name in filenames]
         self.assertEqual(1, len(ldir))
         # the content of the file should be the same as our doc_content
-        with open(os.path.join(cache_dir, "files", ldir[0]), 'rb') as h:
+        with open(ldir[0], 'rb') as h:
             self.assertEqual(h.read(), doc_content)
 
         # now trigger a cache hit
@@ -251,6 +264,216 @@ class ClientTest(unittest.TestCase):
         self.assertEqual(item.metadata(), item2.metadata())
 
 
+    def test_get_all_concurrent(self, m):
+        """Fetch the items in an ItemGroup with a pool of threads"""
+
+        m.get(API_URL + "/item_lists.json",json={'success': 'yes'})
+        client = pyalveo.Client(api_url=API_URL, api_key=API_KEY, use_cache=True, cache_dir="tmp",
+                                retry=pyalveo.RetryPolicy(backoff=0))
+        self.addCleanup(shutil.rmtree, "tmp", True)
+
+        with open('tests/responses/1-190.json', 'rb') as fd:
+            item_meta = json.loads(fd.read().decode('utf-8'))
+
+        item_urls = []
+        for n in range(20):
+            item_url = client.oauth.api_url + "/catalog/cooee/1-%d" % n
+            meta = dict(item_meta)
+            meta['alveo:catalog_url'] = item_url
+            m.get(item_url, json=meta)
+            item_urls.append(item_url)
+
+        group = pyalveo.ItemGroup(item_urls, client)
+        items = group.get_all(workers=4)
+        self.assertEqual([item.url() for item in items], item_urls)
+        self.assertTrue(client.cache.has_item(item_urls[10]))
+
+        # one failing item is reported without losing the others
+        m.get(item_urls[3], status_code=500)
+        with self.assertRaises(pyalveo.BatchError) as cm:
+            group.get_all(force_download=True, workers=4)
+
+        self.assertEqual([url for url, e in cm.exception.errors], [item_urls[3]])
+        self.assertIsNone(cm.exception.results[3])
+        self.assertEqual(cm.exception.results[4].url(), item_urls[4])
+
+    def test_batch_connections_closed(self, m):
+        """Cache connections of batch worker threads are closed when they exit"""
+
+        m.get(API_URL + "/item_lists.json",json={'success': 'yes'})
+        client = pyalveo.Client(api_url=API_URL, api_key=API_KEY, use_cache=True, cache_dir="tmp")
+        self.addCleanup(shutil.rmtree, "tmp", True)
+
+        item_urls = []
+        for n in range(8):
+            item_url = client.oauth.api_url + "/catalog/cooee/1-%d" % n
+            m.get(item_url, json={'alveo:catalog_url': item_url})
+            item_urls.append(item_url)
+
+        client.cache.has_item(item_urls[0])
+        self.assertEqual(1, len(client.cache._connections))
+        for attempt in range(10):
+            client.get_item_batch(item_urls, force_download=attempt % 2 == 0, workers=4)
+        # only the main thread's connection is left
+        self.assertEqual(1, len(client.cache._connections))
+
+    def test_batch_pool_size(self, m):
+        """The connection pool is grown to the number of batch workers"""
+
+        m.get(API_URL + "/item_lists.json",json={'success': 'yes'})
+        client = pyalveo.Client(api_url=API_URL, api_key=API_KEY, use_cache=False,
+                                update_cache=False, cache_dir="tmp", pool_block=True)
+        self.addCleanup(shutil.rmtree, "tmp", True)
+        self.assertTrue(client.oauth.pool_block)
+
+        item_urls = []
+        for n in range(20):
+            item_url = client.oauth.api_url + "/catalog/cooee/1-%d" % n
+            m.get(item_url, json={'alveo:catalog_url': item_url})
+            item_urls.append(item_url)
+
+        client.get_item_batch(item_urls, workers=16)
+        self.assertEqual(16, client.oauth.pool_maxsize)
+        adapter = client.oauth.session().adapters['https://']
+        self.assertEqual(16, adapter._pool_maxsize)
+        self.assertTrue(adapter._pool_block)
+
+        # a smaller batch leaves the pool as it is
+        client.get_item_batch(item_urls, workers=4)
+        self.assertEqual(16, client.oauth.pool_maxsize)
+
+    def test_concurrent_requests_shared(self, m):
+        """Threads asking for the same URL at once share one request"""
+
+        m.get(API_URL + "/item_lists.json",json={'success': 'yes'})
+        client = pyalveo.Client(api_url=API_URL, api_key=API_KEY, use_cache=True, cache_dir="tmp")
+        self.addCleanup(shutil.rmtree, "tmp", True)
+
+        item_url = client.oauth.api_url + "/catalog/cooee/1-190"
+        document_url = item_url + "/document/sample.wav"
+        release = threading.Event()
+
+        def respond(content):
+            def callback(request, context):
+                release.wait(5)
+                return content
+            return callback
+
+        m.get(item_url, content=respond(json.dumps({'alveo:catalog_url': item_url}).encode()))
+        m.get(document_url, content=respond(b'document'))
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+                       (client.get_item(item_url).url(), client.get_document(document_url))))
+                   for n in range(4)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.2)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([(item_url, b'document')] * 4, results)
+        self.assertEqual(1, len([r for r in m.request_history if r.url == item_url]))
+        self.assertEqual(1, len([r for r in m.request_history if r.url == document_url]))
+        self.assertTrue(client.cache.has_item(item_url))
+
+    def test_pickle(self, m):
+        """Clients can be pickled, without their connections"""
+
+        m.get(API_URL + "/item_lists.json",json={'success': 'yes'})
+        client = pyalveo.Client(api_url=API_URL, api_key=API_KEY, use_cache=True, cache_dir="tmp")
+        self.addCleanup(shutil.rmtree, "tmp", True)
+        client.cache.add_item(API_URL + '/catalog/cooee/1', '{"alveo:catalog_url": "cooee/1"}')
+        client.get_item_lists()
+
+        copy = pickle.loads(pickle.dumps(client))
+        self.assertEqual(client, copy)
+        self.assertEqual(client.oauth, copy.oauth)
+        self.assertIsNot(client.cache.conn, copy.cache.conn)
+        self.assertEqual('cooee/1', copy.get_item(API_URL + '/catalog/cooee/1').url())
+        self.assertEqual({'success': 'yes'}, copy.get_item_lists())
+
+    def test_settings_round_trip(self, m):
+        """The Cache, pool and retry settings survive to_json/from_json and pickling"""
+
+        m.get(API_URL + "/item_lists.json",json={'success': 'yes'})
+        self.addCleanup(shutil.rmtree, "tmp", True)
+        cache = pyalveo.Cache("tmp", max_age=60, journal_mode='DELETE', memory_entries=10,
+                              memory_bytes=1000, max_bytes=5000, compression='zlib',
+                              missing_max_age=5, stale_while_revalidate=30)
+        client = pyalveo.Client(api_url=API_URL, api_key=API_KEY, cache=cache,
+                                pool_maxsize=20, retry=pyalveo.RetryPolicy(max_attempts=2))
+
+        for copy in (pyalveo.Client.from_json(client.to_json()),
+                     pickle.loads(pickle.dumps(client))):
+            self.assertEqual(cache.to_dict(), copy.cache.to_dict())
+            self.assertEqual('DELETE', copy.cache.journal_mode)
+            self.assertEqual(1000, copy.cache.memory.max_bytes)
+            self.assertEqual(20, copy.oauth.pool_maxsize)
+            self.assertEqual(2, copy.retry_policy.max_attempts)
+            self.assertEqual(client.retry_policy.to_dict(), copy.retry_policy.to_dict())
+
+    def test_map_items(self, m):
+        """A function can be mapped over an ItemGroup in worker processes"""
+
+        m.get(API_URL + "/item_lists.json",json={'success': 'yes'})
+        client = pyalveo.Client(api_url=API_URL, api_key=API_KEY, use_cache=True, cache_dir="tmp")
+        self.addCleanup(shutil.rmtree, "tmp", True)
+
+        # the workers read the items from the cache
+        item_urls = []
+        for n in range(6):
+            item_url = client.oauth.api_url + "/catalog/cooee/1-%d" % n
+            client.cache.add_item(item_url, json.dumps(
+                {'alveo:catalog_url': item_url,
+                 'alveo:metadata': {'dcterms:identifier': str(n)}}))
+            item_urls.append(item_url)
+
+        group = pyalveo.ItemGroup(item_urls, client)
+        results = group.map(item_identifier, workers=2)
+        self.assertEqual([str(n) for n in range(6)], [identifier for identifier, pid in results])
+        self.assertNotIn(os.getpid(), [pid for identifier, pid in results])
+
+        client.cache.add_item(item_urls[2], json.dumps(
+            {'alveo:catalog_url': item_urls[2],
+             'alveo:metadata': {'dcterms:identifier': 'bad'}}))
+        with self.assertRaises(pyalveo.BatchError) as cm:
+            group.map(item_identifier, workers=2)
+        self.assertEqual([item_urls[2]], [url for url, e in cm.exception.errors])
+        self.assertIsInstance(cm.exception.errors[0][1], ValueError)
+        self.assertEqual('3', cm.exception.results[3][0])
+
+    def test_map_items_in_flight(self, m):
+        """Worker processes don't wait on requests in flight in the parent"""
+
+        m.get(API_URL + "/item_lists.json",json={'success': 'yes'})
+        client = pyalveo.Client(api_url=API_URL, api_key=API_KEY, use_cache=True, cache_dir="tmp")
+        self.addCleanup(shutil.rmtree, "tmp", True)
+
+        item_url = client.oauth.api_url + "/catalog/cooee/1-190"
+        m.get(item_url, json={'alveo:catalog_url': item_url,
+                              'alveo:metadata': {'dcterms:identifier': '1-190'}})
+
+        # a request for the item is in flight in another thread as the
+        # workers are forked
+        started = threading.Event()
+        release = threading.Event()
+
+        def request():
+            started.set()
+            release.wait(10)
+
+        thread = threading.Thread(target=client._inflight.do, args=(('item', item_url), request))
+        thread.start()
+        self.assertTrue(started.wait(5))
+        try:
+            results = client.map_items(item_identifier, [item_url], workers=1)
+        finally:
+            release.set()
+            thread.join()
+        self.assertEqual('1-190', results[0][0])
+
     def test_download_document(self, m):
         """Download a document"""
 
@@ -272,6 +495,274 @@ class ClientTest(unittest.TestCase):
 
         self.assertTrue(os.path.exists(os.path.join(output_dir, outname)))
 
+    def test_download_document_cached(self, m):
+        """Downloading a document streams it into the cache and the output file"""
+
+        m.get(API_URL + "/item_lists.json",json={'success': 'yes'})
+        client = pyalveo.Client(api_url=API_URL, api_key=API_KEY, use_cache=True, cache_dir="tmp")
+        self.addCleanup(shutil.rmtree, "tmp", True)
+
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir, True)
+
+        document_url = client.oauth.api_url + '/catalog/cooee/1-190/document/sample.wav'
+        document = pyalveo.Document({'alveo:url': document_url}, client)
+
+        with open('tests/responses/sample.wav', 'rb') as rh:
+            expected = rh.read()
+            rh.seek(0)
+            m.get(document_url, body=rh)
+            path = document.download_content(output_dir)
+
+        self.assertEqual(path, os.path.join(output_dir, 'sample.wav'))
+        with open(path, 'rb') as fd:
+            self.assertEqual(fd.read(), expected)
+
+        # the cache holds one complete copy and serves the next request
+        self.assertEqual([os.path.join(dirpath, name)
+                          for dirpath, dirnames, filenames in os.walk(os.path.join("tmp", "files"))
+                          for name in filenames],
+                         [client.cache.get_document_path(document_url)])
+        m.get(document_url, status_code=500)
+        self.assertEqual(document.get_content(), expected)
+        path = document.download_content(output_dir, 'copy.wav')
+        with open(path, 'rb') as fd:
+            self.assertEqual(fd.read(), expected)
+
+    def test_document_buffer(self, m):
+        """Document content can be read through a buffer or file object"""
+        m.get(API_URL + "/item_lists.json",json={'success': 'yes'})
+        client = pyalveo.Client(api_url=API_URL, api_key=API_KEY, use_cache=True, cache_dir="tmp")
+        self.addCleanup(shutil.rmtree, "tmp", True)
+
+        document_url = client.oauth.api_url + '/catalog/cooee/1-190/document/sample.wav'
+        document = pyalveo.Document({'alveo:url': document_url}, client)
+
+        with open('tests/responses/sample.wav', 'rb') as rh:
+            expected = rh.read()
+            rh.seek(0)
+            m.get(document_url, body=rh)
+            buf = document.get_content_buffer()
+
+        self.assertEqual(buf[100:200].tobytes(), expected[100:200])
+        self.assertTrue(buf.readonly)
+        with document.open_content() as fd:
+            fd.seek(100)
+            self.assertEqual(fd.read(100), expected[100:200])
+
+        # without a cache the content is held in memory
+        client = pyalveo.Client(api_url=API_URL, api_key=API_KEY, use_cache=False, update_cache=False)
+        document = pyalveo.Document({'alveo:url': document_url}, client)
+        m.get(document_url, content=expected)
+        self.assertEqual(document.get_content_buffer()[:10].tobytes(), expected[:10])
+        with document.open_content() as fd:
+            self.assertEqual(fd.read(), expected)
+
+    def test_missing_cached(self, m):
+        """Missing documents and primary texts are not requested again"""
+        m.get(API_URL + "/item_lists.json",json={'success': 'yes'})
+        client = pyalveo.Client(api_url=API_URL, api_key=API_KEY, use_cache=True, cache_dir="tmp")
+        self.addCleanup(shutil.rmtree, "tmp", True)
+
+        document_url = client.oauth.api_url + '/catalog/cooee/1-190/document/gone.wav'
+        m.get(document_url, status_code=404)
+        for attempt in range(2):
+            with self.assertRaises(pyalveo.APIError) as cm:
+                client.get_document(document_url)
+            self.assertEqual(404, cm.exception.http_status_code)
+        self.assertEqual(1, len([r for r in m.request_history if r.url == document_url]))
+
+        item_url = client.oauth.api_url + '/catalog/cooee/1-191'
+        m.get(item_url, json={'alveo:catalog_url': item_url,
+                              'alveo:primary_text_url': 'No primary text found'})
+        item = client.get_item(item_url)
+        self.assertIsNone(item.get_primary_text())
+        count = m.call_count
+        self.assertIsNone(client.get_primary_text(item_url))
+        self.assertEqual(count, m.call_count)
+
+        # metadata that now links to a primary text overrides the negative result
+        text_url = item_url + '/primary_text.json'
+        m.get(text_url, content=b'text')
+        item = pyalveo.Item({'alveo:catalog_url': item_url,
+                             'alveo:primary_text_url': text_url}, client)
+        self.assertEqual(b'text', item.get_primary_text())
+        self.assertFalse(client.cache.is_missing(item_url, 'primary_text'))
+
+        other_url = client.oauth.api_url + '/catalog/cooee/1-192'
+        client.cache.add_missing(other_url, 'primary_text')
+        client.cache.add_missing(other_url, 'annotations')
+        m.get(other_url, json={'alveo:catalog_url': other_url,
+                               'alveo:primary_text_url': text_url})
+        client.get_item(other_url, force_download=True)
+        self.assertFalse(client.cache.is_missing(other_url, 'primary_text'))
+        self.assertTrue(client.cache.is_missing(other_url, 'annotations'))
+        self.assertEqual(b'text', client.get_primary_text(other_url))
+
+        # force_download checks again
+        m.get(document_url, content=b'found')
+        self.assertEqual(b'found', client.get_document(document_url, force_download=True))
+
+    def test_revalidate(self, m):
+        """Stale items and documents are revalidated with conditional requests"""
+        m.get(API_URL + "/item_lists.json",json={'success': 'yes'})
+        self.addCleanup(shutil.rmtree, "tmp", True)
+        client = pyalveo.Client(api_url=API_URL, api_key=API_KEY,
+                                cache=pyalveo.Cache("tmp", max_age=60))
+
+        item_url = client.oauth.api_url + '/catalog/cooee/1-190'
+        document_url = item_url + '/document/sample.wav'
+        modified = 'Wed, 21 Oct 2015 07:28:00 GMT'
+        m.get(item_url, json={'alveo:catalog_url': item_url}, headers={'ETag': '"v1"'})
+        m.get(document_url, content=b'data', headers={'Last-Modified': modified})
+        client.get_item(item_url)
+        client.get_document(document_url)
+        self.assertIsNone(m.last_request.headers.get('If-Modified-Since'))
+
+        conn = client.cache.conn
+        conn.execute("UPDATE items SET timestamp = timestamp - 120")
+        conn.execute("UPDATE documents SET timestamp = timestamp - 120")
+        conn.commit()
+
+        m.get(item_url, status_code=304)
+        m.get(document_url, status_code=304)
+        self.assertEqual(item_url, client.get_item(item_url).url())
+        self.assertEqual('"v1"', m.last_request.headers['If-None-Match'])
+        self.assertEqual(b'data', client.get_document(document_url))
+        self.assertEqual(modified, m.last_request.headers['If-Modified-Since'])
+        self.assertNotIn('Range', m.last_request.headers)
+
+        # refreshed entries are fresh again
+        count = m.call_count
+        self.assertTrue(client.cache.has_item(item_url))
+        client.get_item(item_url)
+        client.get_document(document_url)
+        self.assertEqual(count, m.call_count)
+
+        # changed content replaces the cached copy
+        conn.execute("UPDATE documents SET timestamp = timestamp - 120")
+        conn.commit()
+        m.get(document_url, content=b'new', headers={'ETag': '"v2"'})
+        self.assertEqual(b'new', client.get_document(document_url))
+        self.assertEqual(('"v2"', None), client.cache.document_validators(document_url))
+
+    def test_stale_while_revalidate(self, m):
+        """Stale entries are returned at once and refreshed in the background"""
+        m.get(API_URL + "/item_lists.json",json={'success': 'yes'})
+        self.addCleanup(shutil.rmtree, "tmp", True)
+        client = pyalveo.Client(api_url=API_URL, api_key=API_KEY,
+                                cache=pyalveo.Cache("tmp", max_age=60,
+                                                    stale_while_revalidate=600))
+
+        item_url = client.oauth.api_url + '/catalog/cooee/1-190'
+        document_url = item_url + '/document/sample.wav'
+        text_url = item_url + '/primary_text.json'
+        m.get(item_url, json={'alveo:catalog_url': item_url,
+                              'alveo:primary_text_url': text_url, 'version': 1})
+        m.get(document_url, content=b'old')
+        m.get(text_url, content=b'old text')
+        item = client.get_item(item_url)
+        client.get_document(document_url)
+        client.get_primary_text(item)
+
+        def age(seconds):
+            for table in ('items', 'documents', 'primary_texts'):
+                client.cache.conn.execute("UPDATE %s SET timestamp = timestamp - ?" % table,
+                                          (seconds,))
+            client.cache.conn.commit()
+
+        age(120)
+        m.get(item_url, json={'alveo:catalog_url': item_url,
+                              'alveo:primary_text_url': text_url, 'version': 2})
+        m.get(document_url, content=b'new')
+        m.get(text_url, content=b'new text')
+        self.assertEqual(1, client.get_item(item_url).metadata()['version'])
+        self.assertEqual(b'old', client.get_document(document_url))
+        self.assertEqual(b'old text', client.get_primary_text(item))
+
+        # close waits for the refreshes
+        client.close()
+        count = m.call_count
+        self.assertEqual(2, client.get_item(item_url).metadata()['version'])
+        self.assertEqual(b'new', client.get_document(document_url))
+        self.assertEqual(b'new text', client.get_primary_text(item))
+        self.assertEqual(count, m.call_count)
+
+        # entries beyond the bound are fetched straight away
+        age(1000)
+        m.get(document_url, content=b'newer')
+        self.assertEqual(b'newer', client.get_document(document_url))
+
+    def test_resume_download(self, m):
+        """An interrupted document download is resumed with a Range request"""
+
+        m.get(API_URL + "/item_lists.json",json={'success': 'yes'})
+        client = pyalveo.Client(api_url=API_URL, api_key=API_KEY, use_cache=True, cache_dir="tmp")
+        self.addCleanup(shutil.rmtree, "tmp", True)
+
+        document_url = client.oauth.api_url + '/catalog/cooee/1-190/document/sample.wav'
+        with open('tests/responses/sample.wav', 'rb') as rh:
+            content = rh.read()
+
+        # the server drops the connection half way through
+        m.get(document_url, content=content[:1000],
+              headers={'Content-Length': str(len(content)), 'ETag': '"v1"'})
+        self.assertRaises(pyalveo.APIError, client.get_document, document_url)
+        self.assertFalse(client.cache.has_document(document_url))
+        part_path = client.cache.partial_document_path(document_url)
+        self.assertEqual(os.path.getsize(part_path), 1000)
+
+        def partial(request, context):
+            self.assertEqual(request.headers['Range'], 'bytes=1000-')
+            self.assertEqual(request.headers['If-Range'], '"v1"')
+            context.status_code = 206
+            context.headers['Content-Range'] = 'bytes 1000-%d/%d' % (len(content) - 1, len(content))
+            return content[1000:]
+
+        m.get(document_url, content=partial)
+        self.assertEqual(client.get_document(document_url), content)
+        self.assertTrue(client.cache.has_document(document_url))
+        self.assertFalse(os.path.exists(part_path))
+        self.assertEqual([], [name for name in os.listdir(client.cache.file_dir)
+                              if name.startswith(os.path.basename(part_path))])
+
+    def test_resume_changed_download(self, m):
+        """A download is not resumed if the document has changed since"""
+
+        m.get(API_URL + "/item_lists.json",json={'success': 'yes'})
+        client = pyalveo.Client(api_url=API_URL, api_key=API_KEY, use_cache=False,
+                                update_cache=False, cache_dir="tmp")
+        self.addCleanup(shutil.rmtree, "tmp", True)
+        output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir, True)
+
+        document_url = client.oauth.api_url + '/catalog/cooee/1-190/document/sample.wav'
+        file_path = os.path.join(output_dir, 'sample.wav')
+        old, new = b'a' * 2000, b'b' * 2000
+
+        m.get(document_url, content=old[:1000],
+              headers={'Content-Length': '2000', 'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+        self.assertRaises(pyalveo.APIError, client.download_document, document_url, file_path)
+
+        def changed(request, context):
+            # the validator doesn't match, so the whole document is sent
+            self.assertEqual(request.headers['If-Range'], 'Wed, 21 Oct 2015 07:28:00 GMT')
+            return new
+
+        m.get(document_url, content=changed)
+        client.download_document(document_url, file_path)
+        with open(file_path, 'rb') as f:
+            self.assertEqual(new, f.read())
+
+        # a partial file without a validator is not resumed
+        with open(file_path + '.part', 'wb') as f:
+            f.write(old[:1000])
+        m.get(document_url, content=new)
+        client.download_document(document_url, file_path)
+        self.assertNotIn('Range', m.last_request.headers)
+        with open(file_path, 'rb') as f:
+            self.assertEqual(new, f.read())
+
     def test_item_lists(self, m):
         """ Test that the item list can be created, item can be added to the item list,
         item list can be renamed and deleted """
@@ -334,6 +825,61 @@ class ClientTest(unittest.TestCase):
         ann = anns['alveo:annotations'][0]
         self.assertEqual(sorted(ann.keys()), [u'@id', u'@type',  u'end',  u'start', u'type'])
 
+    def test_get_annotations_cached(self, m):
+        """Annotations are cached, and filtered locally from a cached full set"""
+
+        m.get(API_URL + "/item_lists.json",json={'success': 'yes'})
+        client = pyalveo.Client(api_url=API_URL, api_key=API_KEY, use_cache=True, cache_dir="tmp")
+        self.addCleanup(shutil.rmtree, "tmp", True)
+
+        item_url = client.oauth.api_url + "/catalog/ace/A01b"
+        with open('tests/responses/A01b.json', 'rb') as fd:
+            m.get(item_url, content=fd.read())
+        item = client.get_item(item_url)
+
+        ann_url = item_url + '/annotations.json'
+        with open('tests/responses/A01b-annotations.json', 'rb') as fd:
+            m.get(ann_url, content=fd.read())
+        anns = item.get_annotations()
+        self.assertEqual(2, len(anns['alveo:annotations']))
+
+        count = m.call_count
+        heading = u'http://ns.ausnc.org.au/schemas/annotation/ice/heading'
+        anns = item.get_annotations(atype=heading)
+        self.assertEqual([heading], [ann['type'] for ann in anns['alveo:annotations']])
+        self.assertEqual(0, len(item.get_annotations(label='missing')['alveo:annotations']))
+        self.assertEqual(count, m.call_count)
+
+        anns = item.get_annotations(atype=heading, force_download=True)
+        self.assertEqual(count + 1, m.call_count)
+        self.assertEqual({'type': [heading]}, m.last_request.qs)
+
+    def test_item_links(self, m):
+        """Primary text and annotations are fetched without refetching item metadata"""
+
+        m.get(API_URL + "/item_lists.json",json={'success': 'yes'})
+        client = pyalveo.Client(api_url=API_URL, api_key=API_KEY, use_cache=False, update_cache=False)
+
+        item_url = client.oauth.api_url + "/catalog/cooee/1-190"
+        with open('tests/responses/1-190.json', 'rb') as fd:
+            m.get(item_url, content=fd.read())
+        item = client.get_item(item_url)
+
+        text_url = item.metadata()['alveo:primary_text_url']
+        m.get(text_url, content=b'primary text')
+
+        # the Item's own metadata is used
+        count = m.call_count
+        self.assertEqual(b'primary text', item.get_primary_text())
+        self.assertIsNone(item.get_annotations())
+        self.assertEqual(count + 1, m.call_count)
+
+        # the links are remembered for item URLs seen before
+        self.assertEqual(b'primary text', client.get_primary_text(item_url))
+        self.assertIsNone(client.get_item_annotations(item_url))
+        self.assertEqual(count + 2, m.call_count)
+        self.assertEqual(text_url, m.last_request.url)
+
     def test_sparql_query(self, m):
         """Can we run a simple SPARQL query"""
 
@@ -0,0 +1,147 @@
+import unittest
+import pyalveo
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import pickle
+import requests_mock
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from pyalveo.ratelimit import fcntl
+
+API_URL = "https://app.alveo.edu.au"
+API_KEY = "fakekeyvalue"
+
+
+def acquire_times(limiter, n):
+    """Function for test_processes, run in worker processes"""
+    times = []
+    for i in range(n):
+        limiter.release(limiter.acquire())
+        times.append(time.time())
+    return times
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def test_rate(self):
+        """Requests beyond the burst are paced at the rate"""
+        limiter = pyalveo.RateLimiter(rate=50, burst=5)
+        start = time.time()
+        for i in range(10):
+            limiter.release(limiter.acquire())
+        elapsed = time.time() - start
+        # 5 immediately, then one every 20ms
+        self.assertTrue(0.09 <= elapsed < 0.5, elapsed)
+        self.assertEqual(10, limiter.stats()['requests'])
+        self.assertTrue(limiter.stats()['waited'] > 0)
+
+        with self.assertRaises(ValueError):
+            pyalveo.RateLimiter(rate=0)
+
+    def test_concurrency(self):
+        """No more than max_concurrent requests are let through at once"""
+        limiter = pyalveo.RateLimiter(max_concurrent=2)
+        lock = threading.Lock()
+        active = [0, 0]
+
+        def request(n):
+            token = limiter.acquire()
+            try:
+                with lock:
+                    active[0] += 1
+                    active[1] = max(active)
+                time.sleep(0.01)
+                with lock:
+                    active[0] -= 1
+            finally:
+                limiter.release(token)
+
+        with ThreadPoolExecutor(6) as pool:
+            list(pool.map(request, range(12)))
+        self.assertEqual(2, active[1])
+
+    @unittest.skipIf(fcntl is None, "needs fcntl")
+    def test_processes(self):
+        """A RateLimiter with a path is shared between processes"""
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp, True)
+        limiter = pyalveo.RateLimiter(rate=50, burst=1, max_concurrent=1,
+                                      path=os.path.join(tmp, 'limit'))
+        copy = pickle.loads(pickle.dumps(limiter))
+        self.assertEqual(limiter.path, copy.path)
+        self.assertEqual(0, copy.stats()['requests'])
+
+        with ProcessPoolExecutor(2) as pool:
+            times = sorted(sum(pool.map(acquire_times, [limiter] * 2, [5] * 2), []))
+        # ten requests at 50/s between them, rather than 50/s each
+        self.assertTrue(times[-1] - times[0] >= 0.15, times)
+
+
+@requests_mock.Mocker()
+class ClientRateLimitTest(unittest.TestCase):
+
+    def test_client(self, m):
+        """Every request sent by a Client, including retries, is paced"""
+        m.get(API_URL + "/item_lists.json", json={'success': 'yes'})
+        self.addCleanup(shutil.rmtree, "tmp", True)
+        limiter = pyalveo.RateLimiter(rate=1000, max_concurrent=4)
+        client = pyalveo.Client(api_url=API_URL, api_key=API_KEY, cache_dir="tmp",
+                                retry=pyalveo.RetryPolicy(backoff=0),
+                                rate_limit=limiter)
+        self.assertIs(limiter, client.rate_limiter)
+
+        url = API_URL + '/item_lists.json'
+        m.get(url, [{'status_code': 503}, {'json': {'own': []}}])
+        count = limiter.stats()['requests']
+        self.assertEqual({'own': []}, client.api_request(url))
+        self.assertEqual(count + 2, limiter.stats()['requests'])
+
+        client = pickle.loads(pickle.dumps(client))
+        self.assertEqual(1000, client.rate_limiter.rate)
+
+    def test_streamed_download(self, m):
+        """A streamed document body holds its concurrency slot until it
+        has been read"""
+        m.get(API_URL + "/item_lists.json", json={'success': 'yes'})
+        self.addCleanup(shutil.rmtree, "tmp", True)
+        limiter = pyalveo.RateLimiter(max_concurrent=1)
+        client = pyalveo.Client(api_url=API_URL, api_key=API_KEY, cache_dir="tmp",
+                                use_cache=False, update_cache=False,
+                                retry=pyalveo.RetryPolicy(backoff=0),
+                                rate_limit=limiter)
+        free = []
+
+        class Body(io.BytesIO):
+            """A response body noting whether the slot is free as it is read"""
+            def read(self, *args, **kwargs):
+                free.append(limiter._slots.acquire(False))
+                if free[-1]:
+                    limiter._slots.release()
+                return io.BytesIO.read(self, *args, **kwargs)
+
+        doc_url = API_URL + '/catalog/cooee/1-190/document/1-190-plain.txt'
+        m.get(doc_url, body=Body(b'first second'))
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp, True)
+        file_path = os.path.join(tmp, "1-190-plain.txt")
+        client.download_document(doc_url, file_path)
+        with open(file_path, 'rb') as f:
+            self.assertEqual(b'first second', f.read())
+        self.assertTrue(free)
+        self.assertFalse(any(free))
+        self.assertTrue(limiter._slots.acquire(False))
+        limiter._slots.release()
+
+        m.get(doc_url, status_code=500)
+        with self.assertRaises(pyalveo.APIError):
+            client.download_document(doc_url, file_path)
+        self.assertTrue(limiter._slots.acquire(False))
+        limiter._slots.release()
+
+
+if __name__ == "__main__" :
+    unittest.main()
@@ -0,0 +1,97 @@
+import unittest
+import pyalveo
+import shutil
+import pickle
+import requests
+import requests_mock
+from email.utils import formatdate
+
+from pyalveo.retry import parse_retry_after
+
+API_URL = "https://app.alveo.edu.au"
+API_KEY = "fakekeyvalue"
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def test_parse_retry_after(self):
+        """Retry-After is either a number of seconds or an HTTP date"""
+        self.assertEqual(120.0, parse_retry_after('120'))
+        self.assertEqual(0.0, parse_retry_after('-5'))
+        self.assertEqual(30.0, parse_retry_after(formatdate(1000030, usegmt=True), now=1000000))
+        self.assertEqual(0.0, parse_retry_after(formatdate(999000, usegmt=True), now=1000000))
+        self.assertIsNone(parse_retry_after('soon'))
+        self.assertIsNone(parse_retry_after(None))
+
+    def test_next_delay(self):
+        """Only idempotent methods and retryable statuses are retried,
+        up to max_attempts and the deadline"""
+        policy = pyalveo.RetryPolicy(max_attempts=3, backoff=1, deadline=None)
+
+        for attempt in (1, 2):
+            delay = policy.next_delay('GET', attempt, 0, 500)
+            self.assertTrue(0 <= delay <= 2 ** (attempt - 1))
+        self.assertIsNone(policy.next_delay('GET', 3, 0, 500))
+        self.assertIsNone(policy.next_delay('POST', 1, 0, 500))
+        self.assertIsNone(policy.next_delay('GET', 1, 0, 404))
+        self.assertEqual(2.0, policy.next_delay('get', 1, 0, 503, '2'))
+        self.assertTrue(policy.next_delay('GET', 1, 0) is not None)
+
+        self.assertEqual({'retries': 4, 'retries_by_status': {500: 2, 503: 1, None: 1},
+                          'exhausted': 1}, policy.stats())
+
+        policy = pyalveo.RetryPolicy(deadline=10)
+        self.assertIsNone(policy.next_delay('GET', 1, 0, 429, '5'))
+
+        copy = pickle.loads(pickle.dumps(policy))
+        self.assertEqual(10, copy.deadline)
+        self.assertEqual(0, copy.stats()['retries'])
+
+
+@requests_mock.Mocker()
+class ClientRetryTest(unittest.TestCase):
+
+    def client(self, m, **kwargs):
+        m.get(API_URL + "/item_lists.json", json={'success': 'yes'})
+        self.addCleanup(shutil.rmtree, "tmp", True)
+        return pyalveo.Client(api_url=API_URL, api_key=API_KEY, cache_dir="tmp",
+                              retry=pyalveo.RetryPolicy(backoff=0, **kwargs))
+
+    def test_retry_status(self, m):
+        """A GET is retried after 503 and connection errors until it succeeds"""
+        client = self.client(m)
+        url = API_URL + '/item_lists.json'
+        m.get(url, [{'status_code': 503, 'headers': {'Retry-After': '0'}},
+                    {'exc': requests.ConnectionError},
+                    {'json': {'own': []}}])
+
+        self.assertEqual({'own': []}, client.api_request(url))
+        self.assertEqual({'retries': 2, 'retries_by_status': {503: 1, None: 1},
+                          'exhausted': 0}, client.retry_policy.stats())
+
+    def test_retry_exhausted(self, m):
+        """The error is raised once max_attempts have been made, and
+        non-idempotent requests are not retried"""
+        client = self.client(m, max_attempts=2)
+        url = API_URL + '/item_lists.json'
+        m.get(url, status_code=502)
+        count = m.call_count
+        with self.assertRaises(pyalveo.APIError) as cm:
+            client.api_request(url)
+        self.assertEqual(502, cm.exception.http_status_code)
+        self.assertEqual(count + 2, m.call_count)
+
+        m.post(url, status_code=503)
+        count = m.call_count
+        with self.assertRaises(pyalveo.APIError):
+            client.api_request(url, method='POST', data='{}')
+        self.assertEqual(count + 1, m.call_count)
+
+        m.get(url, exc=requests.ConnectionError)
+        with self.assertRaises(requests.ConnectionError):
+            client.api_request(url)
+        self.assertEqual(2, client.retry_policy.stats()['exhausted'])
+
+
+if __name__ == "__main__" :
+    unittest.main()
@@ -31,7 +31,7 @@ class OAuthTest(unittest.TestCase):
                       'client_secret':'secretrandomtext',
                       'redirect_url':'https://anotherfake.com'
                       }
-        expected_json = '{"client_id": "morerandomtext", "state": "Yg4HRoIwCGspnYRQY65jCoPlbIHaiy", "token": null, "auth_url": "https://fake.com/oauth/authorize?response_type=code&client_id=morerandomtext&redirect_uri=https%3A%2F%2Fanotherfake.com&state=Yg4HRoIwCGspnYRQY65jCoPlbIHaiy", "redirect_url": "https://anotherfake.com", "client_secret": "secretrandomtext", "api_key": null, "verifySSL": false, "api_url": "https://fake.com"}'
+        expected_json = '{"client_id": "morerandomtext", "state": "Yg4HRoIwCGspnYRQY65jCoPlbIHaiy", "token": null, "auth_url": "https://fake.com/oauth/authorize?response_type=code&client_id=morerandomtext&redirect_uri=https%3A%2F%2Fanotherfake.com&state=Yg4HRoIwCGspnYRQY65jCoPlbIHaiy", "redirect_url": "https://anotherfake.com", "client_secret": "secretrandomtext", "api_key": null, "verifySSL": false, "api_url": "https://fake.com", "pool_connections": 10, "pool_maxsize": 10, "pool_block": false}'
         oauth = OAuth2(api_url,oauth=oauth_dict,verifySSL=verifySSL)
         json_string = oauth.to_json()
         
@@ -91,5 +91,26 @@ class OAuthTest(unittest.TestCase):
         #result = client.oauth.on_callback(resp)
         #self.assertTrue(result)
 
+    def test_pooled_session(self, m):
+        """Requests made with an API key share one pooled session"""
+
+        m.get(API_URL + "/item_lists.json", json={'success': 'yes'})
+        oauth = OAuth2(API_URL, api_key=API_KEY, pool_maxsize=4)
+
+        oauth.get("/item_lists.json")
+        session = oauth.session()
+        oauth.get("/item_lists.json")
+        self.assertIs(session, oauth.session())
+        self.assertEqual(m.last_request.headers['X-API-KEY'], API_KEY)
+
+        adapter = session.get_adapter(API_URL)
+        self.assertEqual(adapter._pool_maxsize, 4)
+
+        # the session is not part of the object's identity
+        self.assertEqual(oauth, OAuth2(API_URL, api_key=API_KEY, pool_maxsize=4))
+
+        oauth.close()
+        self.assertIsNot(session, oauth.session())
+
 if __name__ == "__main__" :
     unittest.main(verbosity=5)